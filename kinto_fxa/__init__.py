@@ -1,26 +1,65 @@
-import pkg_resources
 import warnings
 
+from kinto.core.events import ACTIONS, ResourceChanged
+from pyramid.events import ApplicationCreated, NewResponse
 from pyramid.exceptions import ConfigurationError
-from pyramid.settings import asbool
 
-from kinto_fxa.authentication import fxa_ping
-from kinto_fxa.utils import parse_clients
+from kinto_fxa.authentication import add_server_timing, fxa_ping, setup_policies
+from kinto_fxa.principal_index import PrincipalIndexer
+from kinto_fxa.reload import build_clients_tables, ClientsReloader
+from kinto_fxa.utils import FxAOAuthSettings
+from kinto_fxa.views import params
+
+try:
+    from importlib.metadata import version
+except ImportError:  # pragma: no cover
+    # Python < 3.8: pkg_resources scans every installed distribution.
+    import pkg_resources
+
+    def version(name):
+        return pkg_resources.get_distribution(name).version
 
 #: Module version, as defined in PEP-0396.
-__version__ = pkg_resources.get_distribution(__package__).version
+__version__ = version(__package__)
 
 
 DEFAULT_SETTINGS = {
+    'fxa-oauth.cache.admission.enabled': False,
+    'fxa-oauth.cache.generations_ttl_seconds': 5,
+    'fxa-oauth.cache.local_max_entries': 0,
+    'fxa-oauth.cache.local_ttl_seconds': 60,
+    'fxa-oauth.cache.shared_memory_path': None,
+    'fxa-oauth.cache.shared_memory_slots': 65536,
+    'fxa-oauth.cache.trace_file': None,
+    'fxa-oauth.cache_ttl_jitter': 0.1,
     'fxa-oauth.cache_ttl_seconds': 5 * 60,
     'fxa-oauth.client_id': None,
     'fxa-oauth.client_secret': None,
+    'fxa-oauth.clients_reload.cache_key': None,
+    'fxa-oauth.clients_reload.file': None,
+    'fxa-oauth.clients_reload.interval_seconds': 10,
+    'fxa-oauth.failover_uris': '',
     'fxa-oauth.heartbeat_timeout_seconds': 3,
+    'fxa-oauth.hedging.enabled': False,
+    'fxa-oauth.hedging.min_delay_seconds': 0.05,
+    'fxa-oauth.hedging.percentile': 95,
     'fxa-oauth.oauth_uri': None,
+    'fxa-oauth.params.cache_expires_seconds': 3600,  # 1 hour
+    'fxa-oauth.principal_index.enabled': False,
+    'fxa-oauth.ratelimit.enabled': False,
+    'fxa-oauth.ratelimit.failures_burst': 20,
+    'fxa-oauth.ratelimit.failures_per_second': 0.5,
+    'fxa-oauth.ratelimit.global_failures_burst': 500,
+    'fxa-oauth.ratelimit.global_failures_per_second': 50,
+    'fxa-oauth.ratelimit.max_clients': 10000,
+    'fxa-oauth.ratelimit.shared': False,
+    'fxa-oauth.ratelimit.trusted_proxies': 0,
     'fxa-oauth.relier.enabled': True,
     'fxa-oauth.requested_scope': 'profile',
     'fxa-oauth.required_scope': None,
+    'fxa-oauth.server_timing.enabled': False,
     'fxa-oauth.state.ttl_seconds': 3600,  # 1 hour
+    'fxa-oauth.token_max_length': 4096,
     'fxa-oauth.webapp.authorized_domains': '',
 }
 
@@ -46,9 +85,40 @@ def includeme(config):
         settings['fxa-oauth.requested_scope'] = settings['fxa-oauth.scope']
         settings['fxa-oauth.required_scope'] = settings['fxa-oauth.scope']
 
-    resources, scope_routing = parse_clients(settings)
-    config.registry._fxa_oauth_config = resources
-    config.registry._fxa_oauth_scope_routing = scope_routing
+    # Validate and convert settings once, instead of on every request.
+    fxa_settings = FxAOAuthSettings.from_settings(settings)
+    config.registry._fxa_oauth_settings = fxa_settings
+
+    # Route scopes and serialize the public parameters once, they only depend
+    # on settings (and on the reloaded clients configuration, if any).
+    config.registry._fxa_oauth_clients = build_clients_tables(settings, fxa_settings)
+
+    # Reload the clients configuration when it changes, without a restart.
+    if fxa_settings.clients_reload_file or fxa_settings.clients_reload_cache_key:
+        if fxa_settings.clients_reload_cache_key and not hasattr(config.registry, 'cache'):
+            message = 'fxa-oauth.clients_reload.cache_key requires a cache backend.'
+            raise ConfigurationError(message)
+        reloader = ClientsReloader(config.registry,
+                                   path=fxa_settings.clients_reload_file,
+                                   cache_key=fxa_settings.clients_reload_cache_key,
+                                   interval=fxa_settings.clients_reload_interval_seconds)
+        # Unlike later reloads, an invalid configuration prevents startup.
+        reloader.reload()
+        config.registry._fxa_oauth_clients_reloader = reloader
+        config.add_subscriber(reloader.start, ApplicationCreated)
+
+    # Build the policies clients before the first requests come in.
+    config.add_subscriber(setup_policies, ApplicationCreated)
+
+    # Expose the duration of the authentication phases to clients.
+    if fxa_settings.server_timing_enabled:
+        config.add_subscriber(add_server_timing, NewResponse)
+
+    # Keep track of the objects that FxA users can write, to purge accounts.
+    if fxa_settings.principal_index_enabled:
+        config.add_subscriber(PrincipalIndexer(settings), ResourceChanged,
+                              for_actions=(ACTIONS.CREATE, ACTIONS.UPDATE),
+                              for_resources=('bucket', 'group', 'collection', 'record'))
 
     # Register heartbeat to ping FxA server.
     config.registry.heartbeats['oauth'] = fxa_ping
@@ -60,9 +130,11 @@ def includeme(config):
                     "using Firefox Account.",
         url="https://github.com/Kinto/kinto-fxa")
 
+    # Register the views explicitly, which is faster than scanning the package.
+    config.add_cornice_service(params.params)
+    config.add_cornice_service(params.clients_params)
     # Ignore FxA OAuth relier endpoint in case it's not activated.
-    relier_enabled = asbool(settings['fxa-oauth.relier.enabled'])
-    kwargs = {}
-    if not relier_enabled:
-        kwargs['ignore'] = 'kinto_fxa.views.relier'
-    config.scan('kinto_fxa.views', **kwargs)
+    if fxa_settings.relier_enabled:
+        from kinto_fxa.views import relier
+        config.add_cornice_service(relier.login)
+        config.add_cornice_service(relier.token)
@@ -1,45 +1,272 @@
+import base64
+import contextlib
+import json
 import logging
+import random
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from urllib.parse import urljoin
 
-import requests
-from fxa.oauth import Client as OAuthClient
-from fxa import errors as fxa_errors
+from kinto.core.errors import http_error, ERRORS
 from pyramid import authentication as base_auth
 from pyramid import httpexceptions
 from pyramid.interfaces import IAuthenticationPolicy
-from pyramid.settings import aslist
 from zope.interface import implementer
 
-from kinto_fxa.utils import fxa_conf
+from kinto_fxa.cache import LocalCache, build_cache_tiers, build_frequency_sketch
+from kinto_fxa.ratelimit import GLOBAL_KEY, RateLimiter, SharedFailureCounter, client_address
+from kinto_fxa.trace import TraceWriter
+from kinto_fxa.utils import StripedLock, fxa_settings, verification_cache_key
 
 logger = logging.getLogger(__name__)
 
 REIFY_KEY = 'fxa_verified_token'
+AUTH_TRACE_KEY = 'fxa_auth_trace'
+
+# Syntax of bearer tokens, as defined in RFC 6750 (b64token).
+TOKEN_PATTERN = re.compile(r'^[A-Za-z0-9\-._~+/]+=*$')
+
+
+def token_expiration(token):
+    """Return the expiration timestamp of JWT access tokens, from their
+    ``exp`` claim, or ``None`` for opaque tokens.
+
+    The signature is not checked, since the token is verified by the FxA
+    server anyway. It is only used to cache its verification for less time.
+    """
+    parts = token.split('.')
+    if len(parts) != 3:
+        return None
+    payload = parts[1] + '=' * (-len(parts[1]) % 4)
+    try:
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+def _elapsed_ms(start):
+    return (time.perf_counter() - start) * 1000
+
+
+@contextlib.contextmanager
+def _no_expiration(timestamp):
+    yield
+
+
+def user_generation_cache_key(user_id):
+    """Return the key under which the generation of the cached verifications
+    of ``user_id`` is stored.
+    """
+    return 'fxa.oauth.user_generation:%s' % user_id
 
 
 class TokenVerificationCache(object):
     """Verification cache class as expected by PyFxa library.
 
-    This basically wraps the cache backend instance to specify a constant ttl.
+    This basically wraps the cache backend instance to specify a ttl: at most
+    ``ttl`` seconds, but no longer than the token is valid (from the ``exp``
+    field of the verification, or the one given with :meth:`expiring_at`),
+    shortened by a random ``jitter`` ratio so that entries created together
+    don't expire together.
+
+    Verifications can also be kept in faster tiers, looked up in order before
+    the cache backend (see :mod:`kinto_fxa.cache`), for at most ``tiers_ttl``
+    seconds.
+
+    Verifications are stamped with the generation of their user, stored in
+    the cache backend, so that all the verified tokens of a user can be
+    invalidated by changing it (see :meth:`invalidate_user`). It is checked
+    when a verification is found in the cache backend, but not in the tiers.
+    Fetching it costs a round trip to the backend on every backend hit and
+    every store, so generations are kept in process for ``generations_ttl``
+    seconds (at most ``generations_max_entries`` of them): invalidations can
+    take that much longer to be noticed.
+
+    Lookups are counted in ``sketch``, if any, for the admission policy of the
+    tiers.
     """
-    def __init__(self, cache, ttl):
+    def __init__(self, cache, ttl, tiers=(), tiers_ttl=None, jitter=0, clock=time.time,
+                 sketch=None, generations_ttl=0, generations_max_entries=10000):
         self.cache = cache
         self.ttl = ttl
+        self.tiers = tuple(tiers)
+        self.tiers_ttl = tiers_ttl
+        self.jitter = jitter
+        self.clock = clock
+        self.sketch = sketch
+        self._generations = None
+        if generations_ttl > 0:
+            self._generations = LocalCache(max_entries=generations_max_entries,
+                                           ttl=generations_ttl, clock=clock)
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def expiring_at(self, timestamp):
+        """Cache the verifications stored in this block (and thread) until
+        ``timestamp`` at most.
+        """
+        self._local.expires_at = timestamp
+        try:
+            yield
+        finally:
+            self._local.expires_at = None
+
+    def _entry_ttl(self, value):
+        expires_at = getattr(self._local, 'expires_at', None)
+        try:
+            expires_at = float(json.loads(value)['exp'])
+        except (ValueError, TypeError, KeyError):
+            pass
+        ttl = self.ttl
+        if expires_at is not None:
+            if expires_at > 1e11:
+                expires_at /= 1000  # In milliseconds.
+            ttl = min(ttl, expires_at - self.clock())
+        if self.jitter:
+            ttl -= ttl * self.jitter * random.random()
+        return ttl
+
+    @property
+    def last_lookup(self):
+        """Where the last lookup of the current thread found a value (the
+        ``name`` of the tier, ``'backend'``, or ``None``), and how many
+        seconds it took.
+        """
+        return getattr(self._local, 'lookup', (None, 0))
+
+    @property
+    def last_lookup_hit(self):
+        """Whether the last lookup of the current thread found a value."""
+        return self.last_lookup[0] is not None
+
+    def get(self, key, count=True):
+        """Return the value of ``key``, if any.
+
+        If ``count`` is false, the lookup is not counted in the sketch (see
+        :meth:`count`).
+        """
+        start = time.perf_counter()
+        if count:
+            self.count(key)
+        value, source = self._get(key)
+        self._local.lookup = (source, time.perf_counter() - start)
+        return value
+
+    def count(self, key):
+        """Count a lookup of ``key`` in the sketch, if any."""
+        if self.sketch is not None:
+            self.sketch.increment(key)
+
+    def _get(self, key):
+        for i, tier in enumerate(self.tiers):
+            try:
+                value = tier.get(key)
+            except Exception:
+                logger.exception("Error while fetching from %s", type(tier).__name__)
+                continue
+            if value is not None:
+                self._promote(self.tiers[:i], key, value, self.ttl)
+                return value, getattr(tier, 'name', type(tier).__name__)
 
-    def get(self, key):
         try:
-            return self.cache.get(key)
+            value = self.cache.get(key)
+            if value is not None and not self._is_current(value):
+                value = None
+            if value is not None and self.tiers:
+                # Don't keep the entry in upper tiers longer than in the backend.
+                self._promote(self.tiers, key, value, self.cache.ttl(key))
+            return value, 'backend' if value is not None else None
         except Exception:
             logger.exception("Error while fetching from cache")
-        return None
+        return None, None
+
+    def _promote(self, tiers, key, value, ttl):
+        if self.tiers_ttl is not None:
+            ttl = min(ttl, self.tiers_ttl)
+        if ttl <= 0:
+            return
+        for tier in tiers:
+            try:
+                tier.set(key, value, ttl)
+            except Exception:
+                logger.exception("Error while storing in %s", type(tier).__name__)
 
     def set(self, key, value):
+        ttl = self._entry_ttl(value)
+        if ttl <= 0:
+            return  # Expired already.
+        value = self._stamp(value)
+        self._promote(self.tiers, key, value, ttl)
         try:
-            self.cache.set(key, value, self.ttl)
+            self.cache.set(key, value, ttl)
+        except Exception:
+            logger.exception("Error while storing in cache")
+
+    @staticmethod
+    def _user(value):
+        """Return the verification of ``value`` and its user ID, if any."""
+        try:
+            verification = json.loads(value)
+            return verification, verification['user']
+        except (ValueError, TypeError, KeyError):
+            return None, None
+
+    def _generation(self, user_id):
+        key = user_generation_cache_key(user_id)
+        if self._generations is not None:
+            # Wrapped, to tell users without generation from missing entries.
+            cached = self._generations.get(key)
+            if cached is not None:
+                return cached[0]
+        generation = self.cache.get(key)
+        if self._generations is not None:
+            self._generations.set(key, (generation,), self._generations.ttl)
+        return generation
+
+    def _stamp(self, value):
+        """Add the current generation of its user to the verification."""
+        verification, user_id = self._user(value)
+        if user_id is None:
+            return value
+        try:
+            generation = self._generation(user_id)
+        except Exception:
+            # Not stamped, it won't be valid if the user has a generation.
+            logger.exception("Error while fetching from cache")
+            return value
+        return json.dumps(dict(verification, _user_generation=generation))
+
+    def _is_current(self, value):
+        """Whether the verification was stored since its user was last invalidated."""
+        verification, user_id = self._user(value)
+        if user_id is None:
+            return True
+        return verification.get('_user_generation') == self._generation(user_id)
+
+    def invalidate_user(self, user_id):
+        """Invalidate the cached verifications of every token of ``user_id``,
+        by changing their generation.
+
+        A single write, so that concurrent verifications can't be missed.
+        """
+        key = user_generation_cache_key(user_id)
+        if self._generations is not None:
+            self._generations.delete(key)
+        try:
+            # The generation outlives the verifications that refer to it.
+            self.cache.set(key, uuid.uuid4().hex, self.ttl)
         except Exception:
             logger.exception("Error while storing in cache")
 
     def delete(self, key):
+        for tier in self.tiers:
+            try:
+                tier.delete(key)
+            except Exception:
+                logger.exception("Error while deleting from %s", type(tier).__name__)
         try:
             self.cache.delete(key)
         except Exception:
@@ -48,10 +275,20 @@ class TokenVerificationCache(object):
 
 @implementer(IAuthenticationPolicy)
 class FxAOAuthAuthenticationPolicy(base_auth.CallbackAuthenticationPolicy):
-    def __init__(self, realm='Realm'):
+    def __init__(self, realm='Realm', lock_stripes=64):
         self.realm = realm
         self._cache = None
         self._auth_client = None
+        self._scope_routing = None
+        self._setup_lock = threading.Lock()
+        # Verifications of the same token are serialized, so that concurrent
+        # requests wait for the first one to fill the cache instead of all
+        # reaching the remote server.
+        self._token_locks = StripedLock(int(lock_stripes))
+        self._limiter = None
+        self._global_limiter = None
+        self._shared_failures = None
+        self._trace = None
 
     def unauthenticated_userid(self, request):
         """Return the FxA userid or ``None`` if token could not be verified.
@@ -64,6 +301,11 @@ class FxAOAuthAuthenticationPolicy(base_auth.CallbackAuthenticationPolicy):
         if authmeth.lower() != 'bearer':
             return None
 
+        # Reject malformed tokens for free, without verifying them.
+        max_length = fxa_settings(request).token_max_length
+        if len(token) > max_length or not TOKEN_PATTERN.match(token):
+            return None
+
         user_id, client_name = self._verify_token(token, request)
 
         # Don't add suffix if authentication failed, or no specific client name is configured
@@ -96,62 +338,232 @@ class FxAOAuthAuthenticationPolicy(base_auth.CallbackAuthenticationPolicy):
         # some data that is shared among sub-requests (e.g. default bucket
         # or batch requests)
         if REIFY_KEY not in request.bound_data:
-            user_id = None
-            client_name = None
             auth_client = self._get_auth_client(request)
-
-            for scope, client in request.registry._fxa_oauth_scope_routing.items():
-                try:
-                    profile = auth_client.verify_token(token=token, scope=aslist(scope))
-                    user_id = profile['user']
-                    scope = profile['scope']
-                    client_name = client
-
-                    # Make sure the bearer token scopes don't match multiple configs.
-                    routing_scopes = request.registry._fxa_oauth_scope_routing
-                    intersecting_scopes = [x for x in routing_scopes.keys()
-                                           if x and set(x.split()).issubset(set(scope))]
-                    if len(intersecting_scopes) > 1:
-                        logger.warn("Invalid FxA token: {} matches multiple config" % scope)
-                        return None, None
-
-                    break
-                except fxa_errors.OutOfProtocolError:
-                    logger.exception("Protocol error")
-                    raise httpexceptions.HTTPServiceUnavailable()
-                except (fxa_errors.InProtocolError, fxa_errors.TrustError) as e:
-                    logger.debug("Invalid FxA token: %s" % e)
+            scope_routing = self._get_scope_routing(request.registry)
+            client_addr = client_address(request,
+                                         fxa_settings(request).ratelimit_trusted_proxies)
+
+            # Durations of the verification phases, in milliseconds.
+            trace = None
+            if fxa_settings(request).server_timing_enabled:
+                trace = dict(lock=0, scopes=0, cache=None, cache_lookup=0, verify=0)
+            start = time.perf_counter()
+            try:
+                # Tokens verified recently don't wait for unrelated verifications
+                # that share their lock.
+                verified = self._cached_verification(token, scope_routing, trace=trace)
+                if verified is None:
+                    # Shed unknown tokens of clients that failed verification too often.
+                    if self._is_throttled(client_addr):
+                        raise self._too_many_requests(client_addr)
+                    locking = time.perf_counter()
+                    with self._token_locks.get(token):
+                        if trace is not None:
+                            trace['lock'] = _elapsed_ms(locking)
+                        # The cache is looked up again, since it may have been
+                        # filled while waiting for the lock.
+                        verified = self._verify_scopes(auth_client, scope_routing, token,
+                                                       trace=trace)
+                user_id, client_name = verified
+            finally:
+                if trace is not None:
+                    trace['total'] = _elapsed_ms(start)
+                    request.bound_data[AUTH_TRACE_KEY] = trace
+                    if hasattr(request, 'log_context'):
+                        request.log_context(fxa_auth=trace)
+
+            if self._trace is not None:
+                hit = self._cache is not None and self._cache.last_lookup_hit
+                self._trace.record(token, client_name, hit)
+
+            if user_id is None:
+                self._record_failure(client_addr)
 
             # Save for next call.
             request.bound_data[REIFY_KEY] = (user_id, client_name)
 
         return request.bound_data[REIFY_KEY]
 
-    def _get_cache(self, request):
-        """Instantiate cache when first request comes in.
-        This way, the policy instantiation is decoupled from registry object.
+    def _verify_scopes(self, auth_client, scope_routing, token, trace=None):
+        """Verify the token against each configured client scopes.
+
+        Return the FxA user id and the name of the matching client, or
+        ``(None, None)`` if the token could not be verified.
+
+        If a ``trace`` dict is given, the number of verified scopes, the
+        milliseconds spent in cache lookups and in remote verifications, and
+        where the last lookup found the verification (``cache``) are recorded
+        in it.
+        """
+        from fxa import errors as fxa_errors
+
+        # Don't cache verifications of JWT access tokens past their expiration.
+        expires_at = token_expiration(token)
+        expiring_at = _no_expiration if self._cache is None else self._cache.expiring_at
+        for _, scopes, client in scope_routing:
+            try:
+                start = time.perf_counter()
+                try:
+                    with expiring_at(expires_at):
+                        profile = auth_client.verify_token(token=token, scope=scopes)
+                finally:
+                    if trace is not None:
+                        self._record_verification(trace, _elapsed_ms(start))
+                return self._matching_client(profile, client, scope_routing)
+            except fxa_errors.OutOfProtocolError:
+                logger.exception("Protocol error")
+                raise httpexceptions.HTTPServiceUnavailable()
+            except (fxa_errors.InProtocolError, fxa_errors.TrustError) as e:
+                logger.debug("Invalid FxA token: %s" % e)
+
+        return None, None
+
+    def _cached_verification(self, token, scope_routing, trace=None):
+        """Return the FxA user id and the name of the matching client from the
+        cached verifications of the token, or ``None`` if there is none.
+
+        Only successful verifications are cached, so the first cached scope
+        is the one that :meth:`_verify_scopes` would match.
         """
         if self._cache is None:
-            if hasattr(request.registry, 'cache'):
-                cache_ttl = float(fxa_conf(request, 'cache_ttl_seconds'))
-                oauth_cache = TokenVerificationCache(request.registry.cache,
-                                                     ttl=cache_ttl)
-                self._cache = oauth_cache
+            return None
+        for _, scopes, client in scope_routing:
+            key = verification_cache_key(token, scopes)
+            # Only count the lookups that don't go through PyFxA afterwards.
+            cached = self._cache.get(key, count=False)
+            if trace is not None:
+                source, lookup = self._cache.last_lookup
+                trace['cache'] = source or 'miss'
+                trace['cache_lookup'] += lookup * 1000
+            if cached is not None:
+                self._cache.count(key)
+                return self._matching_client(json.loads(cached), client, scope_routing)
+        return None
 
-        return self._cache
+    def _matching_client(self, profile, client_name, scope_routing):
+        """Return the FxA user id of the verified ``profile`` and the name of
+        its client, or ``(None, None)`` if its scopes match several clients.
+        """
+        scope = profile['scope']
+        # Make sure the bearer token scopes don't match multiple configs.
+        intersecting_scopes = [x for x, x_scopes, _ in scope_routing
+                               if x and set(x_scopes).issubset(set(scope))]
+        if len(intersecting_scopes) > 1:
+            logger.warn("Invalid FxA token: {} matches multiple config" % scope)
+            return None, None
+        return profile['user'], client_name
+
+    def _record_verification(self, trace, duration):
+        trace['scopes'] += 1
+        if self._cache is not None:
+            source, lookup = self._cache.last_lookup
+            trace['cache'] = source or 'miss'
+            trace['cache_lookup'] += lookup * 1000
+            duration -= lookup * 1000
+        trace['verify'] += duration
+
+    def _is_throttled(self, client_addr):
+        if self._limiter is None:
+            return False
+        # Floods from many addresses are shed too.
+        if self._global_limiter is not None and self._global_limiter.exhausted(GLOBAL_KEY):
+            return True
+        if self._limiter.exhausted(client_addr):
+            return True
+        return self._shared_failures is not None and self._shared_failures.exceeded(client_addr)
+
+    def _record_failure(self, client_addr):
+        if self._limiter is None:
+            return
+        self._limiter.consume(client_addr)
+        if self._global_limiter is not None:
+            self._global_limiter.consume(GLOBAL_KEY)
+        if self._shared_failures is not None:
+            self._shared_failures.incr(client_addr)
+
+    def _too_many_requests(self, client_addr):
+        logger.info("Too many failed verifications from %s", client_addr)
+        retry_after = self._limiter.retry_after(client_addr)
+        if self._global_limiter is not None:
+            retry_after = max(retry_after, self._global_limiter.retry_after(GLOBAL_KEY))
+        retry_after = max(1, int(round(retry_after)))
+        response = http_error(httpexceptions.HTTPTooManyRequests(),
+                              errno=ERRORS.CLIENT_REACHED_CAPACITY,
+                              message='Too many invalid tokens, please retry later.')
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    def _get_scope_routing(self, registry):
+        """Return the scope routing of the registry, with the required scopes
+        split only once instead of on every request.
+        """
+        routing = registry._fxa_oauth_clients.scope_routing
+        parsed = self._scope_routing
+        if parsed is None or parsed[0] is not routing:
+            parsed = (routing, tuple((scope, scope.split(), client)
+                                     for scope, client in routing.items()))
+            self._scope_routing = parsed
+        return parsed[1]
+
+    def setup(self, registry):
+        """Instantiate the verification cache and the OAuthClient.
+
+        This is called when the application is created (see
+        :func:`setup_policies`), and on first request otherwise. This way, the
+        policy instantiation is decoupled from registry object.
+
+        Hopefully keeping the client around lets us retain the requests Session
+        in the PyFxA class and keep the HTTP connection alive for longer.
+        """
+        with self._setup_lock:
+            if self._auth_client is not None:
+                return
+
+            # PyFxA and requests are slow to import, and only needed from here.
+            from fxa.oauth import Client as OAuthClient
+            from kinto_fxa.failover import FailoverOAuthClient
+
+            settings = registry._fxa_oauth_settings
+            if hasattr(registry, 'cache'):
+                sketch = build_frequency_sketch(settings)
+                self._cache = TokenVerificationCache(
+                    registry.cache,
+                    ttl=settings.cache_ttl_seconds,
+                    tiers=build_cache_tiers(settings, sketch=sketch),
+                    tiers_ttl=settings.cache_local_ttl_seconds,
+                    jitter=settings.cache_ttl_jitter,
+                    sketch=sketch,
+                    generations_ttl=settings.cache_generations_ttl_seconds)
+            if settings.cache_trace_file:
+                self._trace = TraceWriter(settings.cache_trace_file,
+                                          registry.settings.get('userid_hmac_secret', ''))
+            if settings.ratelimit_enabled:
+                burst = settings.ratelimit_failures_burst
+                rate = settings.ratelimit_failures_per_second
+                self._limiter = RateLimiter(rate=rate, burst=burst,
+                                            max_keys=settings.ratelimit_max_clients)
+                if settings.ratelimit_global_failures_burst > 0:
+                    self._global_limiter = RateLimiter(
+                        rate=settings.ratelimit_global_failures_per_second,
+                        burst=settings.ratelimit_global_failures_burst, max_keys=1)
+                if settings.ratelimit_shared and hasattr(registry, 'cache'):
+                    self._shared_failures = SharedFailureCounter(registry.cache, limit=burst,
+                                                                 window=burst / rate)
+
+            if settings.failover_uris or settings.hedging_enabled:
+                self._auth_client = FailoverOAuthClient(
+                    (settings.oauth_uri,) + settings.failover_uris,
+                    cache=self._cache,
+                    hedge_percentile=(settings.hedging_percentile
+                                      if settings.hedging_enabled else None),
+                    hedge_min_delay=settings.hedging_min_delay_seconds)
+            else:
+                # Use PyFxa defaults if not specified
+                self._auth_client = OAuthClient(server_url=settings.oauth_uri, cache=self._cache)
 
     def _get_auth_client(self, request):
-        """Instantiate OAuthClient on first request but cache it.
-
-        Hopefully this lets us retain the requests Session in the
-        PyFxA class and keep the HTTP connection alive for longer.
-        """
         if self._auth_client is None:
-            # Use PyFxa defaults if not specified
-            server_url = fxa_conf(request, 'oauth_uri')
-            auth_cache = self._get_cache(request)
-            self._auth_client = OAuthClient(server_url=server_url, cache=auth_cache)
-
+            self.setup(request.registry)
         return self._auth_client
 
     def callback(self, userid, request):
@@ -162,9 +574,89 @@ class FxAOAuthAuthenticationPolicy(base_auth.CallbackAuthenticationPolicy):
         return []
 
 
+def setup_policies(event):
+    """Set up the FxA authentication policies when the application is created,
+    so that the first requests don't race to build the clients.
+    """
+    registry = event.app.registry
+    policy = registry.queryUtility(IAuthenticationPolicy)
+    if hasattr(policy, 'get_policies'):
+        policies = [p for _, p in policy.get_policies()]
+    else:
+        policies = [policy]
+
+    for policy in policies:
+        if isinstance(policy, FxAOAuthAuthenticationPolicy):
+            policy.setup(registry)
+
+
+def server_timing(trace):
+    """Format the authentication ``trace`` of a request as a ``Server-Timing``
+    header value.
+    """
+    return ', '.join((
+        'fxa-lock;dur={:.1f}'.format(trace['lock']),
+        'fxa-cache;dur={:.1f};desc="{}"'.format(trace['cache_lookup'], trace['cache'] or 'none'),
+        'fxa-verify;dur={:.1f};desc="{} scopes"'.format(trace['verify'], trace['scopes']),
+        'fxa-auth;dur={:.1f}'.format(trace['total']),
+    ))
+
+
+def add_server_timing(event):
+    """Add the ``Server-Timing`` header to the responses of the requests whose
+    token was verified.
+    """
+    trace = event.request.bound_data.get(AUTH_TRACE_KEY)
+    if trace is not None:
+        event.response.headers['Server-Timing'] = server_timing(trace)
+
+
+def warm_up_verification_cache(registry, tokens, max_workers=8):
+    """Verify ``tokens`` concurrently in order to fill the verification cache,
+    before clients send them.
+
+    At most ``max_workers`` verifications are run at the same time, and
+    ``tokens`` is consumed as verifications go, so that it can be a stream.
+
+    Return a tuple with the number of verified and rejected tokens.
+    """
+    policy = FxAOAuthAuthenticationPolicy()
+    policy.setup(registry)
+    scope_routing = policy._get_scope_routing(registry)
+
+    def verify(token):
+        try:
+            user_id, _ = policy._verify_scopes(policy._auth_client, scope_routing, token)
+        except httpexceptions.HTTPServiceUnavailable:
+            return False
+        return user_id is not None
+
+    counts = {True: 0, False: 0}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for token in tokens:
+            token = token.strip()
+            if not token:
+                continue
+            if len(pending) >= max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    counts[future.result()] += 1
+            pending.add(executor.submit(verify, token))
+
+        for future in wait(pending).done:
+            counts[future.result()] += 1
+
+    return counts[True], counts[False]
+
+
 def fxa_ping(request):
     """Verify if the OAuth server is ready."""
-    server_url = fxa_conf(request, 'oauth_uri')
+    import requests
+    from fxa.oauth import Client as OAuthClient
+
+    settings = fxa_settings(request)
+    server_url = settings.oauth_uri
 
     oauth = None
     if server_url is not None:
@@ -174,8 +666,7 @@ def fxa_ping(request):
 
         try:
             heartbeat_url = urljoin(server_url, '/__heartbeat__')
-            timeout = float(fxa_conf(request, 'heartbeat_timeout_seconds'))
-            r = requests.get(heartbeat_url, timeout=timeout)
+            r = requests.get(heartbeat_url, timeout=settings.heartbeat_timeout_seconds)
             r.raise_for_status()
             oauth = True
         except requests.exceptions.HTTPError:
@@ -0,0 +1,283 @@
+"""Additional tiers for the token verification cache.
+
+Looking up verified tokens in the *Kinto* cache backend costs a network round
+trip. These tiers keep recent verifications closer to the workers:
+
+- :class:`LocalCache` in the memory of each process;
+- :class:`SharedMemoryCache` in a memory-mapped file, shared by every worker
+  process of the host.
+
+Many tokens are only seen once (e.g. crawlers, short-lived scripts). To keep
+them from evicting the tokens of long-running clients, both tiers can consult
+a :class:`FrequencySketch` of the recent lookups before evicting an entry
+(TinyLFU admission).
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from kinto_fxa.utils import StripedLock
+
+# Translation table that halves every counter of a sketch.
+_HALVE = bytes(i >> 1 for i in range(256))
+
+
+class FrequencySketch(object):
+    """Approximate access frequencies of keys, in a count-min sketch.
+
+    Counters saturate at 15, and are all halved after ``10 * width``
+    increments, so that past popularity fades away. Increments are not
+    synchronized between threads: a few of them can be lost, which only makes
+    estimates a bit more approximate.
+    """
+    depth = 4
+    max_count = 15
+
+    def __init__(self, width):
+        self.width = max(1, int(width))
+        self.sample_size = 10 * self.width
+        self._counters = bytearray(self.depth * self.width)
+        self._increments = 0
+
+    def _indexes(self, key):
+        h1 = hash(key)
+        h2 = hash((key, self.depth)) | 1
+        return [row * self.width + (h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def estimate(self, key):
+        counters = self._counters
+        return min(counters[i] for i in self._indexes(key))
+
+    def increment(self, key):
+        indexes = self._indexes(key)
+        counters = self._counters
+        count = min(counters[i] for i in indexes)
+        if count < self.max_count:
+            # Conservative update: only the smallest counters are incremented.
+            for i in indexes:
+                if counters[i] == count:
+                    counters[i] = count + 1
+        self._increments += 1
+        if self._increments >= self.sample_size:
+            self._counters = bytearray(self._counters.translate(_HALVE))
+            self._increments //= 2
+
+
+class LocalCache(object):
+    """In-process LRU cache, whose entries expire after a ttl.
+
+    If a ``sketch`` is given, new entries are only admitted in a full cache if
+    they were accessed more often than the least recently used entry.
+    """
+    name = 'local'
+
+    def __init__(self, max_entries, ttl, clock=time.time, sketch=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.sketch = sketch
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl):
+        now = self.clock()
+        expires = now + min(ttl, self.ttl)
+        with self._lock:
+            if (self.sketch is not None and key not in self._entries and
+                    len(self._entries) >= self.max_entries):
+                victim = next(iter(self._entries))
+                if (self._entries[victim][1] > now and
+                        self.sketch.estimate(key) <= self.sketch.estimate(victim)):
+                    return
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SharedMemoryCache(object):
+    """Fixed-size hash table in a memory-mapped file, shared between processes.
+
+    Every slot holds one entry, protected by a sequence number: writers make it
+    odd while they update the slot, so that readers can detect torn reads
+    without taking any lock. Writers of the same slot are serialized with a
+    lock on its byte range in the file (between processes), and a striped lock
+    (between the threads of a process).
+
+    Entries are looked up in ``probes`` consecutive slots. When they are all
+    taken, the entry closest to expiration is replaced. If a ``sketch`` is
+    given, it is only replaced by entries that were accessed at least
+    ``min_frequency`` times, since the frequency of the replaced entry is not
+    known.
+    """
+    name = 'shared_memory'
+
+    MAGIC = b'KFXA'
+    VERSION = 1
+
+    _header = struct.Struct('<4sIII')  # magic, version, slots, slot_size
+    _slot = struct.Struct('<Id16sH')  # sequence, expires, key digest, value length
+
+    def __init__(self, path, slots=65536, slot_size=512, probes=4, clock=time.time,
+                 sketch=None, min_frequency=2):
+        if slot_size <= self._slot.size:
+            raise ValueError('Slots must be larger than {} bytes.'.format(self._slot.size))
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.probes = min(probes, slots)
+        self.max_value_size = slot_size - self._slot.size
+        self.clock = clock
+        self.sketch = sketch
+        self.min_frequency = min_frequency
+        self._locks = StripedLock(64)
+
+        size = self._header.size + slots * slot_size
+        # Cached verifications grant access: don't follow a link planted by
+        # another user, nor use a file that other users could read or write.
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            stat = os.fstat(self._fd)
+            if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+                raise ValueError('{} should only be accessible by its owner, '
+                                 'the current user.'.format(path))
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self._header.size, 0)
+            try:
+                if os.fstat(self._fd).st_size == 0:
+                    os.ftruncate(self._fd, size)
+                    os.pwrite(self._fd, self._header.pack(self.MAGIC, self.VERSION,
+                                                          slots, slot_size), 0)
+                header = self._header.unpack(os.pread(self._fd, self._header.size, 0))
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self._header.size, 0)
+            if header != (self.MAGIC, self.VERSION, slots, slot_size):
+                raise ValueError('{} has an incompatible layout {}.'.format(path, header))
+            self._mmap = mmap.mmap(self._fd, size)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def close(self):
+        self._mmap.close()
+        os.close(self._fd)
+
+    def _digest(self, key):
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+
+    def _offsets(self, digest):
+        first = int.from_bytes(digest[:8], 'little') % self.slots
+        for i in range(self.probes):
+            index = (first + i) % self.slots
+            yield index, self._header.size + index * self.slot_size
+
+    def _read(self, offset):
+        """Read the slot at ``offset``, or return ``None`` if it is being written."""
+        seq, expires, digest, length = self._slot.unpack_from(self._mmap, offset)
+        start = offset + self._slot.size
+        value = self._mmap[start:start + min(length, self.max_value_size)]
+        if seq % 2 or self._slot.unpack_from(self._mmap, offset)[0] != seq:
+            return None
+        return expires, digest, value
+
+    def get(self, key):
+        digest = self._digest(key)
+        now = self.clock()
+        for _, offset in self._offsets(digest):
+            entry = self._read(offset)
+            if entry is not None and entry[1] == digest and entry[0] > now:
+                return entry[2].decode('utf-8')
+        return None
+
+    def _write(self, index, offset, expires, digest, value):
+        with self._locks.get(index):
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.slot_size, offset)
+            try:
+                seq = struct.unpack_from('<I', self._mmap, offset)[0]
+                seq = (seq + 1 + seq % 2) % 2 ** 32  # Odd while writing.
+                struct.pack_into('<I', self._mmap, offset, seq)
+                self._slot.pack_into(self._mmap, offset, seq, expires, digest, len(value))
+                start = offset + self._slot.size
+                self._mmap[start:start + len(value)] = value
+                struct.pack_into('<I', self._mmap, offset, (seq + 1) % 2 ** 32)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.slot_size, offset)
+
+    def set(self, key, value, ttl):
+        value = value.encode('utf-8')
+        if len(value) > self.max_value_size:
+            return
+        digest = self._digest(key)
+        now = self.clock()
+        candidates = []
+        for index, offset in self._offsets(digest):
+            entry = self._read(offset)
+            if entry is None:
+                # Being written by someone else, or left over by a crashed writer.
+                # Writes are serialized anyway, so take it over.
+                self._write(index, offset, now + ttl, digest, value)
+                return
+            expires, slot_digest, _ = entry
+            if slot_digest == digest or expires <= now:
+                self._write(index, offset, now + ttl, digest, value)
+                return
+            candidates.append((expires, index, offset))
+        if candidates:
+            if self.sketch is not None and self.sketch.estimate(key) < self.min_frequency:
+                return
+            _, index, offset = min(candidates)
+            self._write(index, offset, now + ttl, digest, value)
+
+    def delete(self, key):
+        digest = self._digest(key)
+        for index, offset in self._offsets(digest):
+            entry = self._read(offset)
+            if entry is not None and entry[1] == digest:
+                self._write(index, offset, 0, bytes(16), b'')
+
+
+def build_frequency_sketch(settings):
+    """Instantiate the sketch of the admission policy, if enabled in settings."""
+    if not settings.cache_admission_enabled:
+        return None
+    width = settings.cache_local_max_entries
+    if settings.cache_shared_memory_path:
+        width = max(width, settings.cache_shared_memory_slots)
+    return FrequencySketch(width or 1024)
+
+
+def build_cache_tiers(settings, sketch=None):
+    """Instantiate the cache tiers enabled in settings, fastest first."""
+    tiers = []
+    if settings.cache_local_max_entries > 0:
+        tiers.append(LocalCache(max_entries=settings.cache_local_max_entries,
+                                ttl=settings.cache_local_ttl_seconds,
+                                sketch=sketch))
+    if settings.cache_shared_memory_path:
+        tiers.append(SharedMemoryCache(settings.cache_shared_memory_path,
+                                       slots=settings.cache_shared_memory_slots,
+                                       sketch=sketch))
+    return tiers
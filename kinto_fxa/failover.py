@@ -0,0 +1,247 @@
+"""Verification of tokens against several FxA OAuth endpoints.
+
+With a single endpoint, a slow FxA server directly sets the tail latency of
+authentication. :class:`FailoverOAuthClient` verifies tokens against a list
+of endpoints:
+
+- it picks the endpoint with the lowest recent latency (exploring the others
+  in turn from time to time);
+- it fails over to the next endpoint when one fails or is unreachable;
+- if hedging is enabled, it sends a second request (to the next endpoint, if
+  any) from a thread pool when the first one has not answered within a
+  percentile of the recent latencies of its endpoint. The first request is
+  sent from the caller's thread, so its answer can't be cut short, but if it
+  fails (e.g. times out), the answer of the hedged request is used right away.
+"""
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from fxa import errors as fxa_errors
+from fxa.oauth import Client as OAuthClient
+
+from kinto_fxa.utils import verification_cache_key
+
+logger = logging.getLogger(__name__)
+
+# Errors after which the verification is retried against another endpoint.
+# Other errors (e.g. unknown token, or scope mismatch) are answers.
+ENDPOINT_ERRORS = (fxa_errors.OutOfProtocolError, fxa_errors.ServerError,
+                   requests.exceptions.RequestException)
+
+
+class EndpointStats(object):
+    """Recent latencies of an endpoint."""
+    def __init__(self, window=200, alpha=0.2):
+        self.samples = deque(maxlen=window)
+        self.alpha = alpha
+        self.average = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            if not self.samples:
+                self.average = seconds
+            else:
+                self.average += self.alpha * (seconds - self.average)
+            self.samples.append(seconds)
+
+    def percentile(self, percent):
+        """Return the given percentile of the recent latencies, if any."""
+        with self._lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+class HedgeScheduler(object):
+    """Submit hedged requests to an executor once their delay has expired,
+    unless they were cancelled in the meantime.
+
+    Delays are handled by a single background thread, so that the threads of
+    the executor only run actual requests. At most ``max_running`` hedged
+    requests run at once: beyond that, the executor is saturated and hedges
+    are not scheduled.
+    """
+    def __init__(self, executor, max_running, clock=time.monotonic):
+        self.executor = executor
+        self.max_running = max_running
+        self.clock = clock
+        self.running = 0
+        self._scheduled = []
+        self._ids = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, delay, fn, *args):
+        """Return a :class:`Hedge` calling ``fn(*args)`` in ``delay`` seconds,
+        or ``None`` if the executor is saturated.
+        """
+        with self._condition:
+            if self.running >= self.max_running:
+                return None
+            hedge = Hedge(self, fn, args)
+            heapq.heappush(self._scheduled, (self.clock() + delay, next(self._ids), hedge))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='fxa-hedge',
+                                                daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return hedge
+
+    def _submit(self, hedge):
+        # Called with the condition held.
+        self.running += 1
+        hedge.future = self.executor.submit(hedge.fn, *hedge.args)
+        hedge.future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self._condition:
+            self.running -= 1
+
+    def _run(self):
+        with self._condition:
+            while True:
+                now = self.clock()
+                while self._scheduled and self._scheduled[0][0] <= now:
+                    _, _, hedge = heapq.heappop(self._scheduled)
+                    if not hedge.cancelled:
+                        self._submit(hedge)
+                timeout = self._scheduled[0][0] - now if self._scheduled else None
+                self._condition.wait(timeout)
+
+
+class Hedge(object):
+    """A hedged request, scheduled with a :class:`HedgeScheduler`."""
+    def __init__(self, scheduler, fn, args):
+        self.scheduler = scheduler
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+        self.future = None
+
+    def cancel(self):
+        """Cancel the request, unless it was sent already. Return its future,
+        if it was.
+        """
+        with self.scheduler._condition:
+            if self.future is None:
+                self.cancelled = True
+            return self.future
+
+
+class FailoverOAuthClient(object):
+    """Drop-in replacement of the PyFxA OAuth client's ``verify_token()``,
+    verifying tokens against several endpoints.
+
+    Verifications are cached in ``cache`` (with the same keys as PyFxA).
+    Failures count as ``failure_penalty`` seconds of latency for the endpoint.
+    """
+    #: Proportion of verifications sent to another endpoint than the fastest
+    #: one, to keep track of its latency. The other endpoints are explored in
+    #: turn, so that penalized ones are probed again.
+    explore_every = 50
+
+    def __init__(self, server_urls, cache=None, hedge_percentile=None, hedge_min_delay=0.05,
+                 failure_penalty=5, max_workers=64, clock=time.perf_counter,
+                 client_factory=OAuthClient):
+        self.clients = [client_factory(server_url=url) for url in server_urls]
+        self.stats = [EndpointStats() for _ in self.clients]
+        self.server_url = self.clients[0].server_url
+        self.cache = cache
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.failure_penalty = failure_penalty
+        self.clock = clock
+        self._calls = itertools.count(1)
+        self._executor = self._hedges = None
+        if hedge_percentile is not None:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                                thread_name_prefix='fxa-verify')
+            self._hedges = HedgeScheduler(self._executor, max_running=max_workers)
+
+    def verify_token(self, token, scope=None):
+        key = verification_cache_key(token, scope)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return json.loads(cached)
+
+        if self._executor is None:
+            profile = self._verify_in_turn(token, scope)
+        else:
+            profile = self._verify_hedged(token, scope)
+
+        if self.cache is not None:
+            self.cache.set(key, json.dumps(profile))
+        return profile
+
+    def _endpoints(self):
+        """Return the indices of the endpoints, from the fastest."""
+        order = sorted(range(len(self.clients)), key=lambda i: self.stats[i].average)
+        call = next(self._calls)
+        if len(order) > 1 and call % self.explore_every == 0:
+            explored = 1 + (call // self.explore_every - 1) % (len(order) - 1)
+            order.insert(0, order.pop(explored))
+        return order
+
+    def _verify(self, index, token, scope):
+        start = self.clock()
+        try:
+            profile = self.clients[index].verify_token(token=token, scope=scope)
+        except ENDPOINT_ERRORS as e:
+            logger.warning("Verification failed on %s: %s", self.clients[index].server_url, e)
+            self.stats[index].record(self.failure_penalty)
+            raise
+        except Exception:
+            self.stats[index].record(self.clock() - start)
+            raise
+        self.stats[index].record(self.clock() - start)
+        return profile
+
+    def _verify_in_turn(self, token, scope):
+        return self._verify_in_turn_from(self._endpoints(), token, scope)
+
+    def _verify_in_turn_from(self, endpoints, token, scope):
+        for index in endpoints[:-1]:
+            try:
+                return self._verify(index, token, scope)
+            except ENDPOINT_ERRORS:
+                continue
+        return self._verify(endpoints[-1], token, scope)
+
+    def _hedge_delay(self, index):
+        delay = self.stats[index].percentile(self.hedge_percentile)
+        return self.hedge_min_delay if delay is None else max(delay, self.hedge_min_delay)
+
+    def _verify_hedged(self, token, scope):
+        endpoints = self._endpoints()
+        # With a single endpoint, the hedged request is sent to the same one.
+        backups = endpoints[1:] or endpoints
+        hedge = self._hedges.schedule(self._hedge_delay(endpoints[0]),
+                                      self._verify, backups[0], token, scope)
+        future = None
+        try:
+            return self._verify(endpoints[0], token, scope)
+        except ENDPOINT_ERRORS:
+            pass  # Fail over below.
+        finally:
+            if hedge is not None:
+                future = hedge.cancel()
+
+        if future is None:
+            # Not hedged, or not sent yet: fail over from this thread instead.
+            return self._verify_in_turn_from(backups, token, scope)
+        try:
+            return future.result()
+        except ENDPOINT_ERRORS:
+            if len(backups) == 1:
+                raise
+        return self._verify_in_turn_from(backups[1:], token, scope)
@@ -0,0 +1,184 @@
+"""Index of the objects that FxA users can write.
+
+Deleting the default bucket of an account is not enough when users can
+store data elsewhere. Finding the objects that a principal can write would
+otherwise mean scanning the whole permission backend.
+
+The index maps each FxA principal (e.g. ``fxa:<uid>`` and its client-suffixed
+variants) to the URIs of the objects on which it has the ``write`` permission.
+It is stored in the storage backend, one object per URI under the principal,
+and maintained by a ``ResourceChanged`` subscriber, in the same transaction as
+the changes. It can also be rebuilt in one pass with
+:func:`rebuild_principal_index`.
+
+Entries are not removed when permissions are revoked or objects deleted:
+they are checked against the permission backend when the account is purged.
+"""
+import hashlib
+import logging
+
+from kinto.core.storage import exceptions as storage_exceptions
+
+from kinto_fxa.utils import get_userid_variants
+
+logger = logging.getLogger(__name__)
+
+#: Name of the storage resource in which the index is kept.
+RESOURCE_NAME = 'fxa-principal-index'
+
+
+def object_location(uri):
+    """Return the resource name, parent ID and object ID of a Kinto object URI.
+
+    >>> object_location('/buckets/b/collections/c')
+    ('collection', '/buckets/b', 'c')
+    """
+    parts = uri.strip('/').split('/')
+    parent_id = '/' + '/'.join(parts[:-2]) if len(parts) > 2 else ''
+    return parts[-2].rstrip('s'), parent_id, parts[-1]
+
+
+class PrincipalIndex(object):
+    """Principal to writable objects index, stored in the storage backend."""
+    def __init__(self, storage):
+        self.storage = storage
+
+    def _key(self, uri):
+        return hashlib.sha256(uri.encode('utf-8')).hexdigest()[:32]
+
+    def add(self, principal, uris):
+        for uri in uris:
+            # Storage updates are upserts.
+            self.storage.update(RESOURCE_NAME, principal, self._key(uri), {'uri': uri})
+
+    def lookup(self, principal):
+        """Return the indexed URIs of ``principal``."""
+        return [entry['uri'] for entry in self.storage.list_all(RESOURCE_NAME, principal)]
+
+    def remove(self, principal):
+        self.storage.delete_all(RESOURCE_NAME, principal, with_deleted=False)
+
+    def flush(self):
+        self.storage.delete_all(RESOURCE_NAME, '*', with_deleted=False)
+
+    def index_permissions(self, uris, permissions, prefix):
+        """Index the writers of ``uris`` whose principal starts with ``prefix``.
+
+        ``permissions`` are the permissions of each URI, as returned by
+        ``get_objects_permissions()``.
+        """
+        by_principal = {}
+        for uri, perms in zip(uris, permissions):
+            for principal in perms.get('write', ()):
+                if principal.startswith(prefix):
+                    by_principal.setdefault(principal, []).append(uri)
+        for principal, principal_uris in by_principal.items():
+            self.add(principal, principal_uris)
+
+
+class PrincipalIndexer(object):
+    """``ResourceChanged`` subscriber that indexes the writers of changed objects."""
+    def __init__(self, settings):
+        self.prefix, _ = get_userid_variants(settings)
+
+    def __call__(self, event):
+        parts = event.payload['uri'].rstrip('/').split('/')
+        # Plural endpoints (e.g. ``/buckets/b/collections``) don't end with an ID.
+        plural = len(parts) % 2 == 0
+        uris = []
+        for impacted in event.impacted_objects:
+            object_parts = parts if plural else parts[:-1]
+            uris.append('/'.join(object_parts + [impacted['new']['id']]))
+
+        registry = event.request.registry
+        permissions = registry.permission.get_objects_permissions(uris)
+        PrincipalIndex(registry.storage).index_permissions(uris, permissions, self.prefix)
+
+
+def _walk_objects(storage, parent_id=''):
+    """Yield the URIs of every bucket, group, collection and record."""
+    children = {'': ('bucket',), 'bucket': ('group', 'collection'), 'collection': ('record',)}
+    parent_name = object_location(parent_id)[0] if parent_id else ''
+    for resource_name in children.get(parent_name, ()):
+        for obj in storage.list_all(resource_name, parent_id):
+            uri = '{}/{}s/{}'.format(parent_id, resource_name, obj['id'])
+            yield uri
+            yield from _walk_objects(storage, uri)
+
+
+def rebuild_principal_index(registry, batch_size=1000):
+    """Rebuild the index from the storage and permission backends.
+
+    Returns the number of objects that were visited.
+    """
+    prefix, _ = get_userid_variants(registry.settings)
+    index = PrincipalIndex(registry.storage)
+    index.flush()
+    count = 0
+    batch = []
+
+    def flush():
+        permissions = registry.permission.get_objects_permissions(batch)
+        index.index_permissions(batch, permissions, prefix)
+        batch.clear()
+
+    for uri in _walk_objects(registry.storage):
+        count += 1
+        batch.append(uri)
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    return count
+
+
+def delete_object(registry, uri):
+    """Delete an object, its descendants and their permissions."""
+    resource_name, parent_id, object_id = object_location(uri)
+    try:
+        registry.storage.delete(resource_name, parent_id, object_id, with_deleted=False)
+    except storage_exceptions.ObjectNotFoundError:
+        pass
+    registry.storage.delete_all(None, uri + '/*', with_deleted=False)
+    registry.storage.purge_deleted(None, uri + '/*')
+    registry.permission.delete_object_permissions(uri, uri + '/*')
+
+
+def purge_principals(registry, principals):
+    """Delete the objects of an account, or revoke its permissions on shared ones.
+
+    ``principals`` are all the principals of the account. Objects on which
+    only they have the ``write`` permission are deleted with their
+    descendants. On the others, the principals are removed from every
+    permission.
+
+    Returns the number of deleted objects and the number of objects on which
+    permissions were revoked.
+    """
+    principals = set(principals)
+    index = PrincipalIndex(registry.storage)
+    uris = sorted({uri for principal in principals for uri in index.lookup(principal)},
+                  key=lambda uri: (len(uri), uri))
+    permissions = registry.permission.get_objects_permissions(uris) if uris else []
+
+    deleted = []
+    revoked = 0
+    for uri, perms in zip(uris, permissions):
+        if any(uri.startswith(parent + '/') for parent in deleted):
+            continue  # Already deleted with its parent.
+        writers = perms.get('write', set())
+        if not writers & principals:
+            continue  # Stale entry.
+        if writers <= principals:
+            logger.info("Deleting %r", uri)
+            delete_object(registry, uri)
+            deleted.append(uri)
+        else:
+            logger.info("Revoking permissions on %r", uri)
+            for permission, perm_principals in perms.items():
+                for principal in perm_principals & principals:
+                    registry.permission.remove_principal_from_ace(uri, permission, principal)
+            revoked += 1
+
+    for principal in principals:
+        index.remove(principal)
+    return len(deleted), revoked
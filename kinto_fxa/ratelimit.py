@@ -0,0 +1,122 @@
+"""Rate limiting of bearer token verifications.
+
+Verifying an unknown token costs a round trip to the FxA server. Clients
+whose tokens keep failing verification are limited, so that flooding random
+tokens can't turn every request into a remote call.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+#: Key of the budget shared by all clients in a :class:`RateLimiter`.
+GLOBAL_KEY = '*'
+
+
+def client_address(request, trusted_proxies=0):
+    """Return the IP address of the client of ``request``.
+
+    The ``X-Forwarded-For`` header can be set by anyone, so only the entries
+    appended by the ``trusted_proxies`` closest proxies are trusted. Without
+    trusted proxies, the address of the peer is used.
+    """
+    addresses = [request.remote_addr]
+    if trusted_proxies > 0:
+        forwarded = request.headers.get('X-Forwarded-For', '')
+        addresses = [a.strip() for a in forwarded.split(',') if a.strip()] + addresses
+    return addresses[max(0, len(addresses) - 1 - trusted_proxies)]
+
+
+class RateLimiter(object):
+    """In-process token buckets, indexed by key (e.g. client IP address).
+
+    Each bucket holds up to ``burst`` tokens and is refilled at ``rate``
+    tokens per second. Only the ``max_keys`` most recently used buckets are
+    kept in memory.
+    """
+    def __init__(self, rate, burst, max_keys=10000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _refill(self, key, now):
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        return tokens
+
+    def _store(self, key, tokens, now):
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+
+    def consume(self, key, cost=1):
+        """Take ``cost`` tokens from the bucket of ``key``.
+
+        Return ``False`` if there were not enough tokens left.
+        """
+        with self._lock:
+            now = self.clock()
+            tokens = self._refill(key, now)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._store(key, tokens, now)
+        return allowed
+
+    def exhausted(self, key):
+        """Return ``True`` if the bucket of ``key`` has less than one token."""
+        with self._lock:
+            if key not in self._buckets:
+                return False
+            now = self.clock()
+            tokens = self._refill(key, now)
+            self._store(key, tokens, now)
+        return tokens < 1
+
+    def retry_after(self, key):
+        """Number of seconds until the bucket of ``key`` has a token again."""
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.burst, self.clock()))
+        missing = max(0, 1 - tokens)
+        return missing / self.rate if self.rate else float('inf')
+
+
+class SharedFailureCounter(object):
+    """Count failures in the Kinto cache backend, to aggregate them between
+    processes and hosts.
+
+    Failures are counted per fixed window of ``window`` seconds. Counters are
+    read and written without atomicity, which is good enough to detect floods.
+    """
+    prefix = 'fxa-oauth.ratelimit'
+
+    def __init__(self, cache, limit, window, clock=time.time):
+        self.cache = cache
+        self.limit = limit
+        self.window = window
+        self.clock = clock
+
+    def _key(self, key):
+        return '{}:{}:{}'.format(self.prefix, key, int(self.clock() // self.window))
+
+    def incr(self, key):
+        cache_key = self._key(key)
+        try:
+            count = int(self.cache.get(cache_key) or 0) + 1
+            self.cache.set(cache_key, count, self.window)
+        except Exception:
+            logger.exception("Error while counting failures in cache")
+
+    def exceeded(self, key):
+        try:
+            count = int(self.cache.get(self._key(key)) or 0)
+        except Exception:
+            logger.exception("Error while reading failures from cache")
+            return False
+        return count >= self.limit
@@ -0,0 +1,173 @@
+"""Reload the configuration of the FxA clients without a restart.
+
+The ``fxa-oauth.clients.*`` settings are parsed once in ``includeme`` into
+routing tables, published together on the registry as one immutable
+:class:`ClientsTables`: the client resources, the scope routing used by the
+authentication policy, the responses of the params endpoints, and the
+suffixes of the user IDs of the clients (for the account events scripts).
+
+:class:`ClientsReloader` replaces them when the clients configuration changes
+in a file (``fxa-oauth.clients_reload.file``) or in a key of the cache backend
+(``fxa-oauth.clients_reload.cache_key``), polled every
+``fxa-oauth.clients_reload.interval_seconds``. In both cases, the
+configuration is a JSON object of ``fxa-oauth.clients.*`` settings, which
+replace the ones of the INI file::
+
+    {
+        "fxa-oauth.clients.notes.client_id": "89513028159972bc",
+        "fxa-oauth.clients.notes.required_scope": "profile app-notes"
+    }
+
+New tables are validated like at startup (e.g. a scope cannot be required by
+two clients) before being published. An invalid configuration prevents the
+application from starting, and is logged and ignored when reloaded.
+
+All tables are replaced with a single assignment, so they always match each
+other. A request that reads them more than once may still see both versions
+if a reload happens in between. The verification caches and HTTP connection
+pools are kept, and the settings of the registry are left untouched.
+"""
+import json
+import logging
+import os
+import threading
+from collections import namedtuple
+
+from pyramid.exceptions import ConfigurationError
+
+from kinto_fxa.utils import get_userid_variants, parse_clients
+from kinto_fxa.views.params import build_params
+
+logger = logging.getLogger(__name__)
+
+CLIENTS_PREFIX = 'fxa-oauth.clients.'
+
+#: Routing tables of the configured clients, published at once on the registry.
+ClientsTables = namedtuple('ClientsTables', ['resources', 'scope_routing', 'params',
+                                             'clients_params', 'userid_suffixes'])
+
+
+def build_clients_tables(settings, fxa_settings):
+    """Build the routing tables of the clients configured in ``settings``.
+
+    :raises ConfigurationError: if the clients configuration is invalid.
+    """
+    resources, scope_routing = parse_clients(settings)
+    _, suffixes = get_userid_variants(settings)
+    default_params, clients_params = build_params(fxa_settings, resources)
+    return ClientsTables(resources=resources,
+                         scope_routing=scope_routing,
+                         params=default_params,
+                         clients_params=clients_params,
+                         userid_suffixes=tuple(suffixes))
+
+
+class ClientsReloader(object):
+    """Poll the clients configuration of ``path`` or ``cache_key``, and publish
+    its routing tables on ``registry`` when it changes.
+    """
+    def __init__(self, registry, path=None, cache_key=None, interval=10):
+        self.registry = registry
+        self.path = path
+        self.cache_key = cache_key
+        self.interval = interval
+        self._version = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, event=None):
+        """Poll the configuration in a background thread.
+
+        Can be subscribed to ``ApplicationCreated``, so that only applications
+        poll it.
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='fxa-clients-reload',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def _read(self):
+        """Return the version and the content of the configuration, or
+        ``(None, None)`` if there is none.
+        """
+        if self.path is not None:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return None, None
+            version = (stat.st_mtime_ns, stat.st_size)
+            if version == self._version:
+                return version, None
+            try:
+                with open(self.path) as f:
+                    return version, f.read()
+            except OSError as e:
+                raise ConfigurationError('Cannot read {}: {}'.format(self.path, e))
+
+        content = self.registry.cache.get(self.cache_key)
+        if isinstance(content, dict):
+            content = json.dumps(content, sort_keys=True)
+        return content, content
+
+    def check(self):
+        """Reload the configuration if it changed, and log errors.
+
+        Returns whether new routing tables were published. The current ones are
+        kept if the configuration is invalid.
+        """
+        try:
+            reloaded = self.reload()
+        except ConfigurationError as e:
+            logger.error("Invalid FxA clients configuration: %s", e)
+            return False
+        except Exception:
+            logger.exception("Could not reload the FxA clients configuration")
+            return False
+        if reloaded:
+            logger.info("FxA clients configuration reloaded")
+        return reloaded
+
+    def reload(self):
+        """Reload the configuration if it changed.
+
+        Returns whether new routing tables were published.
+
+        :raises ConfigurationError: if the configuration is invalid.
+        """
+        version, content = self._read()
+        if version is None or version == self._version:
+            return False
+        # Don't try again (and log the same error) until it changes.
+        self._version = version
+        try:
+            clients_settings = json.loads(content)
+        except ValueError as e:
+            raise ConfigurationError('Invalid JSON in the clients configuration: {}'.format(e))
+        self.load(clients_settings)
+        return True
+
+    def load(self, clients_settings):
+        """Validate the ``fxa-oauth.clients.*`` settings of ``clients_settings``,
+        and publish their routing tables.
+        """
+        if not isinstance(clients_settings, dict):
+            raise ConfigurationError('The clients configuration should be a JSON object.')
+        unknown = sorted(k for k in clients_settings if not k.startswith(CLIENTS_PREFIX))
+        if unknown:
+            message = 'Only {}* settings can be reloaded, got {}.'.format(
+                CLIENTS_PREFIX, ', '.join(unknown))
+            raise ConfigurationError(message)
+
+        settings = {k: v for k, v in self.registry.settings.items()
+                    if k.startswith('fxa-oauth.') and not k.startswith(CLIENTS_PREFIX)}
+        settings.update(clients_settings)
+        tables = build_clients_tables(settings, self.registry._fxa_oauth_settings)
+        self.registry._fxa_oauth_clients = tables
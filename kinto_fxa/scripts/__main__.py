@@ -6,23 +6,45 @@ import argparse
 import logging.config
 import os
 
-from pyramid.paster import bootstrap
+from pyramid.paster import bootstrap, get_appsettings
 
-from .process_account_events import process_account_events
+# The modules of the subcommands are imported when they run, since some of
+# them import heavy dependencies (e.g. boto3, or kinto and requests).
 
 DEFAULT_CONFIG_FILE = os.getenv('KINTO_INI', 'config/kinto.ini')
 logger = logging.getLogger(__name__)
 
 
+def add_account_events_arguments(subparser):
+    """Add the options shared by the account events subcommands."""
+    subparser.add_argument("--dedup-history-size", type=int, default=10000,
+                           help="Number of processed events to remember in memory")
+    subparser.add_argument("--dedup-ttl", type=int, default=0,
+                           help="Number of seconds to remember processed events "
+                                "in the cache backend (0 to disable)")
+    subparser.add_argument("--max-attempts", type=int, default=5,
+                           help="Number of attempts before giving up on an event")
+    subparser.add_argument("--retry-backoff", type=int, default=30,
+                           help="Number of seconds before the first retry of a failed event, "
+                                "doubled on each attempt")
+    subparser.add_argument("--drain-timeout", type=int, default=30,
+                           help="Number of seconds to finish the events being processed "
+                                "on SIGTERM or SIGINT")
+    subparser.add_argument("--metrics-port", type=int, default=None,
+                           help="Local port on which to serve metrics at /metrics "
+                                "(disabled by default)")
+
+
 def main(args=None):
-    parser = argparse.ArgumentParser(description="Listen to the queue for account messages.")
+    parser = argparse.ArgumentParser(description="Run kinto-fxa utility scripts.")
     parser.add_argument('--ini', dest='ini_file', required=False, default=DEFAULT_CONFIG_FILE,
                         help="path to kinto INI file")
     subparsers = parser.add_subparsers(title='subcommands',
                                        description='kinto-fxa command to run',
                                        dest='subcommand')
     subparsers.required = True
-    subparser = subparsers.add_parser('process-account-events')
+    subparser = subparsers.add_parser('process-account-events',
+                                      help="Listen to the queue for account messages.")
 
     subparser.add_argument('queue_name',
                            help="SQS queue on which to listen for events")
@@ -30,16 +52,146 @@ def main(args=None):
                            help="aws region in which the queue can be found")
     subparser.add_argument("--queue-wait-time", type=int, default=20,
                            help="Number of seconds to wait for jobs on the queue")
+    subparser.add_argument("--visibility-timeout", type=int, default=None,
+                           help="Number of seconds during which messages being processed "
+                                "are hidden from other consumers (defaults to the queue's)")
+    subparser.add_argument("--dead-letter-queue",
+                           help="SQS queue to which events are sent after the last attempt")
+    add_account_events_arguments(subparser)
+
+    subparser = subparsers.add_parser('replay-account-events',
+                                      help="Process the account messages of a file.")
+    subparser.add_argument('events_file', type=argparse.FileType('r'),
+                           help="file with one JSON event per line ('-' for stdin)")
+    subparser.add_argument("--dead-letter-file", type=argparse.FileType('a'),
+                           help="file to which events are written after the last attempt")
+    add_account_events_arguments(subparser)
+
+    subparser = subparsers.add_parser('purge-accounts',
+                                      help="Delete the data of a list of accounts.")
+    subparser.add_argument('uids_file', type=argparse.FileType('r'),
+                           help="file with one FxA user ID per line ('-' for stdin)")
+    subparser.add_argument('--batch-size', type=int, default=1000,
+                           help="Number of accounts to delete per transaction")
+    subparser.add_argument('--checkpoint',
+                           help="file in which progress is saved, to resume an interrupted purge")
+
+    subparser = subparsers.add_parser('rebuild-principal-index',
+                                      help="Index the objects that FxA users can write.")
+    subparser.add_argument('--batch-size', type=int, default=1000,
+                           help="Number of objects whose permissions are fetched at once")
+
+    subparser = subparsers.add_parser('warm-up-cache',
+                                      help="Verify tokens to fill the verification cache.")
+    subparser.add_argument('tokens_file', type=argparse.FileType('r'),
+                           help="file with one bearer token per line ('-' for stdin)")
+    subparser.add_argument('--max-workers', type=int, default=8,
+                           help="Number of tokens to verify concurrently")
+
+    subparser = subparsers.add_parser('simulate-cache',
+                                      help="Replay a trace of cache lookups in simulated caches.")
+    subparser.add_argument('trace_file', type=argparse.FileType('r'),
+                           help="trace recorded with fxa-oauth.cache.trace_file "
+                                "('-' for stdin)")
+    subparser.add_argument('--size', dest='sizes', type=int, action='append',
+                           help="Number of cached verifications (0 for unbounded), "
+                                "can be repeated")
+    subparser.add_argument('--ttl', dest='ttls', type=float, action='append',
+                           help="Number of seconds verifications are cached, can be repeated")
+    subparser.add_argument('--admission', choices=('off', 'on', 'both'), default='off',
+                           help="Whether to simulate the admission policy")
+    subparser.add_argument('--jitter', type=float, default=0.1,
+                           help="Maximum ratio by which TTLs are shortened")
+    subparser.add_argument('--entry-size', type=int, default=512,
+                           help="Estimated memory used by a cached verification, in bytes")
+
+    subparser = subparsers.add_parser('load-test-relier',
+                                      help="Load test the OAuth relier flow against a fake "
+                                           "FxA server.")
+    subparser.add_argument('--flows', type=int, default=1000,
+                           help="Number of login flows to run")
+    subparser.add_argument('--concurrency', type=int, default=8,
+                           help="Number of login flows to run at a time")
+    subparser.add_argument('--fxa-latency', type=float, default=0,
+                           help="Number of seconds the fake FxA server takes to respond")
+    subparser.add_argument('--cache-backend',
+                           help="Cache backend to use instead of the INI file's "
+                                "(e.g. kinto.core.cache.postgresql)")
+    subparser.add_argument('--cache-url',
+                           help="URL of the cache backend to use instead of the INI file's")
+
+    subparser = subparsers.add_parser('benchmark-startup',
+                                      help="Measure how long the application takes to start.")
+    subparser.add_argument('--runs', type=int, default=5,
+                           help="Number of times the application is started")
+    subparser.add_argument('--budget-ms', type=float, default=None,
+                           help="Fail if importing kinto_fxa and building the application "
+                                "take longer (in milliseconds)")
 
     opts = parser.parse_args(args)
 
     logging.config.fileConfig(opts.ini_file, disable_existing_loggers=False)
     logger.debug("Using config file %r", opts.ini_file)
+
+    if opts.subcommand == 'simulate-cache':
+        # Simulations don't need the application.
+        from .simulate_cache import simulate_cache
+        admission = {'off': (False,), 'on': (True,), 'both': (False, True)}[opts.admission]
+        simulate_cache(opts.trace_file, sizes=opts.sizes or [0], ttls=opts.ttls or [300],
+                       admission=admission, jitter=opts.jitter, entry_size=opts.entry_size)
+        return 0
+    if opts.subcommand == 'load-test-relier':
+        # The application is built with the fake FxA server.
+        from .load_test_relier import load_test_relier
+        load_test_relier(get_appsettings(opts.ini_file), flows=opts.flows,
+                         concurrency=opts.concurrency, fxa_latency=opts.fxa_latency,
+                         cache_backend=opts.cache_backend, cache_url=opts.cache_url)
+        return 0
+
+    if opts.subcommand == 'benchmark-startup':
+        # The application is started in fresh interpreters.
+        from .benchmark_startup import benchmark_startup
+        result = benchmark_startup(opts.ini_file, runs=opts.runs)
+        elapsed_ms = (result.import_kinto_fxa + result.build_app) * 1000
+        if opts.budget_ms is not None and elapsed_ms > opts.budget_ms:
+            logger.error("Startup took %.1fms, over the budget of %.1fms",
+                         elapsed_ms, opts.budget_ms)
+            return 1
+        return 0
+
     config = bootstrap(opts.ini_file)
 
-    process_account_events(
-        config, opts.queue_name,
-        opts.aws_region, opts.queue_wait_time)
+    if opts.subcommand == 'warm-up-cache':
+        from .warm_up_cache import warm_up_cache
+        warm_up_cache(config, opts.tokens_file, opts.max_workers)
+        return 0
+    if opts.subcommand == 'rebuild-principal-index':
+        from .rebuild_principal_index import rebuild_index
+        rebuild_index(config, batch_size=opts.batch_size)
+        return 0
+    if opts.subcommand == 'purge-accounts':
+        from .purge_accounts import purge_accounts
+        purge_accounts(config, opts.uids_file, batch_size=opts.batch_size,
+                       checkpoint_file=opts.checkpoint)
+        return 0
+
+    from .process_account_events import process_account_events, replay_account_events
+    kwargs = dict(dedup_history_size=opts.dedup_history_size,
+                  dedup_ttl=opts.dedup_ttl,
+                  max_attempts=opts.max_attempts,
+                  retry_backoff=opts.retry_backoff,
+                  drain_timeout=opts.drain_timeout,
+                  metrics_port=opts.metrics_port)
+    if opts.subcommand == 'replay-account-events':
+        replay_account_events(config, opts.events_file,
+                              dead_letter_file=opts.dead_letter_file, **kwargs)
+    else:
+        process_account_events(
+            config, opts.queue_name,
+            opts.aws_region, opts.queue_wait_time,
+            visibility_timeout=opts.visibility_timeout,
+            dead_letter_queue_name=opts.dead_letter_queue,
+            **kwargs)
     return 0
 
 
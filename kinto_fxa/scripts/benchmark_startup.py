@@ -0,0 +1,55 @@
+"""Script to measure how long a Kinto process with kinto-fxa takes to start.
+
+Every run starts a fresh Python interpreter, which imports *Kinto*, then
+``kinto_fxa``, and builds the application of the INI file (including the
+setup of the FxA authentication policies). The median duration of each of
+these steps is reported, in order to keep the cold start of new processes
+within a budget.
+
+"""
+import collections
+import json
+import logging
+import statistics
+import subprocess
+import sys
+
+logger = logging.getLogger(__name__)
+
+STEPS = ('import_kinto', 'import_kinto_fxa', 'build_app')
+
+StartupResult = collections.namedtuple('StartupResult', STEPS)
+
+_RUN = """
+import json, time
+start = time.perf_counter()
+import kinto, kinto.core.initialization
+imported_kinto = time.perf_counter()
+import kinto_fxa
+imported_kinto_fxa = time.perf_counter()
+from pyramid.paster import get_app
+get_app({ini_file!r})
+built = time.perf_counter()
+print(json.dumps([imported_kinto - start, imported_kinto_fxa - imported_kinto,
+                  built - imported_kinto_fxa]))
+"""
+
+
+def measure_startup(ini_file):
+    """Start the application of ``ini_file`` in a fresh interpreter, and return
+    the durations of its startup steps, in seconds.
+    """
+    output = subprocess.check_output([sys.executable, '-c', _RUN.format(ini_file=ini_file)])
+    # Only the last line, in case the application prints something.
+    return StartupResult(*json.loads(output.decode('utf-8').splitlines()[-1]))
+
+
+def benchmark_startup(ini_file, runs=5):
+    """Measure the startup of the application of ``ini_file`` ``runs`` times,
+    log the median durations of its steps, and return them.
+    """
+    results = [measure_startup(ini_file) for _ in range(runs)]
+    medians = StartupResult(*(statistics.median(durations) for durations in zip(*results)))
+    for step in STEPS:
+        logger.info("%s: %.1fms", step, getattr(medians, step) * 1000)
+    return medians
@@ -0,0 +1,242 @@
+"""Sources of account events.
+
+The account events consumer only relies on the subset of the ``boto3`` SQS
+``Queue`` API that it uses: ``receive_messages()``, ``delete_messages()``,
+``change_message_visibility_batch()`` and ``attributes``, with messages that
+have a ``body``, a ``message_id``, a ``receipt_handle``, ``attributes``,
+``delete()`` and ``change_visibility()``.
+
+- :class:`SQSQueue` implements it for Amazon SQS, on top of the thread-safe
+  low-level ``boto3`` client (``boto3`` resources must not be shared between
+  threads, whereas the long poll and the visibility heartbeat run in their own);
+- :class:`MemoryQueue` implements it in memory, to feed events from the
+  process itself (e.g. in tests);
+- :class:`JSONLinesQueue` reads events from a file with one event per line,
+  to replay a backlog of events at disk speed, without SQS round trips.
+
+Queues that won't receive any more message are ``exhausted``.
+"""
+import hashlib
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class SQSMessage(object):
+    """A message received from a :class:`SQSQueue`."""
+    def __init__(self, queue, message):
+        self.queue = queue
+        self.message_id = message['MessageId']
+        self.body = message['Body']
+        self.receipt_handle = message['ReceiptHandle']
+        self.attributes = message.get('Attributes', {})
+
+    def delete(self):
+        self.queue.client.delete_message(QueueUrl=self.queue.url,
+                                         ReceiptHandle=self.receipt_handle)
+
+    def change_visibility(self, VisibilityTimeout):
+        self.queue.client.change_message_visibility(QueueUrl=self.queue.url,
+                                                    ReceiptHandle=self.receipt_handle,
+                                                    VisibilityTimeout=VisibilityTimeout)
+
+
+class SQSQueue(object):
+    """Amazon SQS queue, accessed with the low-level ``boto3`` client."""
+    def __init__(self, client, url):
+        self.client = client
+        self.url = url
+        self._attributes = None
+
+    @classmethod
+    def from_resource(cls, queue):
+        """Wrap a ``boto3`` SQS ``Queue`` resource."""
+        return cls(queue.meta.client, queue.url)
+
+    @property
+    def attributes(self):
+        if self._attributes is None:
+            response = self.client.get_queue_attributes(QueueUrl=self.url,
+                                                        AttributeNames=['All'])
+            self._attributes = response.get('Attributes', {})
+        return self._attributes
+
+    def send_message(self, **kwargs):
+        return self.client.send_message(QueueUrl=self.url, **kwargs)
+
+    def receive_messages(self, **kwargs):
+        response = self.client.receive_message(QueueUrl=self.url, **kwargs)
+        return [SQSMessage(self, message) for message in response.get('Messages', [])]
+
+    def delete_messages(self, Entries):
+        return self.client.delete_message_batch(QueueUrl=self.url, Entries=Entries)
+
+    def change_message_visibility_batch(self, Entries):
+        return self.client.change_message_visibility_batch(QueueUrl=self.url, Entries=Entries)
+
+
+class MemoryMessage(object):
+    """A message received from a :class:`MemoryQueue`."""
+    def __init__(self, queue, message_id, body, receive_count):
+        self.queue = queue
+        self.message_id = message_id
+        self.body = body
+        self.receipt_handle = '{}#{}'.format(message_id, receive_count)
+        self.attributes = {'ApproximateReceiveCount': str(receive_count)}
+
+    def delete(self):
+        self.queue.delete_messages(Entries=[{'Id': '0', 'ReceiptHandle': self.receipt_handle}])
+
+    def change_visibility(self, VisibilityTimeout):
+        self.queue.change_message_visibility_batch(Entries=[{
+            'Id': '0',
+            'ReceiptHandle': self.receipt_handle,
+            'VisibilityTimeout': VisibilityTimeout,
+        }])
+
+
+class MemoryQueue(object):
+    """In-memory queue, with the delivery semantics of SQS.
+
+    Received messages are hidden for the visibility timeout of the queue (or
+    of the receive call), and delivered again unless they are deleted in the
+    meantime. Once closed, the queue is exhausted when all its messages were
+    deleted.
+    """
+    def __init__(self, visibility_timeout=30, clock=time.monotonic):
+        self.attributes = {'VisibilityTimeout': str(visibility_timeout)}
+        self.clock = clock
+        self.closed = False
+        self._messages = OrderedDict()  # message_id -> [body, receive count, visible at]
+        self._ids = itertools.count(1)
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return len(self._messages)
+
+    @property
+    def exhausted(self):
+        return self.closed and not self._messages
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def send_message(self, MessageBody, MessageId=None, **kwargs):
+        message_id = MessageId or str(next(self._ids))
+        with self._condition:
+            self._messages[message_id] = [MessageBody, 0, 0]
+            self._condition.notify()
+        return {'MessageId': message_id}
+
+    def _receive(self, max_messages, visibility_timeout):
+        now = self.clock()
+        received = []
+        for message_id, entry in self._messages.items():
+            body, count, visible_at = entry
+            if visible_at <= now:
+                entry[1:] = [count + 1, now + visibility_timeout]
+                received.append(MemoryMessage(self, message_id, body, count + 1))
+                if len(received) == max_messages:
+                    break
+        return received
+
+    def receive_messages(self, MaxNumberOfMessages=1, WaitTimeSeconds=0,
+                         VisibilityTimeout=None, **kwargs):
+        if VisibilityTimeout is None:
+            VisibilityTimeout = int(self.attributes['VisibilityTimeout'])
+        deadline = self.clock() + WaitTimeSeconds
+        with self._condition:
+            while True:
+                received = self._receive(MaxNumberOfMessages, VisibilityTimeout)
+                now = self.clock()
+                if received or now >= deadline or self.exhausted:
+                    return received
+                next_visible = min((entry[2] for entry in self._messages.values()),
+                                   default=deadline)
+                self._condition.wait(min(deadline, next_visible) - now)
+
+    def _batch(self, entries, action):
+        response = {'Successful': [], 'Failed': []}
+        with self._condition:
+            for entry in entries:
+                message_id = entry['ReceiptHandle'].rsplit('#', 1)[0]
+                if message_id in self._messages:
+                    action(message_id, entry)
+                    response['Successful'].append({'Id': entry['Id']})
+                else:
+                    response['Failed'].append({'Id': entry['Id'],
+                                               'Code': 'ReceiptHandleIsInvalid',
+                                               'Message': 'Unknown message',
+                                               'SenderFault': True})
+            self._condition.notify_all()
+        return response
+
+    def delete_messages(self, Entries):
+        def delete(message_id, entry):
+            del self._messages[message_id]
+        return self._batch(Entries, delete)
+
+    def change_message_visibility_batch(self, Entries):
+        def change_visibility(message_id, entry):
+            self._messages[message_id][2] = self.clock() + entry['VisibilityTimeout']
+        return self._batch(Entries, change_visibility)
+
+
+class JSONLinesQueue(MemoryQueue):
+    """Queue of the events read from a file, with one JSON event per line.
+
+    Lines can either be SQS message bodies, or bare events (e.g.
+    ``{"event": "delete", "uid": "..."}``), which are wrapped in a message
+    body. Message IDs are derived from the content of the lines.
+
+    The file is read lazily, keeping at most ``buffer_size`` messages in
+    memory. The queue is exhausted once the file was read and all its
+    messages were deleted.
+    """
+    def __init__(self, fileobj, buffer_size=1000, **kwargs):
+        super().__init__(**kwargs)
+        self.fileobj = fileobj
+        self.buffer_size = buffer_size
+
+    def _fill(self):
+        while not self.closed and len(self._messages) < self.buffer_size:
+            line = self.fileobj.readline()
+            if not line:
+                self.close()
+                break
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                is_event = 'Message' not in json.loads(line)
+            except (ValueError, TypeError):
+                is_event = False  # Let the consumer handle junk.
+            body = json.dumps({'Message': line}) if is_event else line
+            message_id = hashlib.sha1(body.encode('utf-8')).hexdigest()
+            self.send_message(MessageBody=body, MessageId=message_id)
+
+    def receive_messages(self, **kwargs):
+        with self._condition:
+            self._fill()
+        return super().receive_messages(**kwargs)
+
+
+class JSONLinesWriter(object):
+    """Write the body of sent messages to a file, one per line.
+
+    Can be used as a dead-letter queue, whose content can be replayed with a
+    :class:`JSONLinesQueue`.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self._lock = threading.Lock()
+
+    def send_message(self, MessageBody, **kwargs):
+        with self._lock:
+            self.fileobj.write(MessageBody + '\n')
+            self.fileobj.flush()
+        return {}
@@ -0,0 +1,172 @@
+"""Script to load test the OAuth relier flow of a Kinto application.
+
+A relier flow goes through three steps:
+
+1. ``GET /fxa-oauth/login?redirect=...``, which persists a random state in the
+   cache backend, and redirects to the FxA authorization form;
+2. the user signs in on FxA, which grants an authorization code;
+3. ``GET /fxa-oauth/token?code=...&state=...``, which reads and deletes the
+   state from the cache backend, and trades the code for a token on FxA.
+
+This script builds the application of the INI file, with
+:class:`kinto_fxa.testing.FakeFxAServer` as FxA server (and optionally another
+cache backend), and runs flows through it concurrently, in process. It reports
+the number of flows per second, the latency of each step, and the number of
+cache operations, to size the capacity of the relier.
+
+"""
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlparse
+
+import kinto
+import requests
+from kinto.authorization import RouteFactory
+from pyramid.config import Configurator
+from pyramid.request import Request
+
+from kinto_fxa.testing import FakeFxAServer
+
+logger = logging.getLogger(__name__)
+
+STEPS = ('login', 'authorization', 'token')
+CACHE_OPERATIONS = ('get', 'set', 'delete')
+
+LoadTestResult = collections.namedtuple('LoadTestResult', [
+    'flows', 'failures', 'flows_per_second', 'latencies', 'cache_operations'])
+
+StepLatency = collections.namedtuple('StepLatency', ['mean', 'p50', 'p95', 'p99'])
+
+
+def _override(settings, key, value):
+    """Set ``key``, whether the INI file defines it with the ``kinto.`` prefix or not."""
+    settings.pop('kinto.' + key, None)
+    settings[key] = value
+
+
+def _summarize(samples):
+    samples = sorted(samples)
+    if not samples:
+        return StepLatency(0, 0, 0, 0)
+
+    def percentile(percent):
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+    return StepLatency(mean=sum(samples) / len(samples),
+                       p50=percentile(50), p95=percentile(95), p99=percentile(99))
+
+
+def count_cache_operations(cache):
+    """Count the calls to the ``get()``, ``set()`` and ``delete()`` methods of
+    ``cache``, and return the counter.
+    """
+    counter = collections.Counter()
+    lock = threading.Lock()
+
+    def counted(name, method):
+        def wrapped(*args, **kwargs):
+            with lock:
+                counter[name] += 1
+            return method(*args, **kwargs)
+        return wrapped
+
+    for name in CACHE_OPERATIONS:
+        setattr(cache, name, counted(name, getattr(cache, name)))
+    return counter
+
+
+def build_app(settings, oauth_uri, redirect, cache_backend=None, cache_url=None):
+    """Build the Kinto application of ``settings``, with ``oauth_uri`` as FxA
+    server, and ``redirect`` as authorized relier URL.
+    """
+    settings = dict(settings)
+    _override(settings, 'fxa-oauth.oauth_uri', oauth_uri)
+    _override(settings, 'fxa-oauth.relier.enabled', 'true')
+    _override(settings, 'fxa-oauth.webapp.authorized_domains', urlparse(redirect).netloc)
+    for key in ('fxa-oauth.client_id', 'fxa-oauth.client_secret'):
+        if not settings.get(key) and not settings.get('kinto.' + key):
+            settings[key] = 'load-test'
+    if cache_backend:
+        _override(settings, 'cache_backend', cache_backend)
+    if cache_url:
+        _override(settings, 'cache_url', cache_url)
+
+    config = Configurator(settings=settings, root_factory=RouteFactory)
+    app = kinto.main({}, config=config)
+    return app, config.registry
+
+
+def run_flow(app, prefix, redirect, latencies):
+    """Go through the relier flow once, and record the latency of every step."""
+    start = time.perf_counter()
+    query = urlencode({'redirect': redirect})
+    response = Request.blank('{}/fxa-oauth/login?{}'.format(prefix, query)).get_response(app)
+    if response.status_code != 302:
+        raise ValueError('Login failed with {}'.format(response.status))
+    latencies['login'].append(time.perf_counter() - start)
+
+    # The user signs in on the FxA authorization form.
+    start = time.perf_counter()
+    response = requests.get(response.location)
+    response.raise_for_status()
+    grant = response.json()
+    latencies['authorization'].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    query = urlencode({'code': grant['code'], 'state': grant['state']})
+    response = Request.blank('{}/fxa-oauth/token?{}'.format(prefix, query)).get_response(app)
+    if response.status_code != 302 or not response.location.startswith(redirect):
+        raise ValueError('Token failed with {}'.format(response.status))
+    latencies['token'].append(time.perf_counter() - start)
+
+
+def load_test_relier(settings, flows=1000, concurrency=8, fxa_latency=0,
+                     cache_backend=None, cache_url=None):
+    """Run ``flows`` relier flows, ``concurrency`` at a time, against the
+    application of ``settings``, and log the results.
+    """
+    redirect = 'https://relier.example.com/#token='
+    latencies = {step: [] for step in STEPS}
+    failures = collections.Counter()
+
+    with FakeFxAServer(latency=fxa_latency) as fxa_server:
+        app, registry = build_app(settings, fxa_server.url, redirect,
+                                  cache_backend=cache_backend, cache_url=cache_url)
+        cache_operations = count_cache_operations(registry.cache)
+        prefix = '/{}'.format(registry.route_prefix)
+
+        def flow(_):
+            try:
+                run_flow(app, prefix, redirect, latencies)
+            except Exception as e:
+                logger.debug("Flow failed", exc_info=True)
+                failures[type(e).__name__] += 1
+
+        logger.info("Running %s flows, %s at a time", flows, concurrency)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(flow, range(flows)))
+        elapsed = time.perf_counter() - start
+
+    completed = flows - sum(failures.values())
+    result = LoadTestResult(
+        flows=completed, failures=dict(failures),
+        flows_per_second=completed / elapsed if elapsed else 0,
+        latencies={step: _summarize(samples) for step, samples in latencies.items()},
+        cache_operations={name: cache_operations[name] for name in CACHE_OPERATIONS})
+
+    logger.info("%s flows completed (%.1f flows/s), %s failed %s",
+                result.flows, result.flows_per_second, sum(failures.values()),
+                result.failures or '')
+    for step in STEPS:
+        latency = result.latencies[step]
+        logger.info("%s: mean %.1fms, p50 %.1fms, p95 %.1fms, p99 %.1fms", step,
+                    latency.mean * 1000, latency.p50 * 1000, latency.p95 * 1000,
+                    latency.p99 * 1000)
+    logger.info("Cache operations: %s",
+                ', '.join('{} {}'.format(name, count)
+                          for name, count in result.cache_operations.items()))
+    return result
@@ -0,0 +1,126 @@
+"""Metrics of the account events consumer.
+
+:class:`ConsumerMetrics` has the same ``count()`` and ``timer()`` methods as
+the *Kinto* StatsD client, to which it forwards them, if any. Metrics are
+also aggregated in memory, and can be served in the Prometheus text format on
+a local HTTP endpoint with :func:`serve_metrics`, for example to scale
+consumers on the age of the backlog.
+"""
+import functools
+import logging
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Timer(object):
+    """Time a block or a function, as a context manager or a decorator."""
+    def __init__(self, metrics, key):
+        self.metrics = metrics
+        self.key = key
+
+    def __enter__(self):
+        self._start = self.metrics.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.timing(self.key, self.metrics.clock() - self._start)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapped
+
+
+class ConsumerMetrics(object):
+    """Record counters, gauges and timings, and forward them to StatsD.
+
+    Gauges are only kept in memory, since the *Kinto* StatsD client does not
+    support them.
+    """
+    def __init__(self, statsd=None, clock=time.perf_counter):
+        self.statsd = statsd
+        self.clock = clock
+        self._counters = {}
+        self._gauges = {}
+        self._timings = {}  # key -> [count, sum of seconds]
+        self._lock = threading.Lock()
+
+    def count(self, key, *args, **kwargs):
+        value = args[0] if args else kwargs.get('count', 1)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        if self.statsd:
+            self.statsd.count(key, *args, **kwargs)
+
+    def gauge(self, key, value):
+        with self._lock:
+            self._gauges[key] = value
+
+    def timing(self, key, seconds):
+        with self._lock:
+            summary = self._timings.setdefault(key, [0, 0.0])
+            summary[0] += 1
+            summary[1] += seconds
+        if self.statsd:
+            timer = self.statsd.timer(key)
+            timer.ms = seconds * 1000
+            timer.send()
+
+    def timer(self, key):
+        return _Timer(self, key)
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        def name(key):
+            return key.replace('.', '_').replace('-', '_')
+
+        lines = []
+        with self._lock:
+            for key, value in sorted(self._counters.items()):
+                lines += ['# TYPE {}_total counter'.format(name(key)),
+                          '{}_total {}'.format(name(key), value)]
+            for key, value in sorted(self._gauges.items()):
+                lines += ['# TYPE {} gauge'.format(name(key)),
+                          '{} {}'.format(name(key), value)]
+            for key, (count, total) in sorted(self._timings.items()):
+                lines += ['# TYPE {}_seconds summary'.format(name(key)),
+                          '{}_seconds_count {}'.format(name(key), count),
+                          '{}_seconds_sum {}'.format(name(key), total)]
+        return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(metrics, port, host='127.0.0.1'):
+    """Serve ``GET /metrics`` in a background thread.
+
+    Returns the HTTP server, to be closed with ``shutdown()``.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    server = _ThreadingHTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    logger.info("Serving metrics on http://%s:%s/metrics", host, server.server_port)
+    return server
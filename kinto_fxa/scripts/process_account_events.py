@@ -3,8 +3,9 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 """Script to process account-related events from an SQS queue.
 
-This script polls an SQS queue for events indicating activity on an upstream
-account, as documented here:
+This script polls an SQS queue (or replays a file, see
+:mod:`kinto_fxa.scripts.event_sources`) for events indicating activity on an
+upstream account, as documented here:
 
   https://github.com/mozilla/fxa-auth-server/blob/master/docs/service_notifications.md
 
@@ -13,46 +14,447 @@ The following event types are currently supported:
   * "delete": the account was deleted; we delete their default bucket
     to comply with GDPR. Note that this won't be sufficient in
     applications where users can store data in locations besides the
-    default bucket.
+    default bucket, unless the principal index is enabled (see
+    :mod:`kinto_fxa.principal_index`). The cached verifications of their
+    tokens are invalidated too.
+
+  * "passwordChange" and "passwordReset": the tokens of the account may have
+    been revoked; we invalidate the cached verifications of their tokens, so
+    that they are verified again on their next use.
+
+While messages are being processed, their visibility timeout is extended in
+the background, so that long deletions are not delivered to another consumer
+in the meantime.
+
+Events that fail to be processed are retried with an exponential backoff,
+by changing the visibility of their message. After a number of attempts, they
+are forwarded to a dead-letter queue, if any, so that one bad event does not
+stop the pipeline.
+
+On SIGTERM or SIGINT, the consumer stops polling, finishes the events being
+processed within a drain timeout, deletes the processed messages and makes
+the others visible again before exiting.
+
+SQS delivers messages at least once. Events that were already processed
+(same message ID, or deletion of the same user ID) are acknowledged without
+touching the storage again.
 
 Note that this script may not be necessary in all applications of
 kinto-fxa.
 
 """
 
+import contextlib
+import hashlib
+import hmac
 import itertools
 import json
 import logging
-import re
-import uuid
+import signal
+import threading
+import time
+from collections import OrderedDict
 
 import boto3
 from ec2_metadata import ec2_metadata
-from kinto.core.utils import hmac_digest
 import transaction as current_transaction
+from kinto.core.storage import Filter
+from kinto.core.utils import COMPARISON
+
+from kinto_fxa.authentication import TokenVerificationCache
+from kinto_fxa.principal_index import purge_principals
+from kinto_fxa.utils import get_userid_variants
+
+from .event_sources import JSONLinesQueue, JSONLinesWriter, MemoryQueue, SQSQueue
+from .metrics import ConsumerMetrics, serve_metrics
 
 logger = logging.getLogger(__name__)
 
+#: Maximum number of messages per batch allowed by SQS.
+BATCH_SIZE = 10
+
+#: Account events after which the cached verifications of the user's tokens
+#: are invalidated.
+TOKEN_INVALIDATION_EVENTS = ('delete', 'passwordChange', 'passwordReset')
+
+
+@contextlib.contextmanager
+def _untimed():
+    yield
+
+
+def _timer(metrics, key):
+    """Time a phase of the event processing, if the consumer records metrics."""
+    return metrics.timer(key) if metrics is not None else _untimed()
+
 
 def get_default_bucket_id(config, uid):
+    return get_default_bucket_ids(config, [uid])[0]
+
+
+def get_default_bucket_ids(config, userids):
+    """Return the default bucket IDs of ``userids``, in the same order.
+
+    This is the same derivation as ``kinto.plugins.default_bucket``, with the
+    HMAC key prepared only once for all user IDs.
+    """
     secret = config['registry'].settings['userid_hmac_secret']
-    digest = hmac_digest(secret, uid)
-    return str(uuid.UUID(digest[:32]))
+    if isinstance(secret, str):
+        secret = secret.encode('utf-8')
+    prepared = hmac.new(secret, digestmod=hashlib.sha256)
+    bucket_ids = []
+    for userid in userids:
+        h = prepared.copy()
+        h.update(userid.encode('utf-8'))
+        digest = h.hexdigest()
+        # Same as str(uuid.UUID(digest[:32])), without the intermediate object.
+        bucket_ids.append('{}-{}-{}-{}-{}'.format(digest[:8], digest[8:12], digest[12:16],
+                                                  digest[16:20], digest[20:32]))
+    return bucket_ids
+
+
+class EventDeduplicator(object):
+    """Remember the account events that were processed, to skip duplicates.
+
+    Events are identified by their message ID, and deletions by their user ID
+    too, since an account is only deleted once. The most recent ones are kept
+    in a bounded history. If a cache backend is given, they are also recorded
+    there for ``ttl`` seconds, so that they are shared between consumers and
+    survive restarts.
+    """
+    cache_prefix = 'fxa-account-events:'
+
+    def __init__(self, history_size=10000, cache=None, ttl=3600):
+        self.history_size = history_size
+        self.cache = cache
+        self.ttl = ttl
+        self._history = OrderedDict()
+
+    def keys(self, message_id, body):
+        keys = ['message:{}'.format(message_id)]
+        try:
+            event_type, uid = parse_account_event(body)
+        except (ValueError, KeyError):
+            pass
+        else:
+            if event_type == 'delete':
+                keys.append('event:{}:{}'.format(event_type, uid))
+        return keys
+
+    def seen(self, keys):
+        for key in keys:
+            if key in self._history:
+                self._history.move_to_end(key)
+                return True
+        if self.cache is not None:
+            try:
+                return any(self.cache.get(self.cache_prefix + key) for key in keys)
+            except Exception:
+                logger.exception("Error while fetching processed events from cache")
+        return False
+
+    def remember(self, keys):
+        for key in keys:
+            self._history[key] = True
+            self._history.move_to_end(key)
+        while len(self._history) > self.history_size:
+            self._history.popitem(last=False)
+        if self.cache is not None:
+            try:
+                for key in keys:
+                    self.cache.set(self.cache_prefix + key, True, self.ttl)
+            except Exception:
+                logger.exception("Error while storing processed events in cache")
+
+
+class VisibilityHeartbeat(object):
+    """Extend the visibility timeout of in-flight messages in the background.
+
+    Every ``visibility_timeout / 2`` seconds, the visibility of tracked messages
+    is reset to ``visibility_timeout``, in batches. Messages whose visibility
+    could not be extended are abandoned: they may be delivered again.
+
+    Batches are sent while holding the lock, with the messages that are still
+    tracked: once :meth:`untrack` returns, the visibility of the message won't
+    be extended anymore, and can be changed safely (e.g. for a retry backoff).
+    """
+    batch_size = BATCH_SIZE
+
+    def __init__(self, queue, visibility_timeout, statsd=None):
+        self.queue = queue
+        self.visibility_timeout = visibility_timeout
+        self.interval = max(1, visibility_timeout / 2)
+        self.statsd = statsd
+        self._in_flight = OrderedDict()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='visibility-heartbeat',
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def track(self, messages):
+        with self._lock:
+            for msg in messages:
+                self._in_flight[msg.message_id] = msg
+
+    def untrack(self, msg):
+        with self._lock:
+            self._in_flight.pop(msg.message_id, None)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.extend()
+
+    def extend(self):
+        """Extend the visibility of every tracked message."""
+        with self._lock:
+            message_ids = list(self._in_flight)
+
+        for start in range(0, len(message_ids), self.batch_size):
+            with self._lock:
+                self._extend(message_ids[start:start + self.batch_size])
+
+    def _extend(self, message_ids):
+        # Messages untracked since the beginning of the round are skipped.
+        messages = [self._in_flight[message_id] for message_id in message_ids
+                    if message_id in self._in_flight]
+        if not messages:
+            return
+        batch = dict(enumerate(messages))
+        entries = [{'Id': str(i),
+                    'ReceiptHandle': msg.receipt_handle,
+                    'VisibilityTimeout': self.visibility_timeout}
+                   for i, msg in batch.items()]
+        try:
+            response = self.queue.change_message_visibility_batch(Entries=entries)
+        except Exception:
+            logger.exception("Error while extending visibility of messages")
+            return
+
+        failed = response.get('Failed', [])
+        for failure in failed:
+            msg = batch[int(failure['Id'])]
+            logger.warning("Could not extend visibility of %r: %s",
+                           msg.message_id, failure.get('Message'))
+            self._in_flight.pop(msg.message_id, None)
+        if self.statsd:
+            extended = len(response.get('Successful', []))
+            self.statsd.count("process_account_event.visibility_extended", extended)
+            if failed:
+                self.statsd.count("process_account_event.abandoned", len(failed))
+
+
+class GracefulShutdown(object):
+    """Request a cooperative shutdown of the consumer on signals.
+
+    Once requested, the consumer has ``drain_timeout`` seconds to finish the
+    events being processed. A second signal triggers the previous handler
+    (e.g. ``KeyboardInterrupt`` on SIGINT).
+    """
+    def __init__(self, drain_timeout=30, signals=(signal.SIGTERM, signal.SIGINT),
+                 clock=time.monotonic):
+        self.drain_timeout = drain_timeout
+        self.signals = signals
+        self.clock = clock
+        self.deadline = None
+        self._previous = {}
+
+    @property
+    def requested(self):
+        return self.deadline is not None
+
+    @property
+    def expired(self):
+        return self.requested and self.clock() >= self.deadline
+
+    def install(self):
+        # Signal handlers can only be installed from the main thread.
+        if threading.current_thread() is not threading.main_thread():
+            return
+        for signum in self.signals:
+            self._previous[signum] = signal.signal(signum, self.request)
+
+    def restore(self):
+        for signum, handler in self._previous.items():
+            signal.signal(signum, handler)
+        self._previous.clear()
+
+    def request(self, signum=None, frame=None):
+        if self.requested:
+            return
+        logger.info("Shutting down, draining events for at most %s seconds",
+                    self.drain_timeout)
+        self.deadline = self.clock() + self.drain_timeout
+        self.restore()
+
+
+def release_messages(queue, msgs):
+    """Make messages visible again right away, for other consumers."""
+    for start in range(0, len(msgs), BATCH_SIZE):
+        batch = msgs[start:start + BATCH_SIZE]
+        entries = [{'Id': str(i), 'ReceiptHandle': msg.receipt_handle, 'VisibilityTimeout': 0}
+                   for i, msg in enumerate(batch)]
+        try:
+            queue.change_message_visibility_batch(Entries=entries)
+        except Exception:
+            logger.exception("Error while releasing messages")
+
+
+def receive_messages(queue, shutdown, poll_interval=0.5, **kwargs):
+    """Receive messages, unless a shutdown is requested during the long poll.
+
+    The long poll runs in a daemon thread, so that an abandoned poll does not
+    delay the exit of the process. Messages it receives afterwards are released.
+    """
+    lock = threading.Lock()
+    done = threading.Event()
+    outcome = {}
+
+    def poll():
+        try:
+            result = queue.receive_messages(**kwargs)
+        except Exception as e:
+            result = e
+        with lock:
+            if outcome.get('abandoned'):
+                if not isinstance(result, Exception):
+                    release_messages(queue, result)
+                return
+            outcome['result'] = result
+            done.set()
+
+    threading.Thread(target=poll, name='receive', daemon=True).start()
+    while not done.wait(poll_interval):
+        if shutdown.requested:
+            with lock:
+                if not done.is_set():
+                    outcome['abandoned'] = True
+                    return []
+    if isinstance(outcome['result'], Exception):
+        raise outcome['result']
+    return outcome['result']
+
+
+#: Longest visibility timeout allowed by SQS (12 hours).
+MAX_VISIBILITY_TIMEOUT = 43200
+
+
+def queue_lag(msg, now):
+    """Return the number of seconds since the message was sent, if known."""
+    try:
+        return max(0, now - int(msg.attributes['SentTimestamp']) / 1000)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def receive_count(msg):
+    """Return the number of times the message was received, including this one."""
+    try:
+        return int(msg.attributes['ApproximateReceiveCount'])
+    except (KeyError, TypeError, ValueError):
+        return 1
+
+
+def dead_letter(dead_letter_queue, msg, error, statsd=None):
+    """Forward the message to the dead-letter queue, and delete it.
+
+    If that fails, the message is left to be delivered again.
+    """
+    attempts = receive_count(msg)
+    logger.error("Forwarding account event %r to dead-letter queue after %s attempt(s)",
+                 msg.message_id, attempts)
+    try:
+        dead_letter_queue.send_message(MessageBody=msg.body, MessageAttributes={
+            'Error': {'DataType': 'String', 'StringValue': repr(error)[:256]},
+            'ReceiveCount': {'DataType': 'Number', 'StringValue': str(attempts)},
+        })
+        msg.delete()
+    except Exception:
+        logger.exception("Could not forward account event %r to dead-letter queue",
+                         msg.message_id)
+        return
+    if statsd:
+        statsd.count("process_account_event.dead_lettered")
+
+
+def retry_or_dead_letter(msg, error, max_attempts, retry_backoff,
+                         dead_letter_queue=None, statsd=None):
+    """Handle a message that could not be processed.
+
+    The message is made visible again after an exponential backoff, until it
+    was received ``max_attempts`` times. It is then forwarded to the
+    ``dead_letter_queue``. Without dead-letter queue, it is left to the
+    redrive policy of the queue, and retried with the longest backoff.
+    """
+    attempts = receive_count(msg)
+    if attempts >= max_attempts and dead_letter_queue is not None:
+        dead_letter(dead_letter_queue, msg, error, statsd=statsd)
+        return
+
+    backoff = min(retry_backoff * 2 ** (min(attempts, max_attempts) - 1),
+                  MAX_VISIBILITY_TIMEOUT)
+    logger.warning("Retrying account event %r in %s seconds (attempt %s)",
+                   msg.message_id, backoff, attempts)
+    try:
+        msg.change_visibility(VisibilityTimeout=backoff)
+    except Exception:
+        # It will be delivered again once its visibility timeout expires.
+        logger.exception("Could not delay the retry of account event %r", msg.message_id)
+        return
+    if statsd:
+        statsd.count("process_account_event.retried")
+
+
+#: Longest delay before reaching the queue again after errors, in seconds.
+MAX_ERROR_BACKOFF = 60
+
+
+def back_off(shutdown, errors, base=1, maximum=MAX_ERROR_BACKOFF, step=0.5):
+    """Wait before reaching the queue again, after ``errors`` consecutive errors.
+
+    The delay doubles with each error, up to ``maximum`` seconds, and is cut
+    short if a shutdown is requested.
+    """
+    deadline = time.monotonic() + min(maximum, base * 2 ** (errors - 1))
+    while not shutdown.requested:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(step, remaining))
+
+
+def delete_messages(queue, msgs):
+    """Delete the processed messages from the queue, in one batch."""
+    if not msgs:
+        return
+    entries = [{'Id': str(i), 'ReceiptHandle': msg.receipt_handle}
+               for i, msg in enumerate(msgs)]
+    response = queue.delete_messages(Entries=entries)
+    for failure in response.get('Failed', []):
+        # They will be delivered again, and skipped as duplicates.
+        logger.warning("Could not delete account event %r: %s",
+                       msgs[int(failure['Id'])].message_id, failure.get('Message'))
 
 
 def process_account_events(config, queue_name, aws_region=None,
-                           queue_wait_time=20):
+                           queue_wait_time=20, dead_letter_queue_name=None, **kwargs):
     """Process account events from an SQS queue.
 
     This function polls the specified SQS queue for account-related events,
     processing each as it is found.  It polls indefinitely and does not return;
     to interrupt execution you'll need to e.g. SIGINT the process.
+
+    Events that can't be processed are eventually sent to the
+    ``dead_letter_queue_name`` queue. See :func:`consume_account_events` for
+    the other options.
     """
     logger.info("Processing account events from %s", queue_name)
-    statsd = getattr(config['registry'], 'statsd', None)
-    process_one = process_account_event
-    if statsd:
-        process_one = statsd.timer("process_account_event")(process_one)
     try:
         # Connect to the SQS queue.
         # If no region is given, infer it from the instance metadata.
@@ -62,39 +464,302 @@ def process_account_events(config, queue_name, aws_region=None,
 
         logger.debug("Connecting to queue %r in %r", queue_name, aws_region)
         sqs = boto3.resource('sqs', region_name=aws_region)
-        queue = sqs.get_queue_by_name(QueueName=queue_name)
+        queue = SQSQueue.from_resource(sqs.get_queue_by_name(QueueName=queue_name))
+        dead_letter_queue = None
+        if dead_letter_queue_name:
+            dead_letter_queue = SQSQueue.from_resource(
+                sqs.get_queue_by_name(QueueName=dead_letter_queue_name))
+    except Exception:
+        logger.exception("Error while processing account events")
+        raise
+
+    consume_account_events(config, queue, dead_letter_queue=dead_letter_queue,
+                           queue_wait_time=queue_wait_time, **kwargs)
+
+
+def replay_account_events(config, events_file, dead_letter_file=None, **kwargs):
+    """Process the account events of a file, with one JSON event per line.
+
+    Events that can't be processed are written to ``dead_letter_file``, if
+    any, and can be replayed later. Returns once every event of the file was
+    handled. See :func:`consume_account_events` for the other options.
+    """
+    logger.info("Replaying account events from %s", getattr(events_file, 'name', events_file))
+    queue = JSONLinesQueue(events_file)
+    dead_letter_queue = MemoryQueue()
+    if dead_letter_file is not None:
+        dead_letter_queue = JSONLinesWriter(dead_letter_file)
+    kwargs.setdefault('queue_wait_time', 1)
+    consume_account_events(config, queue, dead_letter_queue=dead_letter_queue, **kwargs)
+    if dead_letter_file is None and len(dead_letter_queue):
+        logger.error("%s account events could not be processed", len(dead_letter_queue))
 
-        # Poll for messages indefinitely.
+
+def consume_account_events(config, queue, dead_letter_queue=None,
+                           queue_wait_time=20, dedup_history_size=10000,
+                           dedup_ttl=0, visibility_timeout=None,
+                           max_attempts=5, retry_backoff=30, drain_timeout=30,
+                           metrics_port=None):
+    """Process account events from a queue, until it is exhausted or until
+    a shutdown is requested with SIGTERM or SIGINT.
+
+    The queue can be an SQS queue, or one of the sources of
+    :mod:`kinto_fxa.scripts.event_sources`. Messages are received and deleted
+    in batches.
+
+    If ``dedup_ttl`` is set, processed events are also recorded in the cache
+    backend for that many seconds, in addition to the in-memory history of the
+    last ``dedup_history_size`` events.
+
+    Received messages are hidden from other consumers for ``visibility_timeout``
+    seconds (defaults to the queue setting), renewed until they are processed.
+
+    Events that fail are retried after ``retry_backoff`` seconds, doubled on
+    each attempt. After ``max_attempts``, they are sent to the
+    ``dead_letter_queue``. Events that can't be parsed are sent there right
+    away.
+
+    On shutdown, the events that could not be processed within
+    ``drain_timeout`` seconds are released for other consumers.
+
+    Errors while receiving or deleting messages are logged, and the queue is
+    reached again after an exponential backoff.
+
+    Metrics are sent to StatsD if configured, and served on
+    ``http://127.0.0.1:<metrics_port>/metrics`` if ``metrics_port`` is set.
+    """
+    registry = config['registry']
+    statsd = getattr(registry, 'statsd', None)
+    metrics = ConsumerMetrics(statsd=statsd)
+    metrics_server = serve_metrics(metrics, metrics_port) if metrics_port else None
+    deduplicator = EventDeduplicator(history_size=dedup_history_size,
+                                     cache=registry.cache if dedup_ttl else None,
+                                     ttl=dedup_ttl)
+    heartbeat = None
+    shutdown = GracefulShutdown(drain_timeout)
+    shutdown.install()
+    try:
+        receive_kwargs = dict(MaxNumberOfMessages=BATCH_SIZE,
+                              WaitTimeSeconds=queue_wait_time,
+                              AttributeNames=['ApproximateReceiveCount', 'SentTimestamp'])
+        if visibility_timeout is None:
+            visibility_timeout = int(queue.attributes.get('VisibilityTimeout', 30))
+        else:
+            receive_kwargs['VisibilityTimeout'] = visibility_timeout
+        heartbeat = VisibilityHeartbeat(queue, visibility_timeout, statsd=metrics)
+        heartbeat.start()
+
+        # Poll for messages until the queue is exhausted (never for SQS).
         # Use a wacky looping construct that can be mocked in tests.
+        errors = 0
         for x in itertools.count():
-            msgs = queue.receive_messages(WaitTimeSeconds=queue_wait_time)
-            for msg in msgs:
-                process_one(config, msg.body)
+            if shutdown.requested:
+                break
+            try:
+                with metrics.timer("process_account_event.receive"):
+                    msgs = receive_messages(queue, shutdown, **receive_kwargs)
+            except Exception:
+                logger.exception("Error while receiving account events")
+                metrics.count("process_account_event.queue_errors")
+                errors += 1
+                back_off(shutdown, errors)
+                continue
+            if not msgs and getattr(queue, 'exhausted', False):
+                break
+            heartbeat.track(msgs)
+            metrics.count("process_account_event.received", len(msgs))
+            metrics.gauge("process_account_event.batch_fill_ratio", len(msgs) / BATCH_SIZE)
+            lags = [lag for lag in (queue_lag(msg, time.time()) for msg in msgs)
+                    if lag is not None]
+            if lags:
+                metrics.gauge("process_account_event.queue_lag_seconds", max(lags))
+                metrics.timing("process_account_event.queue_lag", max(lags))
+
+            processed = []
+            for i, msg in enumerate(msgs):
+                metrics.gauge("process_account_event.in_flight", len(msgs) - i)
+                if shutdown.expired:
+                    logger.warning("Releasing %s account events after drain timeout",
+                                   len(msgs) - i)
+                    for unprocessed in msgs[i:]:
+                        heartbeat.untrack(unprocessed)
+                    release_messages(queue, msgs[i:])
+                    break
+
+                with metrics.timer("process_account_event.parse"):
+                    keys = deduplicator.keys(msg.message_id, msg.body)
+                if deduplicator.seen(keys):
+                    logger.info("Skipping duplicate account event %r", msg.message_id)
+                    metrics.count("process_account_event.duplicate")
+                    processed.append(msg)
+                    continue
+
+                if dead_letter_queue is not None:
+                    # Isolate junk messages right away, instead of dropping them.
+                    try:
+                        parse_account_event(msg.body)
+                    except (ValueError, KeyError) as e:
+                        heartbeat.untrack(msg)
+                        metrics.count("process_account_event.failed.{}".format(
+                            type(e).__name__))
+                        dead_letter(dead_letter_queue, msg, e, statsd=metrics)
+                        continue
+
+                process_one = process_account_event
+                if statsd:
+                    process_one = statsd.timer("process_account_event")(process_one)
+                try:
+                    process_one(config, msg.body, metrics=metrics)
+                except Exception as e:
+                    logger.exception("Error while processing account event %r",
+                                     msg.message_id)
+                    # Don't commit its changes along with the next event.
+                    current_transaction.abort()
+                    heartbeat.untrack(msg)
+                    metrics.count("process_account_event.failed.{}".format(type(e).__name__))
+                    retry_or_dead_letter(msg, e, max_attempts, retry_backoff,
+                                         dead_letter_queue=dead_letter_queue, statsd=metrics)
+                    continue
+
+                deduplicator.remember(keys)
                 # This intentionally deletes the event even if it was some
                 # unrecognized type.  No point leaving a backlog.
-                msg.delete()
+                processed.append(msg)
+
+            try:
+                delete_messages(queue, processed)
+            except Exception:
+                # They will be delivered again, and skipped as duplicates.
+                logger.exception("Error while deleting account events")
+                metrics.count("process_account_event.queue_errors")
+                errors += 1
+            else:
+                errors = 0
+            for msg in processed:
+                heartbeat.untrack(msg)
+            metrics.gauge("process_account_event.in_flight", 0)
+            if errors:
+                back_off(shutdown, errors)
 
     except Exception:
         logger.exception("Error while processing account events")
         raise
+    finally:
+        shutdown.restore()
+        if heartbeat is not None:
+            heartbeat.stop()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
 
 
-def process_account_event(config, body):
-    """Parse and process a single account event."""
-    registry = config['registry']
-    settings = registry.settings
+def parse_account_event(body):
+    """Return the event type and user ID of an account event message.
+
+    :raises ValueError: if the message is not valid JSON.
+    :raises KeyError: if a field is missing.
+    """
+    # Messages are a string of JSON, which, when parsed, has a
+    # Message field, which is a string of JSON that actually
+    # contains what we want.
+    event = json.loads(body)
+    event = json.loads(event['Message'])
+    return event["event"], event["uid"]
+
+
+def get_account_userids(registry, uids):
+    """Return the user IDs of FxA accounts, for every configured client.
+
+    The clients are the ones of the last configuration reloaded, if any.
+    """
+    prefix, _ = get_userid_variants(registry.settings)
+    suffixes = registry._fxa_oauth_clients.userid_suffixes
+    return [prefix + uid + suffix for uid in uids for suffix in suffixes]
+
+
+def delete_default_buckets(registry, default_bucket_ids, metrics=None):
+    """Delete default buckets, their descendants and their permissions.
+
+    The buckets, and the permissions of the buckets and of their descendants,
+    are deleted with one call for all of them. The descendants are deleted
+    bucket by bucket, with one parent ID pattern per bucket: default bucket
+    IDs are UUIDs, so ``/buckets/<id>*`` can't match another bucket.
+
+    The current transaction is left to be committed by the caller. The
+    durations of the deletions are recorded in ``metrics``, if any.
+    """
+    if not default_bucket_ids:
+        return
     storage = registry.storage
-    permission = registry.permission
+    bucket_uris = ['/buckets/{}'.format(bucket_id) for bucket_id in default_bucket_ids]
+    logger.info('Deleting buckets %r', bucket_uris)
+    with _timer(metrics, "process_account_event.storage.delete_all"):
+        storage.delete_all(
+            parent_id='',
+            collection_id='bucket',
+            filters=[Filter('id', list(default_bucket_ids), COMPARISON.IN)],
+            with_deleted=False,
+        )
+    # This code is similar to that from kinto.views.buckets:on_buckets_deleted.
+    for bucket_uri in bucket_uris:
+        with _timer(metrics, "process_account_event.storage.delete_all"):
+            storage.delete_all(
+                parent_id=bucket_uri + '*',
+                collection_id=None,
+                with_deleted=False,
+            )
+        # Purge tombstones too.
+        with _timer(metrics, "process_account_event.storage.purge_deleted"):
+            storage.purge_deleted(
+                parent_id=bucket_uri + '*',
+                collection_id=None,
+            )
+    with _timer(metrics, "process_account_event.permission.delete_object_permissions"):
+        registry.permission.delete_object_permissions(*[uri + '*' for uri in bucket_uris])
+
 
+def delete_accounts(config, uids, metrics=None):
+    """Delete the data of FxA accounts, for every configured client.
+
+    The default buckets are deleted. If the principal index is enabled, the
+    other objects of the accounts are deleted too, and their permissions on
+    shared objects are revoked.
+
+    The current transaction is left to be committed by the caller. The
+    durations of the deletions are recorded in ``metrics``, if any.
+    """
+    registry = config['registry']
+    with _timer(metrics, "process_account_event.bucket_ids"):
+        userids = get_account_userids(registry, uids)
+        default_bucket_ids = get_default_bucket_ids(config, userids)
+    delete_default_buckets(registry, default_bucket_ids, metrics=metrics)
+
+    if registry._fxa_oauth_settings.principal_index_enabled:
+        for uid in uids:
+            with _timer(metrics, "process_account_event.purge_principals"):
+                purge_principals(registry, get_account_userids(registry, [uid]))
+
+
+def invalidate_tokens(registry, uid, metrics=None):
+    """Invalidate the cached verifications of the tokens of an FxA account."""
+    cache = getattr(registry, 'cache', None)
+    if cache is None:
+        return
+    # The generation must outlive the verifications cached by the applications.
+    ttl = registry._fxa_oauth_settings.cache_ttl_seconds
+    with _timer(metrics, "process_account_event.invalidate_tokens"):
+        TokenVerificationCache(cache, ttl=ttl).invalidate_user(uid)
+    logger.info("Invalidated cached token verifications for %r", uid)
+
+
+def process_account_event(config, body, metrics=None):
+    """Parse and process a single account event.
+
+    The durations of its phases are recorded in ``metrics``, if any.
+    """
     # Try very hard not to error out if there's junk in the queue.
     try:
-        # Messages are a string of JSON, which, when parsed, has a
-        # Message field, which is a string of JSON that actually
-        # contains what we want.
-        event = json.loads(body)
-        event = json.loads(event['Message'])
-        event_type = event["event"]
-        uid = event["uid"]
+        event_type, uid = parse_account_event(body)
     except (ValueError, KeyError) as e:
         logger.exception("Invalid account message: %r", e)
     else:
@@ -102,42 +767,13 @@ def process_account_event(config, body):
             # Delete everything from storage and permissions for
             # this user.
             logger.info("Processing account delete for %r", uid)
-
-            # Go through configured policies to find the policy name.
-            prefix = ""
-            for k, v in settings.items():
-                m = re.match('multiauth\\.policy\\.(.*)\\.use', k)
-                if m:
-                    if v.endswith('FxAOAuthAuthenticationPolicy'):
-                        prefix = "{}:".format(m.group(1))
-
-            userids = [prefix + uid]
-            # Go through configured clients.
-            for k, v in settings.items():
-                m = re.match('fxa-oauth\\.clients\\.(.*)\\.client_id', k)
-                if m:
-                    suffix = "-{}".format(m.group(1))
-                    userids += [prefix + uid + suffix]
-
-            for uid in userids:
-                default_bucket_id = get_default_bucket_id(config, uid)
-                bucket_uri = '/buckets/{}'.format(default_bucket_id)
-                logger.info('Deleting bucket %r', bucket_uri)
-                # Delete the bucket and all its descendants.
-                # This code is similar to that from kinto.views.buckets:on_buckets_deleted.
-                for parent_id in [bucket_uri, bucket_uri + '/*']:
-                    storage.delete_all(
-                        parent_id=parent_id,
-                        collection_id=None,
-                        with_deleted=False,
-                    )
-                    # Purge tombstones too.
-                    storage.purge_deleted(
-                        parent_id=parent_id,
-                        collection_id=None,
-                    )
-                    permission.delete_object_permissions(parent_id)
-            current_transaction.commit()
+            delete_accounts(config, [uid], metrics=metrics)
+            with _timer(metrics, "process_account_event.commit"):
+                current_transaction.commit()
+            invalidate_tokens(config['registry'], uid, metrics=metrics)
+        elif event_type in TOKEN_INVALIDATION_EVENTS:
+            logger.info("Processing %s for %r", event_type, uid)
+            invalidate_tokens(config['registry'], uid, metrics=metrics)
         else:
             logger.warning("Dropping unknown event type %r",
                            event_type)
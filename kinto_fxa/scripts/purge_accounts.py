@@ -0,0 +1,78 @@
+"""Script to purge the data of a list of deleted accounts.
+
+Besides live account events, lists of deleted FxA accounts have to be purged
+in bulk. This script reads user IDs from a file (one per line), and deletes
+their default buckets (for every configured client), and their other objects
+if the principal index is enabled, in batches, with one transaction per batch.
+The cached verifications of their tokens are then invalidated.
+
+After each batch, the number of processed lines is saved in a checkpoint
+file, if any, so that an interrupted purge can be resumed where it stopped.
+
+"""
+import logging
+import os
+import time
+
+import transaction as current_transaction
+
+from .process_account_events import delete_accounts, invalidate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def read_checkpoint(checkpoint_file):
+    """Return the number of lines already processed, according to the checkpoint."""
+    if checkpoint_file is None or not os.path.exists(checkpoint_file):
+        return 0
+    with open(checkpoint_file) as f:
+        return int(f.read().strip() or 0)
+
+
+def write_checkpoint(checkpoint_file, processed):
+    """Atomically save the number of lines processed in the checkpoint."""
+    if checkpoint_file is None:
+        return
+    tmp = checkpoint_file + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write('{}\n'.format(processed))
+    os.replace(tmp, checkpoint_file)
+
+
+def purge_accounts(config, uids_file, batch_size=1000, checkpoint_file=None):
+    """Delete the default buckets of the accounts listed in ``uids_file``.
+
+    Returns the number of accounts purged in this run.
+    """
+    skipped = read_checkpoint(checkpoint_file)
+    if skipped:
+        logger.info("Resuming after %s lines", skipped)
+
+    start = time.time()
+    processed = purged = 0
+    batch = []
+
+    def flush():
+        nonlocal purged
+        delete_accounts(config, batch)
+        current_transaction.commit()
+        for uid in batch:
+            invalidate_tokens(config['registry'], uid)
+        write_checkpoint(checkpoint_file, skipped + processed)
+        purged += len(batch)
+        batch.clear()
+        elapsed = time.time() - start
+        logger.info("Purged %s accounts in %.1f seconds (%.1f accounts/s)",
+                    purged, elapsed, purged / elapsed if elapsed else 0)
+
+    for lineno, line in enumerate(uids_file):
+        if lineno < skipped:
+            continue
+        processed += 1
+        uid = line.strip()
+        if uid:
+            batch.append(uid)
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    return purged
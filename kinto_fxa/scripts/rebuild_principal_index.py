@@ -0,0 +1,25 @@
+"""Script to rebuild the index of the objects that FxA users can write.
+
+The index is maintained as objects change, once enabled with
+``fxa-oauth.principal_index.enabled``. This script builds it in one pass over
+the storage backend, for example when enabling it on an existing server.
+
+"""
+import logging
+import time
+
+import transaction as current_transaction
+
+from kinto_fxa.principal_index import rebuild_principal_index
+
+logger = logging.getLogger(__name__)
+
+
+def rebuild_index(config, batch_size=1000):
+    """Rebuild the principal index from the storage and permission backends."""
+    logger.info("Rebuilding principal index")
+    start = time.time()
+    count = rebuild_principal_index(config['registry'], batch_size=batch_size)
+    current_transaction.commit()
+    logger.info("Indexed %s objects in %.1f seconds", count, time.time() - start)
+    return count
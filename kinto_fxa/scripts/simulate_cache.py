@@ -0,0 +1,100 @@
+"""Script to replay a trace of verification cache lookups in simulated caches.
+
+Traces are recorded by the authentication policy when
+``fxa-oauth.cache.trace_file`` is set (see :mod:`kinto_fxa.trace`). This
+script replays them through :class:`TokenVerificationCache` instances with a
+simulated clock, for every combination of the given sizes, TTLs and admission
+policies, and reports their hit ratio, the resulting rate of requests to the
+FxA server, and their peak memory use.
+
+"""
+import collections
+import itertools
+import logging
+
+from kinto_fxa.authentication import TokenVerificationCache
+from kinto_fxa.cache import FrequencySketch, LocalCache
+from kinto_fxa.trace import read_trace
+
+logger = logging.getLogger(__name__)
+
+#: Client name of the lookups that matched no client (see :mod:`kinto_fxa.trace`).
+NO_CLIENT = '-'
+
+SimulationResult = collections.namedtuple('SimulationResult', [
+    'size', 'ttl', 'admission', 'lookups', 'hit_ratio', 'fxa_calls_per_second',
+    'peak_memory_bytes'])
+
+
+class _NoBackend(object):
+    """Cache backend that stores nothing, so that only the simulated tier is used."""
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+
+def simulate(lookups, size, ttl, admission=False, jitter=0, entry_size=512):
+    """Replay the ``(timestamp, token_hash, client_name, hit)`` lookups of a
+    trace in a cache of ``size`` entries (0 for unbounded).
+
+    Failed verifications (without client name) are not cached by the policy:
+    their lookups always count as misses, and are not stored.
+    """
+    now = 0
+
+    def clock():
+        return now
+
+    sketch = FrequencySketch(size or 1024) if admission else None
+    tier = LocalCache(max_entries=size or float('inf'), ttl=ttl, clock=clock, sketch=sketch)
+    cache = TokenVerificationCache(_NoBackend(), ttl, tiers=[tier], jitter=jitter, clock=clock,
+                                   sketch=sketch)
+    count = hits = peak = 0
+    first = last = None
+    for timestamp, token_hash, client_name, _ in lookups:
+        now = last = timestamp
+        if first is None:
+            first = timestamp
+        count += 1
+        if client_name == NO_CLIENT:
+            continue
+        # Verifications are cached per token and scope.
+        key = '{}:{}'.format(token_hash, client_name)
+        if cache.get(key) is not None:
+            hits += 1
+        else:
+            cache.set(key, '{}')
+            # Expired entries are only evicted lazily.
+            peak = max(peak, len(tier))
+
+    duration = (last - first) if count else 0
+    return SimulationResult(
+        size=size, ttl=ttl, admission=admission, lookups=count,
+        hit_ratio=hits / count if count else 0,
+        fxa_calls_per_second=(count - hits) / duration if duration else 0,
+        peak_memory_bytes=peak * entry_size)
+
+
+def simulate_cache(trace_file, sizes, ttls, admission=(False,), jitter=0, entry_size=512):
+    """Simulate every combination of ``sizes``, ``ttls`` and ``admission``
+    policies on the lookups of ``trace_file``, and log their results.
+    """
+    lookups = list(read_trace(trace_file))
+    if lookups:
+        observed = sum(1 for lookup in lookups if lookup[3]) / len(lookups)
+        logger.info("Replaying %s lookups (observed hit ratio: %.1f%%)",
+                    len(lookups), observed * 100)
+
+    results = []
+    for size, ttl, admit in itertools.product(sizes, ttls, admission):
+        result = simulate(lookups, size, ttl, admission=admit, jitter=jitter,
+                          entry_size=entry_size)
+        logger.info("size=%s ttl=%ss admission=%s: hit ratio %.1f%%, "
+                    "%.2f FxA calls/s, %.1f MB",
+                    size or 'unbounded', ttl, 'on' if admit else 'off',
+                    result.hit_ratio * 100, result.fxa_calls_per_second,
+                    result.peak_memory_bytes / 1024 / 1024)
+        results.append(result)
+    return results
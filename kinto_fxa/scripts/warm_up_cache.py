@@ -0,0 +1,25 @@
+"""Script to fill the token verification cache before traffic arrives.
+
+After a deploy or a cache flush, every active client would otherwise pay a
+round trip to the FxA server on its first request, all at the same time.
+This script reads bearer tokens from a file (one per line), and verifies them
+with bounded concurrency in order to fill the verification cache.
+
+"""
+import logging
+import time
+
+from kinto_fxa.authentication import warm_up_verification_cache
+
+logger = logging.getLogger(__name__)
+
+
+def warm_up_cache(config, tokens_file, max_workers=8):
+    """Verify the tokens of ``tokens_file`` to fill the verification cache."""
+    logger.info("Warming up verification cache with %s workers", max_workers)
+    start = time.time()
+    verified, rejected = warm_up_verification_cache(
+        config['registry'], tokens_file, max_workers=max_workers)
+    logger.info("Verified %s tokens and rejected %s in %.1f seconds",
+                verified, rejected, time.time() - start)
+    return verified, rejected
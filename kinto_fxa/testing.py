@@ -0,0 +1,257 @@
+"""Fake FxA OAuth server, to test and benchmark without Firefox Accounts.
+
+:class:`FakeFxAServer` serves the endpoints of the FxA OAuth server that
+kinto-fxa relies on, on localhost, from a background thread:
+
+- ``GET /v1/authorization``: grants a code to the configured user, and
+  redirects to ``redirect_uri`` (if given) with the ``code`` and ``state``;
+- ``POST /v1/token``: trades a code for an access token;
+- ``POST /v1/verify``: verifies an access token;
+- ``GET /v1/jwks``: publishes the key with which JWT access tokens are signed;
+- ``GET /__heartbeat__``.
+
+Latency, error rate, granted scopes and token lifetimes can be configured, and
+changed while the server is running, in order to reproduce the behaviour of
+production servers offline. For example, in a pytest fixture::
+
+    @pytest.fixture
+    def fxa_server():
+        with FakeFxAServer(latency=lognormal(0.02, 0.5), error_rate=0.01) as server:
+            yield server
+
+And with ``fxa-oauth.oauth_uri = <server.url>`` in the settings of the
+application, tokens issued with ``server.issue_token()`` can be used in
+``Authorization`` headers.
+
+Note that JWT access tokens are signed with a symmetric key (``HS256``),
+unlike the ones of the real FxA server.
+"""
+import base64
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import math
+import random
+import secrets
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+logger = logging.getLogger(__name__)
+
+#: Errors of the FxA OAuth server (see fxa-auth-server docs/api.md).
+INVALID_TOKEN = (400, 108, 'Invalid token')
+UNKNOWN_CODE = (400, 105, 'Unknown code')
+UNKNOWN_ENDPOINT = (404, 999, 'Not found')
+SERVICE_UNAVAILABLE = (503, 999, 'Service unavailable')
+
+
+def constant(seconds):
+    """Latency distribution that always returns ``seconds``."""
+    return lambda rand: seconds
+
+
+def lognormal(median, sigma):
+    """Log-normal latency distribution, with a long tail like network calls."""
+    return lambda rand: rand.lognormvariate(math.log(median), sigma)
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+Token = collections.namedtuple('Token', ['user', 'scope', 'client_id', 'expires_at'])
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeFxAServer(object):
+    """Stand-in of the FxA OAuth server, listening on localhost.
+
+    :param latency: latency of every response, in seconds, or a distribution
+        (see :func:`constant` and :func:`lognormal`).
+    :param error_rate: proportion of the requests that fail with a
+        ``503 Service Unavailable``.
+    :param scopes: scopes granted by authorization codes.
+    :param token_ttl: lifetime of the issued tokens, in seconds.
+    :param jwt: whether access tokens are JWTs (with an ``exp`` claim), or
+        opaque strings.
+    """
+    def __init__(self, latency=0, error_rate=0, scopes=('profile',), token_ttl=3600,
+                 user='fake-user', client_id='fake-client', jwt=False, seed=None,
+                 host='127.0.0.1', port=0, clock=time.time):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.scopes = tuple(scopes)
+        self.token_ttl = token_ttl
+        self.user = user
+        self.client_id = client_id
+        self.jwt = jwt
+        self.healthy = True
+        self.clock = clock
+        self.requests = collections.Counter()
+        self._random = random.Random(seed)
+        self._key = secrets.token_bytes(32)
+        self._tokens = {}
+        self._codes = {}
+        self._lock = threading.Lock()
+        self._address = (host, port)
+        self._server = None
+
+    @property
+    def url(self):
+        """URL of the OAuth API, for the ``fxa-oauth.oauth_uri`` setting."""
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/v1'.format(host, port)
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server._handle(self, 'GET')
+
+            def do_POST(self):
+                server._handle(self, 'POST')
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self._server = _ThreadingHTTPServer(self._address, Handler)
+        thread = threading.Thread(target=self._server.serve_forever, name='fake-fxa',
+                                  daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def issue_token(self, user=None, scope=None, client_id=None, ttl=None):
+        """Issue an access token, as if the user had signed in."""
+        token = Token(user=user or self.user,
+                      scope=list(scope or self.scopes),
+                      client_id=client_id or self.client_id,
+                      expires_at=self.clock() + (self.token_ttl if ttl is None else ttl))
+        if self.jwt:
+            header = _b64(json.dumps({'alg': 'HS256', 'typ': 'at+jwt', 'kid': 'fake'}).encode())
+            claims = {'sub': token.user, 'scope': ' '.join(token.scope),
+                      'client_id': token.client_id, 'exp': int(token.expires_at),
+                      'jti': secrets.token_hex(16)}
+            signed = header + '.' + _b64(json.dumps(claims).encode())
+            signature = hmac.new(self._key, signed.encode(), hashlib.sha256).digest()
+            access_token = signed + '.' + _b64(signature)
+        else:
+            access_token = secrets.token_hex(32)
+        with self._lock:
+            self._tokens[access_token] = token
+        return access_token
+
+    def revoke(self, access_token):
+        with self._lock:
+            self._tokens.pop(access_token, None)
+
+    def grant_code(self, user=None, scope=None, client_id=None):
+        """Grant an authorization code, to be traded with ``POST /v1/token``."""
+        code = secrets.token_hex(32)
+        with self._lock:
+            self._codes[code] = (user, scope, client_id)
+        return code
+
+    def _latency(self):
+        if callable(self.latency):
+            return self.latency(self._random)
+        return self.latency
+
+    def _handle(self, handler, method):
+        url = urlparse(handler.path)
+        endpoint = (method, url.path)
+        self.requests[url.path] += 1
+        time.sleep(max(0, self._latency()))
+
+        routes = {
+            ('GET', '/__heartbeat__'): self._heartbeat,
+            ('GET', '/v1/authorization'): self._authorization,
+            ('GET', '/v1/jwks'): self._jwks,
+            ('POST', '/v1/token'): self._token,
+            ('POST', '/v1/verify'): self._verify,
+        }
+        if endpoint not in routes:
+            return self._respond(handler, *self._error(UNKNOWN_ENDPOINT))
+        if self.error_rate and self._random.random() < self.error_rate:
+            return self._respond(handler, *self._error(SERVICE_UNAVAILABLE))
+
+        body = {}
+        if method == 'POST':
+            length = int(handler.headers.get('Content-Length') or 0)
+            try:
+                body = json.loads(handler.rfile.read(length) or b'{}')
+            except ValueError:
+                pass
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        self._respond(handler, *routes[endpoint](body, query))
+
+    def _respond(self, handler, status, body, headers=()):
+        payload = json.dumps(body).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(payload)))
+        for name, value in headers:
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def _error(self, error):
+        status, errno, message = error
+        return status, {'code': status, 'errno': errno, 'error': message, 'message': message}
+
+    def _heartbeat(self, body, query):
+        if not self.healthy:
+            return self._error(SERVICE_UNAVAILABLE)
+        return 200, {}
+
+    def _authorization(self, body, query):
+        code = self.grant_code(client_id=query.get('client_id'),
+                               scope=query['scope'].split() if 'scope' in query else None)
+        if 'redirect_uri' not in query:
+            return 200, {'code': code, 'state': query.get('state')}
+        location = '{}?{}'.format(query['redirect_uri'],
+                                  urlencode({'code': code, 'state': query.get('state', '')}))
+        return 302, {}, [('Location', location)]
+
+    def _jwks(self, body, query):
+        return 200, {'keys': [{'kty': 'oct', 'alg': 'HS256', 'use': 'sig', 'kid': 'fake',
+                               'k': _b64(self._key)}]}
+
+    def _token(self, body, query):
+        with self._lock:
+            grant = self._codes.pop(body.get('code'), None)
+        if grant is None:
+            return self._error(UNKNOWN_CODE)
+        user, scope, client_id = grant
+        access_token = self.issue_token(user=user, scope=scope,
+                                        client_id=client_id or body.get('client_id'))
+        token = self._tokens[access_token]
+        return 200, {'access_token': access_token, 'token_type': 'bearer',
+                     'scope': ' '.join(token.scope), 'expires_in': self.token_ttl,
+                     'auth_at': int(self.clock())}
+
+    def _verify(self, body, query):
+        with self._lock:
+            token = self._tokens.get(body.get('token'))
+        if token is None or token.expires_at <= self.clock():
+            return self._error(INVALID_TOKEN)
+        return 200, {'user': token.user, 'scope': token.scope, 'client_id': token.client_id,
+                     'exp': int(token.expires_at)}
@@ -1,4 +1,10 @@
+import base64
 import gc
+import json
+import os
+import shutil
+import tempfile
+import threading
 import time
 import unittest
 
@@ -10,7 +16,11 @@ from fxa import errors as fxa_errors
 from pyramid import httpexceptions
 
 from kinto_fxa import authentication, DEFAULT_SETTINGS
-from kinto_fxa.utils import parse_clients
+from kinto_fxa.cache import FrequencySketch, LocalCache
+from kinto_fxa.failover import FailoverOAuthClient
+from kinto_fxa.reload import build_clients_tables
+from kinto_fxa.trace import read_trace
+from kinto_fxa.utils import FxAOAuthSettings
 
 
 class TokenVerificationCacheTest(unittest.TestCase):
@@ -56,6 +66,220 @@ class TokenVerificationCacheTest(unittest.TestCase):
         self.assertIsNone(retrieved)
 
 
+class TokenVerificationCacheTTLTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = mock.Mock()
+        self.now = 1500000000
+        self.cache = authentication.TokenVerificationCache(self.backend, 3600,
+                                                           clock=lambda: self.now)
+
+    def stored_ttl(self, value):
+        self.backend.reset_mock()
+        self.cache.set('key', value)
+        if not self.backend.set.called:
+            return None
+        return self.backend.set.call_args_list[0][0][2]
+
+    def test_ttl_is_capped_by_expiration_of_verification(self):
+        self.assertEqual(self.stored_ttl(json.dumps({'exp': self.now + 60})), 60)
+        self.assertEqual(self.stored_ttl(json.dumps({'exp': (self.now + 60) * 1000})), 60)
+        self.assertEqual(self.stored_ttl(json.dumps({'exp': self.now + 7200})), 3600)
+
+    def test_expired_verifications_are_not_stored(self):
+        self.assertIsNone(self.stored_ttl(json.dumps({'exp': self.now - 100})))
+
+    def test_ttl_is_capped_by_given_expiration(self):
+        with self.cache.expiring_at(self.now + 30):
+            self.assertEqual(self.stored_ttl('toto'), 30)
+        self.assertEqual(self.stored_ttl('toto'), 3600)
+
+    @mock.patch('kinto_fxa.authentication.random.random')
+    def test_ttl_is_shortened_by_jitter(self, random):
+        random.return_value = 0.5
+        self.cache.jitter = 0.1
+        self.assertEqual(self.stored_ttl(json.dumps({'exp': self.now + 100})), 95)
+
+    def test_token_expiration_is_read_from_jwt(self):
+        payload = base64.urlsafe_b64encode(json.dumps({'exp': 1234}).encode()).rstrip(b'=')
+        token = 'header.{}.signature'.format(payload.decode())
+        self.assertEqual(authentication.token_expiration(token), 1234)
+        self.assertIsNone(authentication.token_expiration('opaque'))
+        self.assertIsNone(authentication.token_expiration('not.a.jwt'))
+
+
+class TokenVerificationCacheInvalidationTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = memory_backend.Cache(cache_prefix="tests",
+                                            cache_max_size_bytes=float("inf"))
+        self.local = LocalCache(max_entries=10, ttl=60)
+        self.cache = authentication.TokenVerificationCache(self.backend, 10,
+                                                           tiers=[self.local])
+        self.profile = json.dumps({'user': 'abc', 'scope': ['profile']})
+
+    def test_verifications_are_stamped_with_user_generation(self):
+        self.backend.set(authentication.user_generation_cache_key('abc'), 'g1', 10)
+        self.cache.set('key1', self.profile)
+        self.assertEqual(json.loads(self.backend.get('key1'))['_user_generation'], 'g1')
+        self.assertEqual(json.loads(self.cache.get('key1'))['user'], 'abc')
+
+    def test_values_without_user_are_not_stamped(self):
+        self.cache.set('key1', 'toto')
+        self.cache.invalidate_user('abc')
+        self.assertEqual(self.backend.get('key1'), 'toto')
+        self.assertEqual(self.cache.get('key1'), 'toto')
+
+    def test_invalidate_user_invalidates_every_verification_of_the_user(self):
+        self.cache.set('key1', self.profile)
+        self.cache.set('key2', self.profile)
+        self.cache.set('other', json.dumps({'user': 'def'}))
+        self.cache.invalidate_user('abc')
+        # Tiers aren't invalidated, they keep verifications for less time.
+        self.assertIsNotNone(self.cache.get('key1'))
+        backend_only = authentication.TokenVerificationCache(self.backend, 10)
+        self.assertIsNone(backend_only.get('key1'))
+        self.assertIsNone(backend_only.get('key2'))
+        self.assertIsNotNone(backend_only.get('other'))
+        # Verifications stored since then are valid.
+        self.cache.set('key1', self.profile)
+        self.assertIsNotNone(backend_only.get('key1'))
+
+    def test_concurrent_verifications_are_not_lost(self):
+        # Verifications stored from another process, with the same generation.
+        other = authentication.TokenVerificationCache(self.backend, 10)
+        self.cache.set('key1', self.profile)
+        other.set('key2', self.profile)
+        self.cache.invalidate_user('abc')
+        self.assertIsNone(other.get('key1'))
+        self.assertIsNone(other.get('key2'))
+
+    def test_generation_is_kept_as_long_as_verifications(self):
+        self.cache.invalidate_user('abc')
+        key = authentication.user_generation_cache_key('abc')
+        self.assertEqual(self.backend.ttl(key), 10)
+
+    def test_verifications_are_not_stamped_if_generation_is_unavailable(self):
+        self.cache.invalidate_user('abc')
+        with mock.patch.object(self.backend, 'get', side_effect=ValueError):
+            self.cache.set('key1', self.profile)
+        self.assertEqual(self.backend.get('key1'), self.profile)
+        backend_only = authentication.TokenVerificationCache(self.backend, 10)
+        self.assertIsNone(backend_only.get('key1'))
+
+    def test_invalidation_errors_are_ignored(self):
+        with mock.patch.object(self.backend, 'set', side_effect=ValueError):
+            self.cache.invalidate_user('abc')
+
+    def test_generations_can_be_kept_in_process(self):
+        now = [1000]
+        cache = authentication.TokenVerificationCache(self.backend, 10, clock=lambda: now[0],
+                                                      generations_ttl=5)
+        with mock.patch.object(self.backend, 'get', wraps=self.backend.get) as get:
+            cache.set('key1', self.profile)
+            cache.set('key2', self.profile)
+            self.assertIsNotNone(cache.get('key1'))
+        generation_key = authentication.user_generation_cache_key('abc')
+        self.assertEqual(get.call_args_list.count(mock.call(generation_key)), 1)
+
+        # Invalidations from other processes are noticed once they expire.
+        other = authentication.TokenVerificationCache(self.backend, 10)
+        other.invalidate_user('abc')
+        self.assertIsNotNone(cache.get('key1'))
+        now[0] += 5
+        self.assertIsNone(cache.get('key1'))
+
+    def test_invalidations_are_noticed_right_away_in_process(self):
+        cache = authentication.TokenVerificationCache(self.backend, 10, generations_ttl=5)
+        cache.set('key1', self.profile)
+        cache.invalidate_user('abc')
+        self.assertIsNone(cache.get('key1'))
+
+    def test_tiers_ttl_is_capped(self):
+        cache = authentication.TokenVerificationCache(self.backend, 10,
+                                                      tiers=[self.local], tiers_ttl=0.01)
+        cache.set('foobar', 'toto')
+        time.sleep(0.02)
+        self.assertIsNone(self.local.get('foobar'))
+        self.assertEqual(self.backend.get('foobar'), 'toto')
+
+
+class TokenVerificationCacheTiersTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = memory_backend.Cache(cache_prefix="tests",
+                                            cache_max_size_bytes=float("inf"))
+        self.local = LocalCache(max_entries=10, ttl=60)
+        self.other = LocalCache(max_entries=10, ttl=60)
+        self.cache = authentication.TokenVerificationCache(self.backend, 10,
+                                                           tiers=[self.local, self.other])
+
+    def tearDown(self):
+        self.backend.flush()
+
+    def test_set_stores_in_every_tier(self):
+        self.cache.set('foobar', 'toto')
+        self.assertEqual(self.local.get('foobar'), 'toto')
+        self.assertEqual(self.other.get('foobar'), 'toto')
+        self.assertEqual(self.backend.get('foobar'), 'toto')
+
+    def test_get_uses_fastest_tier_first(self):
+        self.local.set('foobar', 'local', 10)
+        with mock.patch.object(self.backend, 'get') as mocked:
+            self.assertEqual(self.cache.get('foobar'), 'local')
+        self.assertFalse(mocked.called)
+
+    def test_get_promotes_value_to_upper_tiers(self):
+        self.other.set('foobar', 'other', 10)
+        self.assertEqual(self.cache.get('foobar'), 'other')
+        self.assertEqual(self.local.get('foobar'), 'other')
+
+    def test_get_promotes_backend_value_with_its_remaining_ttl(self):
+        self.backend.set('foobar', 'toto', 0.01)
+        self.assertEqual(self.cache.get('foobar'), 'toto')
+        time.sleep(0.02)
+        self.assertIsNone(self.local.get('foobar'))
+        self.assertIsNone(self.other.get('foobar'))
+
+    def test_get_does_not_promote_values_without_ttl(self):
+        with mock.patch.object(self.backend, 'get', return_value='toto'):
+            self.assertEqual(self.cache.get('foobar'), 'toto')
+        self.assertIsNone(self.local.get('foobar'))
+
+    def test_get_counts_lookups_in_sketch(self):
+        self.cache.sketch = FrequencySketch(width=64)
+        self.cache.get('foobar')
+        self.cache.get('foobar')
+        self.assertEqual(self.cache.sketch.estimate('foobar'), 2)
+
+    def test_delete_removes_from_every_tier(self):
+        self.cache.set('foobar', 'toto')
+        self.cache.delete('foobar')
+        self.assertIsNone(self.local.get('foobar'))
+        self.assertIsNone(self.other.get('foobar'))
+        self.assertIsNone(self.backend.get('foobar'))
+
+    def test_last_lookup_tells_where_the_value_was_found(self):
+        self.assertEqual(self.cache.last_lookup, (None, 0))
+        self.cache.get('foobar')
+        self.assertIsNone(self.cache.last_lookup[0])
+        self.backend.set('foobar', 'toto', 10)
+        self.cache.get('foobar')
+        self.assertEqual(self.cache.last_lookup[0], 'backend')
+        self.cache.get('foobar')
+        source, duration = self.cache.last_lookup
+        self.assertEqual(source, 'local')
+        self.assertGreater(duration, 0)
+
+    def test_tier_errors_are_ignored(self):
+        self.backend.set('foobar', 'toto', 10)
+        for method in ('get', 'set', 'delete'):
+            patcher = mock.patch.object(self.local, method, side_effect=ValueError)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.assertEqual(self.cache.get('foobar'), 'toto')
+        self.cache.set('foobar', 'titi')
+        self.cache.delete('foobar')
+        self.assertIsNone(self.other.get('foobar'))
+
+
 class FxAOAuthAuthenticationPolicyTest(unittest.TestCase):
     def setUp(self):
         self.policy = authentication.FxAOAuthAuthenticationPolicy()
@@ -80,9 +304,9 @@ class FxAOAuthAuthenticationPolicyTest(unittest.TestCase):
         settings['fxa-oauth.cache_ttl_seconds'] = '0.01'
         settings['fxa-oauth.required_scope'] = 'mandatory profile'
         request.registry.settings = settings
-        resources, scope_routing = parse_clients(settings)
-        request.registry._fxa_oauth_config = resources
-        request.registry._fxa_oauth_scope_routing = scope_routing
+        request.registry._fxa_oauth_settings = FxAOAuthSettings.from_settings(settings)
+        request.registry._fxa_oauth_clients = build_clients_tables(
+            settings, request.registry._fxa_oauth_settings)
         request.headers['Authorization'] = 'Bearer foo'
         return request
 
@@ -128,6 +352,19 @@ class FxAOAuthAuthenticationPolicyTest(unittest.TestCase):
         # Cache backend was used.
         self.assertEqual(1, api_mocked.call_count)
 
+    @mock.patch('fxa.oauth.APIClient.post')
+    def test_oauth_verification_is_cached_until_jwt_expiration(self, api_mocked):
+        api_mocked.return_value = self.profile_data
+        payload = base64.urlsafe_b64encode(json.dumps({'exp': 1}).encode()).rstrip(b'=')
+        token = 'header.{}.signature'.format(payload.decode())
+        request = self._build_request()
+        request.headers['Authorization'] = 'Bearer ' + token
+        self.assertEqual(self.policy.authenticated_userid(request), '33')
+        # Expired already, so not cached.
+        self.assertIsNone(self.backend.get(
+            authentication.verification_cache_key(token, ['mandatory', 'profile'])))
+        self.assertEqual(api_mocked.call_count, 1)
+
     @mock.patch('fxa.oauth.APIClient.post')
     def test_oauth_verification_is_done_once_per_request(self, api_mocked):
         api_mocked.return_value = self.profile_data
@@ -166,25 +403,151 @@ class FxAOAuthAuthenticationPolicyTest(unittest.TestCase):
         self.assertEqual(2, api_mocked.call_count)
 
     def test_raise_error_if_oauth2_server_misbehaves(self):
-        with mock.patch('kinto_fxa.authentication.'
-                        'OAuthClient.verify_token') as mocked:
+        with mock.patch('fxa.oauth.Client.verify_token') as mocked:
             mocked.side_effect = fxa_errors.OutOfProtocolError
             self.assertRaises(httpexceptions.HTTPServiceUnavailable,
                               self.policy.authenticated_userid,
                               self.request)
 
     def test_returns_none_if_oauth2_error(self):
-        with mock.patch('kinto_fxa.authentication.'
-                        'OAuthClient.verify_token') as mocked:
+        with mock.patch('fxa.oauth.Client.verify_token') as mocked:
             mocked.side_effect = fxa_errors.ClientError
             self.assertIsNone(self.policy.authenticated_userid(self.request))
 
     def test_returns_none_if_oauth2_scope_mismatch(self):
-        with mock.patch('kinto_fxa.authentication.'
-                        'OAuthClient.verify_token') as mocked:
+        with mock.patch('fxa.oauth.Client.verify_token') as mocked:
             mocked.side_effect = fxa_errors.TrustError
             self.assertIsNone(self.policy.authenticated_userid(self.request))
 
+    @mock.patch('fxa.oauth.APIClient.post')
+    def test_oauth_verification_is_serialized_per_token(self, api_mocked):
+        api_mocked.return_value = self.profile_data
+        lock = mock.MagicMock()
+        with mock.patch.object(self.policy._token_locks, 'get', return_value=lock) as mocked:
+            self.policy.authenticated_userid(self.request)
+        mocked.assert_called_with('foo')
+        self.assertTrue(lock.__enter__.called)
+        self.assertTrue(lock.__exit__.called)
+
+    @mock.patch('fxa.oauth.APIClient.post')
+    def test_cached_verifications_do_not_wait_for_the_token_lock(self, api_mocked):
+        api_mocked.return_value = self.profile_data
+        settings = self.request.registry._fxa_oauth_settings
+        self.request.registry._fxa_oauth_settings = settings.replace(cache_ttl_seconds=60)
+        self.policy.authenticated_userid(self.request)
+        request = self._build_request()
+        request.registry._fxa_oauth_settings = self.request.registry._fxa_oauth_settings
+        with self.policy._token_locks.get('foo'):
+            results = []
+            thread = threading.Thread(
+                target=lambda: results.append(self.policy.authenticated_userid(request)))
+            thread.start()
+            thread.join(timeout=5)
+        self.assertEqual(results, ['33'])
+        self.assertEqual(api_mocked.call_count, 1)
+
+    def test_setup_builds_clients_only_once(self):
+        with mock.patch('fxa.oauth.Client') as mocked:
+            threads = [threading.Thread(target=self.policy.setup,
+                                        args=(self.request.registry,))
+                       for _ in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(mocked.call_count, 1)
+        self.assertIsNotNone(self.policy._cache)
+
+    def test_setup_does_not_require_a_cache_backend(self):
+        del self.request.registry.cache
+        with mock.patch('fxa.oauth.Client') as mocked:
+            self.policy.setup(self.request.registry)
+        mocked.assert_called_with(server_url=None, cache=None)
+
+    def test_setup_builds_failover_client_if_configured(self):
+        settings = self.request.registry._fxa_oauth_settings
+        self.request.registry._fxa_oauth_settings = settings.replace(
+            oauth_uri='https://a/v1', failover_uris=('https://b/v1',))
+        self.policy.setup(self.request.registry)
+        client = self.policy._auth_client
+        self.assertIsInstance(client, FailoverOAuthClient)
+        self.assertEqual([c.server_url for c in client.clients],
+                         ['https://a/v1', 'https://b/v1'])
+        self.assertIsNone(client._executor)
+        self.assertIs(client.cache, self.policy._cache)
+
+    def test_setup_enables_hedging_if_configured(self):
+        settings = self.request.registry._fxa_oauth_settings
+        self.request.registry._fxa_oauth_settings = settings.replace(hedging_enabled=True)
+        self.policy.setup(self.request.registry)
+        self.assertEqual(self.policy._auth_client.hedge_percentile, 95)
+        self.policy._auth_client._executor.shutdown()
+
+    @mock.patch('fxa.oauth.APIClient.post')
+    def test_verified_tokens_are_traced_if_enabled(self, api_mocked):
+        api_mocked.return_value = self.profile_data
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'trace.tsv')
+        settings = self.request.registry._fxa_oauth_settings
+        self.request.registry._fxa_oauth_settings = settings.replace(cache_trace_file=path,
+                                                                     cache_ttl_seconds=60)
+        self.policy.setup(self.request.registry)
+        for _ in range(2):
+            self.policy.authenticated_userid(self._build_request())
+        self.policy._trace.close()
+        with open(path) as f:
+            lookups = list(read_trace(f))
+        self.assertEqual([(client, hit) for _, _, client, hit in lookups],
+                         [('default', False), ('default', True)])
+
+    @mock.patch('fxa.oauth.APIClient.post')
+    def test_verification_phases_are_recorded_if_enabled(self, api_mocked):
+        api_mocked.return_value = self.profile_data
+        settings = self.request.registry._fxa_oauth_settings.replace(server_timing_enabled=True,
+                                                                     cache_ttl_seconds=60)
+        self.request.registry._fxa_oauth_settings = settings
+        self.request.log_context = mock.Mock()
+        self.policy.authenticated_userid(self.request)
+        trace = self.request.bound_data[authentication.AUTH_TRACE_KEY]
+        self.assertEqual(trace['cache'], 'miss')
+        self.assertEqual(trace['scopes'], 1)
+        self.assertGreaterEqual(trace['total'], trace['lock'] + trace['verify'])
+        self.request.log_context.assert_called_with(fxa_auth=trace)
+
+        request = self._build_request()
+        request.registry._fxa_oauth_settings = settings
+        self.policy.authenticated_userid(request)
+        trace = request.bound_data[authentication.AUTH_TRACE_KEY]
+        self.assertEqual(trace['cache'], 'backend')
+
+    @mock.patch('fxa.oauth.APIClient.post')
+    def test_verification_phases_are_recorded_on_errors(self, api_mocked):
+        api_mocked.side_effect = fxa_errors.OutOfProtocolError
+        settings = self.request.registry._fxa_oauth_settings
+        self.request.registry._fxa_oauth_settings = settings.replace(server_timing_enabled=True)
+        with self.assertRaises(httpexceptions.HTTPServiceUnavailable):
+            self.policy.authenticated_userid(self.request)
+        trace = self.request.bound_data[authentication.AUTH_TRACE_KEY]
+        self.assertEqual(trace['scopes'], 1)
+
+    def test_verification_phases_are_not_recorded_by_default(self):
+        with mock.patch.object(self.policy, '_verify_scopes', return_value=('33', 'default')):
+            self.policy.authenticated_userid(self.request)
+        self.assertNotIn(authentication.AUTH_TRACE_KEY, self.request.bound_data)
+
+    def test_returns_none_if_token_has_invalid_characters(self):
+        self.request.headers['Authorization'] = 'Bearer foo bar'
+        with mock.patch.object(self.policy, '_verify_token') as mocked:
+            self.assertIsNone(self.policy.unauthenticated_userid(self.request))
+        self.assertFalse(mocked.called)
+
+    def test_returns_none_if_token_is_too_long(self):
+        self.request.headers['Authorization'] = 'Bearer ' + 'a' * 4097
+        with mock.patch.object(self.policy, '_verify_token') as mocked:
+            self.assertIsNone(self.policy.unauthenticated_userid(self.request))
+        self.assertFalse(mocked.called)
+
     def test_forget_uses_realm(self):
         policy = authentication.FxAOAuthAuthenticationPolicy(realm='Who')
         headers = policy.forget(self.request)
@@ -192,16 +555,197 @@ class FxAOAuthAuthenticationPolicyTest(unittest.TestCase):
                          ('WWW-Authenticate', 'Bearer realm="Who"'))
 
 
+class ServerTimingTest(unittest.TestCase):
+    def setUp(self):
+        self.trace = {'lock': 0.01, 'cache': 'local', 'cache_lookup': 0.123,
+                      'verify': 0, 'scopes': 1, 'total': 0.2}
+
+    def test_trace_is_formatted_as_server_timing(self):
+        self.assertEqual(authentication.server_timing(self.trace),
+                         'fxa-lock;dur=0.0, fxa-cache;dur=0.1;desc="local", '
+                         'fxa-verify;dur=0.0;desc="1 scopes", fxa-auth;dur=0.2')
+
+    def test_header_is_added_if_token_was_verified(self):
+        event = mock.Mock()
+        event.request.bound_data = {authentication.AUTH_TRACE_KEY: self.trace}
+        event.response.headers = {}
+        authentication.add_server_timing(event)
+        self.assertIn('fxa-auth;dur=0.2', event.response.headers['Server-Timing'])
+
+    def test_header_is_not_added_otherwise(self):
+        event = mock.Mock()
+        event.request.bound_data = {}
+        event.response.headers = {}
+        authentication.add_server_timing(event)
+        self.assertEqual(event.response.headers, {})
+
+
+class FxAOAuthRateLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = authentication.FxAOAuthAuthenticationPolicy()
+        self.backend = memory_backend.Cache(cache_prefix="tests",
+                                            cache_max_size_bytes=float("inf"))
+        self.settings = DEFAULT_SETTINGS.copy()
+        self.settings['fxa-oauth.required_scope'] = 'profile'
+        self.settings['fxa-oauth.ratelimit.enabled'] = 'true'
+        self.settings['fxa-oauth.ratelimit.failures_burst'] = '2'
+        self.settings['fxa-oauth.ratelimit.failures_per_second'] = '0.001'
+
+        patcher = mock.patch('fxa.oauth.APIClient.post')
+        self.api_mocked = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.api_mocked.side_effect = fxa_errors.ClientError
+
+    def tearDown(self):
+        self.backend.flush()
+
+    def _build_request(self, token='foo', client_addr='1.2.3.4', forwarded_for=None):
+        request = DummyRequest()
+        request.bound_data = {}
+        request.remote_addr = client_addr
+        if forwarded_for is not None:
+            request.headers['X-Forwarded-For'] = forwarded_for
+        request.registry.cache = self.backend
+        request.registry.settings = self.settings
+        request.registry._fxa_oauth_settings = FxAOAuthSettings.from_settings(self.settings)
+        request.registry._fxa_oauth_clients = build_clients_tables(
+            self.settings, request.registry._fxa_oauth_settings)
+        request.headers['Authorization'] = 'Bearer ' + token
+        return request
+
+    def _fail(self, times, **kwargs):
+        for i in range(times):
+            request = self._build_request(token='invalid%s' % i, **kwargs)
+            self.policy.authenticated_userid(request)
+
+    def test_unknown_tokens_are_shed_after_too_many_failures(self):
+        self._fail(2)
+        with self.assertRaises(httpexceptions.HTTPTooManyRequests) as cm:
+            self.policy.authenticated_userid(self._build_request(token='another'))
+        self.assertEqual(cm.exception.json['errno'], 117)
+        self.assertEqual(cm.exception.headers['Retry-After'], '1000')
+        self.assertEqual(self.api_mocked.call_count, 2)
+
+    def test_other_clients_are_not_shed(self):
+        self._fail(2)
+        request = self._build_request(token='another', client_addr='5.6.7.8')
+        self.assertIsNone(self.policy.authenticated_userid(request))
+        self.assertEqual(self.api_mocked.call_count, 3)
+
+    def test_cached_tokens_are_not_shed(self):
+        self.api_mocked.side_effect = None
+        self.api_mocked.return_value = {'user': '33', 'scope': ['profile'], 'client_id': ''}
+        self.policy.authenticated_userid(self._build_request(token='valid'))
+        self.api_mocked.side_effect = fxa_errors.ClientError
+        self._fail(2)
+        user_id = self.policy.authenticated_userid(self._build_request(token='valid'))
+        self.assertEqual(user_id, '33')
+
+    def test_failures_are_aggregated_in_shared_cache(self):
+        self.settings['fxa-oauth.ratelimit.shared'] = 'true'
+        self._fail(2)
+        other_policy = authentication.FxAOAuthAuthenticationPolicy()
+        with self.assertRaises(httpexceptions.HTTPTooManyRequests):
+            other_policy.authenticated_userid(self._build_request(token='another'))
+
+    def test_shared_failures_are_not_read_for_cached_tokens(self):
+        self.settings['fxa-oauth.ratelimit.shared'] = 'true'
+        self.api_mocked.side_effect = None
+        self.api_mocked.return_value = {'user': '33', 'scope': ['profile'], 'client_id': ''}
+        self.policy.authenticated_userid(self._build_request(token='valid'))
+        with mock.patch.object(self.policy._shared_failures, 'exceeded') as mocked:
+            user_id = self.policy.authenticated_userid(self._build_request(token='valid'))
+        self.assertEqual(user_id, '33')
+        self.assertFalse(mocked.called)
+
+    def test_nothing_is_shed_if_disabled(self):
+        self.settings['fxa-oauth.ratelimit.enabled'] = 'false'
+        self._fail(5)
+        self.assertEqual(self.api_mocked.call_count, 5)
+
+    def test_tokens_are_shed_if_there_is_no_cache_backend(self):
+        self.policy.setup(self._build_request().registry)
+        self.policy._cache = None
+        self._fail(2)
+        with self.assertRaises(httpexceptions.HTTPTooManyRequests):
+            self.policy.authenticated_userid(self._build_request(token='another'))
+
+    def test_forwarded_addresses_are_not_trusted_by_default(self):
+        for i in range(2):
+            request = self._build_request(token='invalid%s' % i, forwarded_for='9.9.9.%s' % i)
+            self.policy.authenticated_userid(request)
+        with self.assertRaises(httpexceptions.HTTPTooManyRequests):
+            request = self._build_request(token='another', forwarded_for='9.9.9.9')
+            self.policy.authenticated_userid(request)
+
+    def test_forwarded_addresses_of_trusted_proxies_are_used(self):
+        self.settings['fxa-oauth.ratelimit.trusted_proxies'] = '1'
+        self._fail(2, client_addr='10.0.0.1', forwarded_for='6.6.6.6, 1.2.3.4')
+        with self.assertRaises(httpexceptions.HTTPTooManyRequests):
+            request = self._build_request(token='another', client_addr='10.0.0.2',
+                                          forwarded_for='7.7.7.7, 1.2.3.4')
+            self.policy.authenticated_userid(request)
+        request = self._build_request(token='another', client_addr='10.0.0.1',
+                                      forwarded_for='5.6.7.8')
+        self.assertIsNone(self.policy.authenticated_userid(request))
+
+    def test_floods_from_many_addresses_are_shed(self):
+        self.settings['fxa-oauth.ratelimit.global_failures_burst'] = '3'
+        self.settings['fxa-oauth.ratelimit.global_failures_per_second'] = '0.01'
+        for i in range(3):
+            self._fail(1, client_addr='1.2.3.%s' % i)
+        with self.assertRaises(httpexceptions.HTTPTooManyRequests) as cm:
+            request = self._build_request(token='another', client_addr='5.6.7.8')
+            self.policy.authenticated_userid(request)
+        self.assertEqual(cm.exception.headers['Retry-After'], '100')
+        self.assertEqual(self.api_mocked.call_count, 3)
+
+    def test_global_budget_can_be_disabled(self):
+        self.settings['fxa-oauth.ratelimit.global_failures_burst'] = '0'
+        self.policy.setup(self._build_request().registry)
+        self.assertIsNone(self.policy._global_limiter)
+
+
+class SetupPoliciesTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = authentication.FxAOAuthAuthenticationPolicy()
+        self.event = mock.Mock()
+        self.registry = self.event.app.registry
+
+    def test_sets_up_fxa_policies_among_multiauth_ones(self):
+        other = mock.Mock()
+        multiauth = mock.Mock()
+        multiauth.get_policies.return_value = [('fxa', self.policy), ('other', other)]
+        self.registry.queryUtility.return_value = multiauth
+        with mock.patch.object(self.policy, 'setup') as mocked:
+            authentication.setup_policies(self.event)
+        mocked.assert_called_with(self.registry)
+
+    def test_sets_up_a_single_fxa_policy(self):
+        self.registry.queryUtility.return_value = self.policy
+        with mock.patch.object(self.policy, 'setup') as mocked:
+            authentication.setup_policies(self.event)
+        mocked.assert_called_with(self.registry)
+
+
 class FxAPingTest(unittest.TestCase):
     def setUp(self):
         self.request = DummyRequest()
-        self.request.registry.settings = DEFAULT_SETTINGS
-        self.request.registry.settings['fxa-oauth.oauth_uri'] = 'http://fxa'
+        settings = DEFAULT_SETTINGS.copy()
+        settings['fxa-oauth.oauth_uri'] = 'http://fxa'
+        self.request.registry.settings = settings
+        self.request.registry._fxa_oauth_settings = FxAOAuthSettings.from_settings(settings)
 
     def test_returns_none_if_oauth_deactivated(self):
-        self.request.registry.settings['fxa-oauth.oauth_uri'] = None
+        registry = self.request.registry
+        registry._fxa_oauth_settings = registry._fxa_oauth_settings.replace(oauth_uri=None)
         self.assertIsNone(authentication.fxa_ping(self.request))
 
+    @mock.patch('requests.get')
+    def test_uses_heartbeat_timeout_from_settings(self, get_mocked):
+        authentication.fxa_ping(self.request)
+        get_mocked.assert_called_with('http://fxa/__heartbeat__', timeout=3.0)
+
     @mock.patch('requests.get')
     def test_returns_true_if_ok(self, get_mocked):
         httpOK = requests.models.Response()
@@ -247,9 +791,9 @@ class FxAOAuthAuthenticationMultipleClientsPolicyTest(unittest.TestCase):
             'profile https://identity.mozilla.org/apps/lockbox')
 
         request.registry.settings = settings
-        resources, scope_routing = parse_clients(settings)
-        request.registry._fxa_oauth_config = resources
-        request.registry._fxa_oauth_scope_routing = scope_routing
+        request.registry._fxa_oauth_settings = FxAOAuthSettings.from_settings(settings)
+        request.registry._fxa_oauth_clients = build_clients_tables(
+            settings, request.registry._fxa_oauth_settings)
         request.headers['Authorization'] = 'Bearer foo'
         return request
 
@@ -0,0 +1,31 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from kinto_fxa.scripts.benchmark_startup import benchmark_startup
+
+CONFIG = """
+[app:main]
+use = egg:kinto
+kinto.includes = kinto_fxa
+kinto.userid_hmac_secret = secret
+multiauth.policies = fxa
+multiauth.policy.fxa.use = kinto_fxa.authentication.FxAOAuthAuthenticationPolicy
+fxa-oauth.oauth_uri = https://oauth.accounts.firefox.com/v1
+"""
+
+
+class BenchmarkStartupTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.ini_file = os.path.join(tmpdir, 'kinto.ini')
+        with open(self.ini_file, 'w') as f:
+            f.write(CONFIG)
+
+    def test_startup_steps_are_measured(self):
+        result = benchmark_startup(self.ini_file, runs=1)
+        self.assertGreater(result.import_kinto, 0)
+        self.assertGreater(result.import_kinto_fxa, 0)
+        self.assertGreater(result.build_app, 0)
@@ -0,0 +1,246 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import mock
+
+from kinto_fxa import DEFAULT_SETTINGS
+from kinto_fxa.cache import (
+    FrequencySketch, LocalCache, SharedMemoryCache, build_cache_tiers, build_frequency_sketch)
+from kinto_fxa.utils import FxAOAuthSettings
+
+
+class FrequencySketchTest(unittest.TestCase):
+    def setUp(self):
+        self.sketch = FrequencySketch(width=64)
+
+    def test_estimates_count_increments(self):
+        for _ in range(3):
+            self.sketch.increment('a')
+        self.sketch.increment('b')
+        self.assertEqual(self.sketch.estimate('a'), 3)
+        self.assertEqual(self.sketch.estimate('b'), 1)
+        self.assertEqual(self.sketch.estimate('c'), 0)
+
+    def test_counters_saturate(self):
+        for _ in range(20):
+            self.sketch.increment('a')
+        self.assertEqual(self.sketch.estimate('a'), 15)
+
+    def test_counters_are_halved_periodically(self):
+        for _ in range(6):
+            self.sketch.increment('a')
+        for i in range(self.sketch.sample_size - 6):
+            self.sketch.increment('b')
+        self.assertEqual(self.sketch.estimate('a'), 3)
+
+
+class LocalCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = LocalCache(max_entries=2, ttl=10, clock=lambda: self.now)
+
+    def test_get_returns_stored_value(self):
+        self.cache.set('a', 'value', 5)
+        self.assertEqual(self.cache.get('a'), 'value')
+
+    def test_get_returns_none_for_unknown_keys(self):
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_entries_expire_after_ttl(self):
+        self.cache.set('a', 'value', 5)
+        self.now += 5
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_ttl_is_capped(self):
+        self.cache.set('a', 'value', 3600)
+        self.now += 10
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        self.cache.set('a', 'value', 5)
+        self.cache.set('b', 'value', 5)
+        self.cache.get('a')
+        self.cache.set('c', 'value', 5)
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+
+    def test_delete_removes_entry(self):
+        self.cache.set('a', 'value', 5)
+        self.cache.delete('a')
+        self.cache.delete('a')
+        self.assertIsNone(self.cache.get('a'))
+
+
+class LocalCacheAdmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.sketch = FrequencySketch(width=64)
+        self.cache = LocalCache(max_entries=1, ttl=10, clock=lambda: self.now,
+                                sketch=self.sketch)
+        self.sketch.increment('hot')
+        self.sketch.increment('hot')
+        self.cache.set('hot', 'value', 5)
+
+    def test_rare_entries_are_not_admitted_when_full(self):
+        self.sketch.increment('once')
+        self.cache.set('once', 'value', 5)
+        self.assertIsNone(self.cache.get('once'))
+        self.assertEqual(self.cache.get('hot'), 'value')
+
+    def test_frequent_entries_replace_rare_ones(self):
+        for _ in range(3):
+            self.sketch.increment('hotter')
+        self.cache.set('hotter', 'value', 5)
+        self.assertEqual(self.cache.get('hotter'), 'value')
+
+    def test_expired_entries_are_replaced(self):
+        self.now += 5
+        self.cache.set('once', 'value', 5)
+        self.assertEqual(self.cache.get('once'), 'value')
+
+    def test_existing_entries_are_updated(self):
+        self.cache.set('hot', 'other', 5)
+        self.assertEqual(self.cache.get('hot'), 'other')
+
+
+class SharedMemoryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'tokens')
+        self.cache = self._build()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _build(self, name='tokens', **kwargs):
+        kwargs.setdefault('slots', 8)
+        kwargs.setdefault('slot_size', 128)
+        path = os.path.join(self.tmpdir, name)
+        cache = SharedMemoryCache(path, clock=lambda: self.now, **kwargs)
+        self.addCleanup(lambda: cache._mmap.closed or cache.close())
+        return cache
+
+    def test_get_returns_stored_value(self):
+        self.cache.set('a', '{"user": "33"}', 5)
+        self.assertEqual(self.cache.get('a'), '{"user": "33"}')
+
+    def test_get_returns_none_for_unknown_keys(self):
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_entries_are_shared_between_instances(self):
+        other = self._build()
+        self.cache.set('a', 'value', 5)
+        self.assertEqual(other.get('a'), 'value')
+
+    def test_entries_expire_after_ttl(self):
+        self.cache.set('a', 'value', 5)
+        self.now += 5
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_set_overwrites_previous_value(self):
+        self.cache.set('a', 'a longer value', 5)
+        self.cache.set('a', 'short', 5)
+        self.assertEqual(self.cache.get('a'), 'short')
+
+    def test_values_larger_than_slots_are_not_stored(self):
+        self.cache.set('a', 'x' * 200, 5)
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_entry_closest_to_expiration_is_replaced_when_full(self):
+        cache = self._build('small', slots=1, probes=1)
+        cache.set('a', 'value', 10)
+        cache.set('b', 'value', 5)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 'value')
+
+    def test_entries_are_spread_over_probed_slots(self):
+        cache = self._build('small', slots=2, probes=2)
+        cache.set('a', 'value', 10)
+        cache.set('b', 'other', 5)
+        cache.set('c', 'third', 5)
+        self.assertEqual(cache.get('a'), 'value')
+        self.assertIsNone(cache.get('b'))
+
+    def test_slots_being_written_are_ignored_by_readers(self):
+        self.cache.set('a', 'value', 5)
+        for offset in range(16, 16 + 8 * 128, 128):
+            struct.pack_into('<I', self.cache._mmap, offset, 3)
+        self.assertIsNone(self.cache.get('a'))
+        # Slots left over by a crashed writer are taken over.
+        self.cache.set('a', 'value', 5)
+        self.assertEqual(self.cache.get('a'), 'value')
+
+    def test_live_entries_are_only_replaced_by_frequent_ones(self):
+        sketch = FrequencySketch(width=64)
+        cache = self._build('small', slots=1, probes=1, sketch=sketch)
+        cache.set('a', 'value', 10)
+        sketch.increment('b')
+        cache.set('b', 'value', 5)
+        self.assertIsNone(cache.get('b'))
+        sketch.increment('b')
+        cache.set('b', 'value', 5)
+        self.assertEqual(cache.get('b'), 'value')
+
+    def test_delete_removes_entry(self):
+        self.cache.set('a', 'value', 5)
+        self.cache.delete('a')
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_incompatible_layout_is_rejected(self):
+        with self.assertRaises(ValueError):
+            SharedMemoryCache(self.path, slots=16, slot_size=128)
+
+    def test_files_accessible_by_other_users_are_rejected(self):
+        os.chmod(self.path, 0o644)
+        with self.assertRaises(ValueError):
+            self._build()
+
+    def test_files_of_other_users_are_rejected(self):
+        with mock.patch('os.getuid', return_value=os.getuid() + 1):
+            with self.assertRaises(ValueError):
+                self._build()
+
+    def test_links_are_not_followed(self):
+        link = os.path.join(self.tmpdir, 'link')
+        os.symlink(self.path, link)
+        with self.assertRaises(OSError):
+            SharedMemoryCache(link, slots=8, slot_size=128)
+
+    def test_slots_must_be_large_enough(self):
+        with self.assertRaises(ValueError):
+            SharedMemoryCache(self.path, slot_size=16)
+
+
+class BuildCacheTiersTest(unittest.TestCase):
+    def test_no_tier_is_enabled_by_default(self):
+        settings = FxAOAuthSettings.from_settings(DEFAULT_SETTINGS)
+        self.assertEqual(build_cache_tiers(settings), [])
+
+    def test_sketch_is_sized_after_the_largest_tier(self):
+        settings = DEFAULT_SETTINGS.copy()
+        self.assertIsNone(build_frequency_sketch(FxAOAuthSettings.from_settings(settings)))
+        settings['fxa-oauth.cache.admission.enabled'] = 'true'
+        self.assertEqual(build_frequency_sketch(
+            FxAOAuthSettings.from_settings(settings)).width, 1024)
+        settings['fxa-oauth.cache.local_max_entries'] = '100'
+        settings['fxa-oauth.cache.shared_memory_path'] = '/tmp/tokens'
+        settings['fxa-oauth.cache.shared_memory_slots'] = '4096'
+        self.assertEqual(build_frequency_sketch(
+            FxAOAuthSettings.from_settings(settings)).width, 4096)
+
+    def test_tiers_are_ordered_from_fastest(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        settings = DEFAULT_SETTINGS.copy()
+        settings['fxa-oauth.cache.local_max_entries'] = '100'
+        settings['fxa-oauth.cache.shared_memory_path'] = os.path.join(tmpdir, 'tokens')
+        settings['fxa-oauth.cache.shared_memory_slots'] = '16'
+        tiers = build_cache_tiers(FxAOAuthSettings.from_settings(settings))
+        self.assertIsInstance(tiers[0], LocalCache)
+        self.assertIsInstance(tiers[1], SharedMemoryCache)
+        tiers[1].close()
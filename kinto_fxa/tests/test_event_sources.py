@@ -0,0 +1,158 @@
+import io
+import json
+import threading
+import unittest
+
+import mock
+
+from kinto_fxa.scripts.event_sources import (
+    JSONLinesQueue, JSONLinesWriter, MemoryQueue, SQSQueue)
+
+
+class MemoryQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.queue = MemoryQueue(visibility_timeout=30, clock=lambda: self.now)
+
+    def test_received_messages_are_hidden_until_visibility_timeout(self):
+        self.queue.send_message(MessageBody='a')
+        self.assertEqual(len(self.queue.receive_messages()), 1)
+        self.assertEqual(self.queue.receive_messages(), [])
+        self.now += 30
+        msg, = self.queue.receive_messages()
+        self.assertEqual(msg.body, 'a')
+        self.assertEqual(msg.attributes, {'ApproximateReceiveCount': '2'})
+
+    def test_receive_is_limited_to_max_number_of_messages(self):
+        for body in 'abc':
+            self.queue.send_message(MessageBody=body)
+        msgs = self.queue.receive_messages(MaxNumberOfMessages=2)
+        self.assertEqual([msg.body for msg in msgs], ['a', 'b'])
+
+    def test_deleted_messages_are_not_delivered_again(self):
+        self.queue.send_message(MessageBody='a')
+        self.queue.send_message(MessageBody='b')
+        first, second = self.queue.receive_messages(MaxNumberOfMessages=2, VisibilityTimeout=0)
+        first.delete()
+        response = self.queue.delete_messages(Entries=[
+            {'Id': '0', 'ReceiptHandle': second.receipt_handle},
+            {'Id': '1', 'ReceiptHandle': first.receipt_handle},
+        ])
+        self.assertEqual(response['Successful'], [{'Id': '0'}])
+        self.assertEqual(response['Failed'][0]['Id'], '1')
+        self.assertEqual(len(self.queue), 0)
+
+    def test_visibility_can_be_changed(self):
+        self.queue.send_message(MessageBody='a')
+        msg, = self.queue.receive_messages()
+        msg.change_visibility(VisibilityTimeout=0)
+        self.assertEqual(len(self.queue.receive_messages()), 1)
+
+    def test_closed_queues_are_exhausted_once_empty(self):
+        self.queue.send_message(MessageBody='a')
+        self.queue.close()
+        self.assertFalse(self.queue.exhausted)
+        self.queue.receive_messages()[0].delete()
+        self.assertTrue(self.queue.exhausted)
+
+    def test_receive_waits_for_messages(self):
+        queue = MemoryQueue()
+        threading.Timer(0.01, queue.send_message, kwargs={'MessageBody': 'a'}).start()
+        msg, = queue.receive_messages(WaitTimeSeconds=5)
+        self.assertEqual(msg.body, 'a')
+
+    def test_receive_waits_for_hidden_messages(self):
+        queue = MemoryQueue()
+        queue.send_message(MessageBody='a')
+        queue.receive_messages(VisibilityTimeout=0.01)
+        msg, = queue.receive_messages(WaitTimeSeconds=5)
+        self.assertEqual(msg.body, 'a')
+
+    def test_receive_gives_up_after_wait_time(self):
+        self.assertEqual(MemoryQueue().receive_messages(WaitTimeSeconds=0.01), [])
+
+
+class JSONLinesQueueTest(unittest.TestCase):
+    def test_lines_are_received_as_messages(self):
+        body = json.dumps({'Message': json.dumps({'event': 'delete', 'uid': 'abc'})})
+        queue = JSONLinesQueue(io.StringIO(body + '\n\n'))
+        msg, = queue.receive_messages(MaxNumberOfMessages=10)
+        self.assertEqual(msg.body, body)
+        self.assertEqual(len(msg.message_id), 40)
+
+    def test_bare_events_are_wrapped_in_message_bodies(self):
+        queue = JSONLinesQueue(io.StringIO('{"event": "delete", "uid": "abc"}\njunk\n'))
+        first, second = queue.receive_messages(MaxNumberOfMessages=10)
+        self.assertEqual(json.loads(json.loads(first.body)['Message']),
+                         {'event': 'delete', 'uid': 'abc'})
+        self.assertEqual(second.body, 'junk')
+
+    def test_file_is_read_lazily(self):
+        queue = JSONLinesQueue(io.StringIO('1\n2\n3\n'), buffer_size=2)
+        self.assertEqual(len(queue.receive_messages(MaxNumberOfMessages=10)), 2)
+        self.assertFalse(queue.closed)
+
+    def test_queue_is_exhausted_once_file_is_processed(self):
+        queue = JSONLinesQueue(io.StringIO('1\n'))
+        for msg in queue.receive_messages():
+            msg.delete()
+        self.assertEqual(queue.receive_messages(), [])
+        self.assertTrue(queue.exhausted)
+
+
+class JSONLinesWriterTest(unittest.TestCase):
+    def test_message_bodies_are_written_as_lines(self):
+        output = io.StringIO()
+        writer = JSONLinesWriter(output)
+        writer.send_message(MessageBody='a', MessageAttributes={})
+        writer.send_message(MessageBody='b')
+        self.assertEqual(output.getvalue(), 'a\nb\n')
+
+
+class SQSQueueTest(unittest.TestCase):
+    def setUp(self):
+        resource = mock.Mock(url='https://sqs/queue')
+        self.client = resource.meta.client
+        self.queue = SQSQueue.from_resource(resource)
+        self.client.receive_message.return_value = {'Messages': [{
+            'MessageId': '1', 'Body': 'body', 'ReceiptHandle': 'h1',
+            'Attributes': {'ApproximateReceiveCount': '2'}}]}
+
+    def test_calls_go_through_the_client(self):
+        entries = [{'Id': '0', 'ReceiptHandle': 'h1'}]
+        self.queue.send_message(MessageBody='body')
+        self.queue.delete_messages(Entries=entries)
+        self.queue.change_message_visibility_batch(Entries=entries)
+        self.client.send_message.assert_called_with(QueueUrl='https://sqs/queue',
+                                                    MessageBody='body')
+        self.client.delete_message_batch.assert_called_with(QueueUrl='https://sqs/queue',
+                                                            Entries=entries)
+        self.client.change_message_visibility_batch.assert_called_with(
+            QueueUrl='https://sqs/queue', Entries=entries)
+
+    def test_attributes_are_fetched_once(self):
+        self.client.get_queue_attributes.return_value = {
+            'Attributes': {'VisibilityTimeout': '30'}}
+        self.assertEqual(self.queue.attributes, {'VisibilityTimeout': '30'})
+        self.assertEqual(self.queue.attributes, {'VisibilityTimeout': '30'})
+        self.client.get_queue_attributes.assert_called_once_with(
+            QueueUrl='https://sqs/queue', AttributeNames=['All'])
+
+    def test_received_messages_are_wrapped(self):
+        [msg] = self.queue.receive_messages(MaxNumberOfMessages=10)
+        self.client.receive_message.assert_called_with(QueueUrl='https://sqs/queue',
+                                                       MaxNumberOfMessages=10)
+        self.assertEqual((msg.message_id, msg.body, msg.receipt_handle),
+                         ('1', 'body', 'h1'))
+        self.assertEqual(msg.attributes, {'ApproximateReceiveCount': '2'})
+
+        msg.change_visibility(VisibilityTimeout=0)
+        self.client.change_message_visibility.assert_called_with(
+            QueueUrl='https://sqs/queue', ReceiptHandle='h1', VisibilityTimeout=0)
+        msg.delete()
+        self.client.delete_message.assert_called_with(QueueUrl='https://sqs/queue',
+                                                      ReceiptHandle='h1')
+
+    def test_empty_receives_return_no_message(self):
+        self.client.receive_message.return_value = {}
+        self.assertEqual(self.queue.receive_messages(), [])
@@ -0,0 +1,229 @@
+import json
+import threading
+import unittest
+
+import mock
+import requests
+from fxa import errors as fxa_errors
+
+from kinto_fxa.failover import EndpointStats, FailoverOAuthClient, HedgeScheduler
+from kinto_fxa.utils import verification_cache_key
+
+
+class FakeClient(object):
+    def __init__(self, server_url):
+        self.server_url = server_url
+        self.verify_token = mock.Mock(return_value={'user': server_url})
+
+
+class EndpointStatsTest(unittest.TestCase):
+    def test_average_is_weighted_towards_recent_latencies(self):
+        stats = EndpointStats(alpha=0.5)
+        stats.record(1)
+        self.assertEqual(stats.average, 1)
+        stats.record(3)
+        self.assertEqual(stats.average, 2)
+
+    def test_percentile_of_recent_latencies(self):
+        stats = EndpointStats(window=10)
+        self.assertIsNone(stats.percentile(95))
+        for i in range(20):
+            stats.record(i)
+        self.assertEqual(stats.percentile(50), 15)
+        self.assertEqual(stats.percentile(100), 19)
+
+
+class FailoverOAuthClientTest(unittest.TestCase):
+    def setUp(self):
+        self.client = FailoverOAuthClient(['a', 'b'], client_factory=FakeClient,
+                                          clock=lambda: 0)
+        self.a, self.b = self.client.clients
+
+    def test_fastest_endpoint_is_used(self):
+        self.client.stats[0].record(1)
+        self.client.stats[1].record(0.1)
+        self.assertEqual(self.client.verify_token('token', scope='profile'), {'user': 'b'})
+        self.b.verify_token.assert_called_with(token='token', scope='profile')
+        self.assertFalse(self.a.verify_token.called)
+
+    def test_other_endpoints_are_explored(self):
+        self.client.explore_every = 2
+        results = [self.client.verify_token('token')['user'] for _ in range(4)]
+        self.assertEqual(sorted(results), ['a', 'a', 'b', 'b'])
+
+    def test_every_endpoint_is_explored_in_turn(self):
+        client = FailoverOAuthClient(['a', 'b', 'c'], client_factory=FakeClient,
+                                     clock=lambda: 0)
+        client.explore_every = 2
+        client.stats[1].record(0.1)
+        client.stats[2].record(client.failure_penalty)
+        results = [client.verify_token('token')['user'] for _ in range(4)]
+        self.assertEqual(results, ['a', 'b', 'a', 'c'])
+
+    def test_fails_over_to_next_endpoint(self):
+        self.a.verify_token.side_effect = requests.exceptions.ConnectionError
+        self.assertEqual(self.client.verify_token('token'), {'user': 'b'})
+        # The failing endpoint is penalized.
+        self.assertEqual(self.client.stats[0].average, self.client.failure_penalty)
+
+    def test_raises_if_every_endpoint_fails(self):
+        self.a.verify_token.side_effect = fxa_errors.OutOfProtocolError
+        self.b.verify_token.side_effect = fxa_errors.ServerError({})
+        with self.assertRaises(fxa_errors.ServerError):
+            self.client.verify_token('token')
+
+    def test_invalid_tokens_are_not_verified_again(self):
+        self.a.verify_token.side_effect = fxa_errors.ClientError({})
+        with self.assertRaises(fxa_errors.ClientError):
+            self.client.verify_token('token')
+        self.assertFalse(self.b.verify_token.called)
+
+    def test_verifications_are_cached_with_pyfxa_keys(self):
+        cache = mock.Mock()
+        cache.get.return_value = None
+        self.client.cache = cache
+        self.client.verify_token('token', scope='profile')
+        key = verification_cache_key('token', 'profile')
+        cache.set.assert_called_with(key, json.dumps({'user': 'a'}))
+
+        cache.get.return_value = json.dumps({'user': 'cached'})
+        self.assertEqual(self.client.verify_token('token', scope='profile'), {'user': 'cached'})
+        cache.get.assert_called_with(key)
+
+
+class HedgedOAuthClientTest(unittest.TestCase):
+    def build(self, urls):
+        client = FailoverOAuthClient(urls, hedge_percentile=95, hedge_min_delay=0.01,
+                                     client_factory=FakeClient)
+        self.addCleanup(client._executor.shutdown)
+        return client
+
+    def test_fast_answers_are_not_hedged(self):
+        client = self.build(['a', 'b'])
+        self.assertEqual(client.verify_token('token'), {'user': 'a'})
+        self.assertFalse(client.clients[1].verify_token.called)
+
+    def time_out_once_hedged(self, hedged):
+        def verify_token(**kwargs):
+            hedged.wait(5)
+            raise requests.exceptions.Timeout
+        return verify_token
+
+    def test_slow_failures_are_hedged_to_next_endpoint(self):
+        client = self.build(['a', 'b'])
+        hedged = threading.Event()
+        client.clients[0].verify_token.side_effect = self.time_out_once_hedged(hedged)
+        client.clients[1].verify_token.side_effect = lambda **kw: hedged.set() or {'user': 'b'}
+        self.assertEqual(client.verify_token('token'), {'user': 'b'})
+        self.assertEqual(client.clients[1].verify_token.call_count, 1)
+
+    def test_slow_failures_are_hedged_to_same_endpoint_if_single(self):
+        client = self.build(['a'])
+        hedged = threading.Event()
+        answers = iter([self.time_out_once_hedged(hedged),
+                        lambda **kw: hedged.set() or {'user': 'hedged'}])
+        client.clients[0].verify_token.side_effect = lambda **kw: next(answers)(**kw)
+        self.assertEqual(client.verify_token('token'), {'user': 'hedged'})
+
+    def test_first_request_is_sent_from_the_caller_thread(self):
+        client = self.build(['a', 'b'])
+        threads = []
+        client.clients[0].verify_token.side_effect = (
+            lambda **kw: threads.append(threading.current_thread()) or {'user': 'a'})
+        client.verify_token('token')
+        self.assertEqual(threads, [threading.current_thread()])
+
+    def test_hedges_fail_over_to_the_next_endpoints(self):
+        client = self.build(['a', 'b', 'c'])
+        hedged = threading.Event()
+        client.clients[0].verify_token.side_effect = self.time_out_once_hedged(hedged)
+
+        def fail(**kwargs):
+            hedged.set()
+            raise requests.exceptions.ConnectionError
+        client.clients[1].verify_token.side_effect = fail
+        self.assertEqual(client.verify_token('token'), {'user': 'c'})
+
+    def test_raises_if_hedge_fails_too(self):
+        client = self.build(['a', 'b'])
+        hedged = threading.Event()
+        client.clients[0].verify_token.side_effect = self.time_out_once_hedged(hedged)
+
+        def fail(**kwargs):
+            hedged.set()
+            raise fxa_errors.OutOfProtocolError
+        client.clients[1].verify_token.side_effect = fail
+        with self.assertRaises(fxa_errors.OutOfProtocolError):
+            client.verify_token('token')
+
+    def test_requests_are_not_hedged_when_pool_is_saturated(self):
+        client = self.build(['a', 'b'])
+        client._hedges.max_running = 0
+        threads = []
+        client.clients[0].verify_token.side_effect = requests.exceptions.Timeout
+        client.clients[1].verify_token.side_effect = (
+            lambda **kw: threads.append(threading.current_thread()) or {'user': 'b'})
+        self.assertEqual(client.verify_token('token'), {'user': 'b'})
+        self.assertEqual(threads, [threading.current_thread()])
+
+    def test_hedge_delay_follows_latency_percentile(self):
+        client = self.build(['a'])
+        self.assertEqual(client._hedge_delay(0), 0.01)
+        for _ in range(10):
+            client.stats[0].record(0.2)
+        self.assertEqual(client._hedge_delay(0), 0.2)
+
+    def test_failed_requests_fail_over_without_waiting(self):
+        client = self.build(['a', 'b', 'c'])
+        client.clients[0].verify_token.side_effect = requests.exceptions.Timeout
+        client.clients[1].verify_token.side_effect = requests.exceptions.Timeout
+        self.assertEqual(client.verify_token('token'), {'user': 'c'})
+
+    def test_raises_if_every_endpoint_fails(self):
+        client = self.build(['a', 'b'])
+        for fake in client.clients:
+            fake.verify_token.side_effect = fxa_errors.OutOfProtocolError
+        with self.assertRaises(fxa_errors.OutOfProtocolError):
+            client.verify_token('token')
+
+    def test_answers_of_hedged_requests_are_final(self):
+        client = self.build(['a', 'b'])
+        client.clients[0].verify_token.side_effect = fxa_errors.TrustError
+        with self.assertRaises(fxa_errors.TrustError):
+            client.verify_token('token')
+
+
+class HedgeSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.executor = mock.Mock()
+        self.scheduler = HedgeScheduler(self.executor, max_running=1)
+
+    def test_hedges_are_submitted_after_their_delay(self):
+        submitted = threading.Event()
+        self.executor.submit.side_effect = lambda fn, *args: submitted.set() or mock.Mock()
+        hedge = self.scheduler.schedule(0.01, 'fn', 'arg')
+        self.assertTrue(submitted.wait(5))
+        self.executor.submit.assert_called_with('fn', 'arg')
+        self.assertIs(hedge.cancel(), hedge.future)
+        self.assertFalse(hedge.cancelled)
+
+    def test_cancelled_hedges_are_not_submitted(self):
+        later = self.scheduler.schedule(5, 'later')
+        self.assertIsNone(later.cancel())
+        submitted = threading.Event()
+        self.executor.submit.side_effect = lambda fn, *args: submitted.set() or mock.Mock()
+        self.scheduler.schedule(0, 'now')
+        self.assertTrue(submitted.wait(5))
+        self.executor.submit.assert_called_once_with('now')
+
+    def test_hedges_are_not_scheduled_beyond_max_running(self):
+        future = mock.Mock()
+        submitted = threading.Event()
+        self.executor.submit.side_effect = lambda fn, *args: submitted.set() or future
+        self.scheduler.schedule(0, 'fn')
+        self.assertTrue(submitted.wait(5))
+        self.assertIsNone(self.scheduler.schedule(0, 'fn'))
+        # Once done, they don't count anymore.
+        [done] = future.add_done_callback.call_args[0]
+        done(future)
+        self.assertIsNotNone(self.scheduler.schedule(0, 'fn'))
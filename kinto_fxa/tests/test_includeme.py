@@ -43,3 +43,17 @@ class IncludeMeTest(unittest.TestCase):
         self.assertEqual(settings['fxa-oauth.requested_scope'], 'kinto')
         self.assertIn('fxa-oauth.required_scope', settings)
         self.assertEqual(settings['fxa-oauth.required_scope'], 'kinto')
+
+    def test_include_fails_if_settings_are_invalid(self):
+        config = Configurator(settings={'fxa-oauth.cache_ttl_seconds': 'abc'})
+        kinto.core.initialize(config, '0.0.1')
+        with self.assertRaises(ConfigurationError):
+            config.include(includeme)
+
+    def test_principal_indexer_is_subscribed_if_enabled(self):
+        config = Configurator(settings={'fxa-oauth.principal_index.enabled': 'true'})
+        kinto.core.initialize(config, '0.0.1')
+        with mock.patch('kinto_fxa.PrincipalIndexer') as indexer:
+            config.include(includeme)
+            config.commit()
+        indexer.assert_called_with(config.get_settings())
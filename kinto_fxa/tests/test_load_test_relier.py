@@ -0,0 +1,71 @@
+import mock
+import unittest
+
+from kinto.core.utils import random_bytes_hex
+
+from kinto_fxa.scripts.load_test_relier import build_app, load_test_relier, run_flow
+
+
+def app_settings():
+    return {
+        'includes': 'kinto_fxa',
+        'multiauth.policies': 'fxa',
+        'multiauth.policy.fxa.use': 'kinto_fxa.authentication.FxAOAuthAuthenticationPolicy',
+        'userid_hmac_secret': random_bytes_hex(16),
+        'kinto.fxa-oauth.oauth_uri': 'https://oauth.accounts.firefox.com/v1',
+        'fxa-oauth.client_id': 'abc',
+    }
+
+
+class BuildAppTest(unittest.TestCase):
+    def test_fxa_server_and_cache_backend_are_overridden(self):
+        _, registry = build_app(app_settings(), 'http://127.0.0.1:1234/v1',
+                                'https://relier.example.com/', cache_url='memory://',
+                                cache_backend='kinto.core.cache.memory')
+        settings = registry._fxa_oauth_settings
+        self.assertEqual(settings.oauth_uri, 'http://127.0.0.1:1234/v1')
+        self.assertEqual(settings.authorized_domains, ('relier.example.com',))
+        self.assertEqual(settings.client_id, 'abc')
+        self.assertEqual(settings.client_secret, 'load-test')
+        self.assertEqual(registry.settings['cache_url'], 'memory://')
+
+
+class RunFlowTest(unittest.TestCase):
+    def setUp(self):
+        self.redirect = 'https://relier.example.com/'
+        self.app, _ = build_app(app_settings(), 'http://127.0.0.1:1234/v1', self.redirect)
+        self.latencies = {'login': [], 'authorization': [], 'token': []}
+
+    def test_failed_login_is_raised(self):
+        with self.assertRaisesRegex(ValueError, 'Login failed with 400'):
+            run_flow(self.app, '/v1', 'https://unknown.example.com/', self.latencies)
+
+    def test_failed_token_is_raised(self):
+        with mock.patch('kinto_fxa.scripts.load_test_relier.requests.get') as get:
+            get.return_value.json.return_value = {'code': 'abc', 'state': 'unknown'}
+            with self.assertRaisesRegex(ValueError, 'Token failed with 408'):
+                run_flow(self.app, '/v1', self.redirect, self.latencies)
+        self.assertEqual(len(self.latencies['authorization']), 1)
+        self.assertEqual(self.latencies['token'], [])
+
+
+class LoadTestRelierTest(unittest.TestCase):
+    def test_flows_go_through_every_step(self):
+        result = load_test_relier(app_settings(), flows=6, concurrency=2,
+                                  cache_backend='kinto.core.cache.memory')
+        self.assertEqual(result.flows, 6)
+        self.assertEqual(result.failures, {})
+        self.assertGreater(result.flows_per_second, 0)
+        self.assertEqual(sorted(result.latencies), ['authorization', 'login', 'token'])
+        self.assertGreater(result.latencies['token'].p99, 0)
+        # The state is stored on login, and read then deleted on callback.
+        self.assertEqual(result.cache_operations, {'get': 6, 'set': 6, 'delete': 6})
+
+    def test_failed_flows_are_counted(self):
+        with mock.patch('kinto_fxa.scripts.load_test_relier.run_flow',
+                        side_effect=ValueError):
+            result = load_test_relier(app_settings(), flows=3,
+                                      cache_backend='kinto.core.cache.memory')
+        self.assertEqual(result.flows, 0)
+        self.assertEqual(result.failures, {'ValueError': 3})
+        self.assertEqual(result.latencies['login'].p50, 0)
@@ -0,0 +1,62 @@
+import mock
+import unittest
+import urllib.error
+import urllib.request
+
+from kinto_fxa.scripts.metrics import ConsumerMetrics, serve_metrics
+
+
+class ConsumerMetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.statsd = mock.Mock()
+        self.metrics = ConsumerMetrics(statsd=self.statsd, clock=lambda: self.now)
+
+    def test_counts_are_forwarded_to_statsd(self):
+        self.metrics.count('events')
+        self.metrics.count('events', 3)
+        self.statsd.count.assert_called_with('events', 3)
+        self.assertIn('events_total 4\n', self.metrics.render())
+
+    def test_timings_are_sent_in_milliseconds(self):
+        timer = self.statsd.timer.return_value
+        self.metrics.timing('phase', 0.25)
+        self.statsd.timer.assert_called_with('phase')
+        self.assertEqual(timer.ms, 250)
+        timer.send.assert_called_with()
+
+    def test_timer_can_decorate_functions(self):
+        @self.metrics.timer('phase')
+        def phase():
+            self.now += 2
+            return 'result'
+
+        self.assertEqual(phase(), 'result')
+        rendered = self.metrics.render()
+        self.assertIn('phase_seconds_count 1\n', rendered)
+        self.assertIn('phase_seconds_sum 2.0\n', rendered)
+
+    def test_gauges_are_kept_in_memory(self):
+        self.metrics.gauge('in-flight', 3)
+        self.metrics.gauge('in-flight', 1)
+        self.assertIn('# TYPE in_flight gauge\nin_flight 1\n', self.metrics.render())
+        self.assertFalse(self.statsd.gauge.called)
+
+
+class ServeMetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = ConsumerMetrics()
+        self.server = serve_metrics(self.metrics, 0)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def test_metrics_are_served(self):
+        self.metrics.count('events')
+        with urllib.request.urlopen(self.url + '/metrics') as response:
+            self.assertIn(b'events_total 1\n', response.read())
+
+    def test_other_paths_are_not_found(self):
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            urllib.request.urlopen(self.url + '/')
+        self.assertEqual(cm.exception.code, 404)
@@ -0,0 +1,146 @@
+import mock
+import unittest
+
+from kinto.core.permission import memory as memory_permission
+from kinto.core.storage import memory as memory_storage
+
+from kinto_fxa.principal_index import (
+    PrincipalIndex,
+    PrincipalIndexer,
+    object_location,
+    purge_principals,
+    rebuild_principal_index,
+)
+from kinto_fxa.scripts.rebuild_principal_index import rebuild_index
+
+
+SETTINGS = {
+    'multiauth.policy.fxa.use': 'kinto_fxa.authentication.FxAOAuthAuthenticationPolicy',
+    'fxa-oauth.clients.notes.client_id': 'a',
+}
+
+
+class PrincipalIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = mock.Mock()
+        self.registry.settings = SETTINGS
+        self.storage = self.registry.storage = memory_storage.Storage()
+        self.permission = self.registry.permission = memory_permission.Permission()
+        self.index = PrincipalIndex(self.storage)
+
+    def create(self, uri, writers, **permissions):
+        resource_name, parent_id, object_id = object_location(uri)
+        self.storage.create(resource_name, parent_id, {'id': object_id})
+        permissions['write'] = writers
+        self.permission.replace_object_permissions(uri, permissions)
+
+    def exists(self, uri):
+        resource_name, parent_id, object_id = object_location(uri)
+        return any(obj['id'] == object_id
+                   for obj in self.storage.list_all(resource_name, parent_id))
+
+    def test_object_location(self):
+        self.assertEqual(object_location('/buckets/b'), ('bucket', '', 'b'))
+        self.assertEqual(object_location('/buckets/b/collections/c/records/r'),
+                         ('record', '/buckets/b/collections/c', 'r'))
+
+    def test_lookup_returns_indexed_uris(self):
+        self.index.add('fxa:abc', ['/buckets/b', '/buckets/b'])
+        self.assertEqual(self.index.lookup('fxa:abc'), ['/buckets/b'])
+        self.assertEqual(self.index.lookup('fxa:def'), [])
+
+    def test_only_matching_writers_are_indexed(self):
+        self.index.index_permissions(['/buckets/b'],
+                                     [{'write': {'fxa:abc', 'basicauth:x'},
+                                       'read': {'fxa:def'}}], 'fxa:')
+        self.assertEqual(self.index.lookup('fxa:abc'), ['/buckets/b'])
+        self.assertEqual(self.index.lookup('fxa:def'), [])
+        self.assertEqual(self.index.lookup('basicauth:x'), [])
+
+    def test_indexer_indexes_impacted_objects(self):
+        indexer = PrincipalIndexer(SETTINGS)
+        self.create('/buckets/b/collections/c1', {'fxa:abc'})
+        self.create('/buckets/b/collections/c2', {'fxa:abc-notes'})
+        event = mock.Mock(payload={'uri': '/buckets/b/collections',
+                                   'resource_name': 'collection'},
+                          impacted_objects=[{'new': {'id': 'c1'}}, {'new': {'id': 'c2'}}])
+        event.request.registry = self.registry
+        indexer(event)
+
+        event.payload['uri'] = '/buckets/b/collections/c1'
+        event.impacted_objects = [{'new': {'id': 'c1'}}]
+        indexer(event)
+
+        self.assertEqual(self.index.lookup('fxa:abc'), ['/buckets/b/collections/c1'])
+        self.assertEqual(self.index.lookup('fxa:abc-notes'), ['/buckets/b/collections/c2'])
+
+    def test_rebuild_walks_every_object(self):
+        self.index.add('fxa:stale', ['/buckets/gone'])
+        self.create('/buckets/b', {'fxa:abc'})
+        self.create('/buckets/b/groups/g', {'fxa:def'})
+        self.create('/buckets/b/collections/c', {'fxa:abc'})
+        self.create('/buckets/b/collections/c/records/r', {'fxa:def'})
+
+        count = rebuild_principal_index(self.registry, batch_size=2)
+
+        self.assertEqual(count, 4)
+        self.assertEqual(sorted(self.index.lookup('fxa:abc')),
+                         ['/buckets/b', '/buckets/b/collections/c'])
+        self.assertEqual(sorted(self.index.lookup('fxa:def')),
+                         ['/buckets/b/collections/c/records/r', '/buckets/b/groups/g'])
+        self.assertEqual(self.index.lookup('fxa:stale'), [])
+
+    def test_purge_deletes_owned_objects_with_descendants(self):
+        self.create('/buckets/b', {'fxa:abc'})
+        self.create('/buckets/b/collections/c', {'fxa:abc-notes'})
+        self.create('/buckets/b/collections/c/records/r', {'fxa:abc'})
+        rebuild_principal_index(self.registry)
+
+        deleted, revoked = purge_principals(self.registry, ['fxa:abc', 'fxa:abc-notes'])
+
+        self.assertEqual((deleted, revoked), (1, 0))
+        self.assertFalse(self.exists('/buckets/b'))
+        self.assertFalse(self.exists('/buckets/b/collections/c/records/r'))
+        self.assertEqual(self.permission.get_object_permissions('/buckets/b/collections/c'), {})
+        self.assertEqual(self.index.lookup('fxa:abc'), [])
+
+    def test_purge_revokes_permissions_on_shared_objects(self):
+        self.create('/buckets/b', {'fxa:abc', 'fxa:def'}, read={'fxa:abc', 'system.Everyone'})
+        self.create('/buckets/b/collections/c', {'fxa:abc'})
+        rebuild_principal_index(self.registry)
+
+        deleted, revoked = purge_principals(self.registry, ['fxa:abc'])
+
+        self.assertEqual((deleted, revoked), (1, 1))
+        self.assertTrue(self.exists('/buckets/b'))
+        self.assertFalse(self.exists('/buckets/b/collections/c'))
+        self.assertEqual(self.permission.get_object_permissions('/buckets/b'),
+                         {'write': {'fxa:def'}, 'read': {'system.Everyone'}})
+
+    def test_purge_ignores_stale_entries(self):
+        self.create('/buckets/b', {'fxa:def'})
+        self.index.add('fxa:abc', ['/buckets/b', '/buckets/gone'])
+
+        self.assertEqual(purge_principals(self.registry, ['fxa:abc']), (0, 0))
+        self.assertTrue(self.exists('/buckets/b'))
+
+    def test_purge_deletes_permissions_of_missing_objects(self):
+        self.permission.replace_object_permissions('/buckets/gone', {'write': {'fxa:abc'}})
+        self.index.add('fxa:abc', ['/buckets/gone'])
+
+        self.assertEqual(purge_principals(self.registry, ['fxa:abc']), (1, 0))
+        self.assertEqual(self.permission.get_object_permissions('/buckets/gone'), {})
+
+    def test_purge_without_entries_does_nothing(self):
+        self.assertEqual(purge_principals(self.registry, ['fxa:abc']), (0, 0))
+
+
+class RebuildIndexScriptTest(unittest.TestCase):
+    @mock.patch('kinto_fxa.scripts.rebuild_principal_index.current_transaction')
+    @mock.patch('kinto_fxa.scripts.rebuild_principal_index.rebuild_principal_index')
+    def test_index_is_rebuilt_and_committed(self, rebuild_principal_index, transaction):
+        rebuild_principal_index.return_value = 3
+        registry = mock.Mock()
+        self.assertEqual(rebuild_index({'registry': registry}, batch_size=10), 3)
+        rebuild_principal_index.assert_called_with(registry, batch_size=10)
+        transaction.commit.assert_called_with()
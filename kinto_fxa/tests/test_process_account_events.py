@@ -1,12 +1,39 @@
+import io
 import json
 import mock
+import os
+import signal
+import threading
+import time
 import unittest
+import uuid
+
+import transaction
+
+from kinto.core.cache import memory as memory_backend
+from kinto.core.permission import memory as memory_permission
+from kinto.core.storage import Filter, memory as memory_storage
+from kinto.core.utils import COMPARISON, hmac_digest
+
+from kinto_fxa import DEFAULT_SETTINGS
 
 from kinto_fxa.scripts.process_account_events import (
+    EventDeduplicator,
+    GracefulShutdown,
+    VisibilityHeartbeat,
+    back_off,
     get_default_bucket_id,
+    get_default_bucket_ids,
+    receive_messages,
+    release_messages,
     process_account_event,
     process_account_events,
+    replay_account_events,
 )
+from kinto_fxa.authentication import (
+    TokenVerificationCache, user_generation_cache_key, verification_cache_key)
+from kinto_fxa.scripts.metrics import ConsumerMetrics
+from kinto_fxa.utils import FxAOAuthSettings
 
 
 class TestProcessAccountEvent(unittest.TestCase):
@@ -15,6 +42,10 @@ class TestProcessAccountEvent(unittest.TestCase):
         self.registry.settings = {
             'userid_hmac_secret': 'efghi'
         }
+        self.registry._fxa_oauth_settings = FxAOAuthSettings.from_settings(DEFAULT_SETTINGS)
+        self.registry._fxa_oauth_clients.userid_suffixes = ('',)
+        self.registry.cache = memory_backend.Cache(cache_prefix="tests",
+                                                   cache_max_size_bytes=float("inf"))
         self.config = {"registry": self.registry}
         self.uid = 'abcd'
         # Computed this by hand in the Python terminal
@@ -57,12 +88,50 @@ class TestProcessAccountEvent(unittest.TestCase):
             "rezone"
         )
 
+    def _cache_verification(self, token):
+        self.verifications = TokenVerificationCache(self.registry.cache, ttl=60)
+        key = verification_cache_key(token, 'profile')
+        self.verifications.set(key, json.dumps({'user': self.uid, 'scope': ['profile']}))
+        return key
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.delete_accounts')
+    def test_cached_token_verifications_are_invalidated_on_deletion(self, delete_accounts):
+        key = self._cache_verification('token')
+        process_account_event(self.config, self.real_message)
+        self.assertIsNone(self.verifications.get(key))
+
+    def test_cached_token_verifications_are_invalidated_on_password_change(self):
+        for event_type in ('passwordChange', 'passwordReset'):
+            key = self._cache_verification('token')
+            process_account_event(self.config, json.dumps({
+                "Message": json.dumps({"event": event_type, "uid": self.uid})}))
+            self.assertIsNone(self.verifications.get(key))
+        self.assertFalse(self.registry.storage.delete_all.called)
+
+    def test_invalidation_is_kept_as_long_as_cached_verifications(self):
+        self.registry._fxa_oauth_settings = self.registry._fxa_oauth_settings.replace(
+            cache_ttl_seconds=3600)
+        process_account_event(self.config, json.dumps({
+            "Message": json.dumps({"event": "passwordChange", "uid": self.uid})}))
+        key = user_generation_cache_key(self.uid)
+        self.assertEqual(self.registry.cache.ttl(key), 3600)
+
+    def test_tokens_are_not_invalidated_without_cache_backend(self):
+        self.registry.cache = None
+        process_account_event(self.config, json.dumps({
+            "Message": json.dumps({"event": "passwordChange", "uid": self.uid})}))
+
     def test_get_default_bucket_id(self):
         self.assertEqual(get_default_bucket_id(self.config, self.uid),
                          self.bucket_id)
 
-    @mock.patch('kinto_fxa.scripts.process_account_events.get_default_bucket_id')
-    def test_each_configured_client_is_taken_into_account(self, get_default_bucket_id):
+    def test_get_default_bucket_ids_matches_kinto_derivation(self):
+        uids = [self.uid, 'ffxxaa:abcd-notes', 'é']
+        expected = [str(uuid.UUID(hmac_digest('efghi', uid)[:32])) for uid in uids]
+        self.assertEqual(get_default_bucket_ids(self.config, uids), expected)
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.get_default_bucket_ids')
+    def test_each_configured_client_is_taken_into_account(self, get_default_bucket_ids):
         self.registry.settings = {
             'multiauth.policies': 'ffxxaa',
             'multiauth.policy.ffxxaa.use': 'kinto_fxa.authentication.FxAOAuthAuthenticationPolicy',
@@ -71,43 +140,76 @@ class TestProcessAccountEvent(unittest.TestCase):
             'fxa-oauth.clients.lockbox.client_id': 'b',
             'fxa-oauth.clients.lockbox.required_scope': 'b-b',
         }
+        self.registry._fxa_oauth_clients.userid_suffixes = ('', '-notes', '-lockbox')
 
         process_account_event(self.config, self.real_message)
 
-        user_ids = [c[0][1] for c in get_default_bucket_id.call_args_list]
+        user_ids = get_default_bucket_ids.call_args[0][1]
         assert 'ffxxaa:abcd' in user_ids
         assert 'ffxxaa:abcd-notes' in user_ids
         assert 'ffxxaa:abcd-lockbox' in user_ids
 
-    @mock.patch('kinto_fxa.scripts.process_account_events.get_default_bucket_id')
-    def test_valid_message_calls_deletes(self, get_default_bucket_id):
-        get_default_bucket_id.return_value = 'some_fxa_bucket'
+    @mock.patch('kinto_fxa.scripts.process_account_events.purge_principals')
+    def test_other_objects_are_purged_if_principal_index_is_enabled(self, purge_principals):
+        process_account_event(self.config, self.real_message)
+        self.assertFalse(purge_principals.called)
+
+        self.registry._fxa_oauth_settings = self.registry._fxa_oauth_settings.replace(
+            principal_index_enabled=True)
+        process_account_event(self.config, self.real_message)
+        purge_principals.assert_called_with(self.registry, ['abcd'])
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.get_default_bucket_ids')
+    def test_valid_message_calls_deletes(self, get_default_bucket_ids):
+        get_default_bucket_ids.return_value = ['some_fxa_bucket']
         process_account_event(self.config, self.real_message)
         self.registry.storage.delete_all.assert_any_call(
-            parent_id='/buckets/some_fxa_bucket',
-            collection_id=None,
+            parent_id='',
+            collection_id='bucket',
+            filters=[Filter('id', ['some_fxa_bucket'], COMPARISON.IN)],
             with_deleted=False,
         )
-        self.registry.storage.purge_deleted.assert_any_call(
-            parent_id='/buckets/some_fxa_bucket',
-            collection_id=None,
-        )
         self.registry.storage.delete_all.assert_any_call(
-            parent_id='/buckets/some_fxa_bucket/*',
+            parent_id='/buckets/some_fxa_bucket*',
             collection_id=None,
             with_deleted=False,
         )
         self.registry.storage.purge_deleted.assert_any_call(
-            parent_id='/buckets/some_fxa_bucket/*',
+            parent_id='/buckets/some_fxa_bucket*',
             collection_id=None,
         )
         self.registry.permission.delete_object_permissions.assert_any_call(
-            '/buckets/some_fxa_bucket',
-        )
-        self.registry.permission.delete_object_permissions.assert_any_call(
-            '/buckets/some_fxa_bucket/*',
+            '/buckets/some_fxa_bucket*',
         )
 
+    def test_descendants_of_deleted_buckets_are_deleted(self):
+        storage = memory_storage.Storage()
+        permission = memory_permission.Permission()
+        self.registry.storage = storage
+        self.registry.permission = permission
+        bucket_id = self.bucket_id
+        other_id = '819b8628-0230-7b89-46e8-a365d68a66d1'
+        for bid in (bucket_id, other_id):
+            storage.create('bucket', '', {'id': bid})
+            storage.create('collection', '/buckets/' + bid, {'id': 'c'})
+            storage.create('record', '/buckets/{}/collections/c'.format(bid), {'id': 'r'})
+            permission.add_principal_to_ace('/buckets/' + bid, 'write', 'alice')
+            permission.add_principal_to_ace('/buckets/{}/collections/c'.format(bid),
+                                            'write', 'alice')
+
+        process_account_event(self.config, self.real_message)
+
+        self.assertEqual([b['id'] for b in storage.list_all('bucket', '')], [other_id])
+        self.assertEqual(storage.list_all('collection', '/buckets/' + bucket_id), [])
+        self.assertEqual(
+            storage.list_all('record', '/buckets/{}/collections/c'.format(bucket_id)), [])
+        self.assertEqual(len(storage.list_all('record',
+                                              '/buckets/{}/collections/c'.format(other_id))), 1)
+        self.assertEqual(permission.get_object_permissions('/buckets/' + bucket_id), {})
+        self.assertEqual(permission.get_object_permissions(
+            '/buckets/{}/collections/c'.format(bucket_id)), {})
+        self.assertNotEqual(permission.get_object_permissions('/buckets/' + other_id), {})
+
 
 class TestProcessAccountEvents(unittest.TestCase):
     def setUp(self):
@@ -120,6 +222,13 @@ class TestProcessAccountEvents(unittest.TestCase):
 
         self.queue = mock.Mock()
         self.sqs.get_queue_by_name.return_value = self.queue
+        self.queue.attributes = {'VisibilityTimeout': '30'}
+        self.queue.delete_messages.return_value = {}
+        from_resource_patcher = mock.patch(
+            'kinto_fxa.scripts.process_account_events.SQSQueue.from_resource',
+            side_effect=lambda queue: queue)
+        self.from_resource = from_resource_patcher.start()
+        self.addCleanup(from_resource_patcher.stop)
 
         ec2_metadata_patcher = mock.patch('kinto_fxa.scripts.process_account_events.ec2_metadata')
         self.ec2 = ec2_metadata_patcher.start()
@@ -129,6 +238,11 @@ class TestProcessAccountEvents(unittest.TestCase):
         self.config = {"registry": self.registry}
         self.registry.statsd = None
 
+    def assertDeleted(self, *messages):
+        entries = [{'Id': str(i), 'ReceiptHandle': msg.receipt_handle}
+                   for i, msg in enumerate(messages)]
+        self.queue.delete_messages.assert_called_with(Entries=entries)
+
     @mock.patch('kinto_fxa.scripts.process_account_events.itertools')
     def test_gets_sqs_queue(self, itertools):
         itertools.count.return_value = [1]
@@ -137,7 +251,10 @@ class TestProcessAccountEvents(unittest.TestCase):
         process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23)
         self.boto3.resource.assert_called_with('sqs', region_name='my-aws-region')
         self.sqs.get_queue_by_name.assert_called_with(QueueName='my-queue-name')
-        self.queue.receive_messages.assert_called_with(WaitTimeSeconds=23)
+        self.from_resource.assert_called_with(self.queue)
+        self.queue.receive_messages.assert_called_with(
+            MaxNumberOfMessages=10, WaitTimeSeconds=23,
+            AttributeNames=['ApproximateReceiveCount', 'SentTimestamp'])
 
     @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
     @mock.patch('kinto_fxa.scripts.process_account_events.itertools.count')
@@ -148,8 +265,8 @@ class TestProcessAccountEvents(unittest.TestCase):
         self.queue.receive_messages.return_value = [message]
 
         process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23)
-        process_account_event.assert_called_with(self.config, 'my-body')
-        message.delete.assert_called_with()
+        process_account_event.assert_called_with(self.config, 'my-body', metrics=mock.ANY)
+        self.assertDeleted(message)
 
     @mock.patch('kinto_fxa.scripts.process_account_events.logger')
     @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
@@ -158,15 +275,237 @@ class TestProcessAccountEvents(unittest.TestCase):
             self, count, process_account_event, logger):
         count.return_value = [1]
 
-        message = mock.Mock(body="my-body")
+        message = mock.Mock(body="my-body", message_id='1', attributes={})
         self.queue.receive_messages.return_value = [message]
         process_account_event.side_effect = ValueError
 
+        process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23)
+
+        logger.exception.assert_called_with("Error while processing account event %r", '1')
+        message.delete.assert_not_called()
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.logger')
+    @mock.patch('kinto_fxa.scripts.process_account_events.itertools.count')
+    def test_errors_outside_of_messages_are_logged_and_raised(self, count, logger):
+        count.return_value = [1]
+        self.queue.attributes = mock.Mock()
+        self.queue.attributes.get.side_effect = ValueError
+
+        with self.assertRaises(ValueError):
+            process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23)
+
+        logger.exception.assert_called_with("Error while processing account events")
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.back_off')
+    @mock.patch('kinto_fxa.scripts.process_account_events.logger')
+    @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
+    @mock.patch('kinto_fxa.scripts.process_account_events.itertools.count')
+    def test_receive_errors_are_logged_and_retried(self, count, process_account_event,
+                                                   logger, back_off):
+        count.return_value = [1, 2, 3]
+        message = mock.Mock(body="my-body", message_id='1')
+        self.queue.receive_messages.side_effect = [ValueError, ValueError, [message]]
+
+        process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23)
+
+        logger.exception.assert_called_with("Error while receiving account events")
+        self.assertEqual([c[0][1] for c in back_off.call_args_list], [1, 2])
+        process_account_event.assert_called_with(self.config, 'my-body', metrics=mock.ANY)
+        self.assertDeleted(message)
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.back_off')
+    @mock.patch('kinto_fxa.scripts.process_account_events.logger')
+    @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
+    @mock.patch('kinto_fxa.scripts.process_account_events.itertools.count')
+    def test_delete_errors_are_logged_and_retried(self, count, process_account_event,
+                                                  logger, back_off):
+        count.return_value = [1, 2, 3]
+        message = mock.Mock(body="my-body", message_id='1')
+        self.queue.receive_messages.return_value = [message]
+        self.queue.delete_messages.side_effect = [ValueError, ValueError, {}]
+
+        process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23)
+
+        logger.exception.assert_called_with("Error while deleting account events")
+        self.assertEqual([c[0][1] for c in back_off.call_args_list], [1, 2])
+        self.assertEqual(self.queue.delete_messages.call_count, 3)
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.logger')
+    def test_connection_errors_are_logged_and_raised(self, logger):
+        self.sqs.get_queue_by_name.side_effect = ValueError
+
         with self.assertRaises(ValueError):
             process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23)
 
         logger.exception.assert_called_with("Error while processing account events")
 
+    @mock.patch('kinto_fxa.scripts.process_account_events.logger')
+    @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
+    @mock.patch('kinto_fxa.scripts.process_account_events.itertools.count')
+    def test_messages_that_could_not_be_deleted_are_logged(
+            self, count, process_account_event, logger):
+        count.return_value = [1]
+        message = mock.Mock(body="my-body", message_id='1')
+        self.queue.receive_messages.return_value = [message]
+        self.queue.delete_messages.return_value = {
+            'Failed': [{'Id': '0', 'Message': 'ReceiptHandleIsInvalid'}]}
+
+        process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23)
+
+        logger.warning.assert_called_with("Could not delete account event %r: %s",
+                                          '1', 'ReceiptHandleIsInvalid')
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
+    @mock.patch('kinto_fxa.scripts.process_account_events.itertools.count')
+    def test_failed_events_are_retried_with_exponential_backoff(
+            self, count, process_account_event):
+        count.return_value = [1]
+        process_account_event.side_effect = [ValueError, None]
+        failing = mock.Mock(body="my-body", message_id='1',
+                            attributes={'ApproximateReceiveCount': '3'})
+        following = mock.Mock(body="other-body", message_id='2', attributes={})
+        self.queue.receive_messages.return_value = [failing, following]
+
+        process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23,
+                               retry_backoff=10)
+
+        failing.change_visibility.assert_called_with(VisibilityTimeout=40)
+        failing.delete.assert_not_called()
+        # The consumer kept going.
+        self.assertDeleted(following)
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
+    @mock.patch('kinto_fxa.scripts.process_account_events.itertools.count')
+    def test_changes_of_failed_events_are_aborted(self, count, process_account_event):
+        count.return_value = [1]
+        failed_changes = mock.Mock(sortKey=lambda: 'failed')
+        changes = mock.Mock(sortKey=lambda: 'changes')
+
+        def process(config, body, metrics=None):
+            if body == 'failing':
+                transaction.get().join(failed_changes)
+                raise ValueError
+            transaction.get().join(changes)
+            transaction.commit()
+
+        process_account_event.side_effect = process
+        failing = mock.Mock(body="failing", message_id='1', attributes={})
+        following = mock.Mock(body="following", message_id='2', attributes={})
+        self.queue.receive_messages.return_value = [failing, following]
+
+        process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23)
+
+        self.assertTrue(failed_changes.abort.called)
+        self.assertFalse(failed_changes.commit.called)
+        self.assertTrue(changes.commit.called)
+        self.assertTrue(changes.tpc_finish.called)
+        self.assertDeleted(following)
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.logger')
+    @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
+    @mock.patch('kinto_fxa.scripts.process_account_events.itertools.count')
+    def test_failed_retries_are_logged(self, count, process_account_event, logger):
+        count.return_value = [1]
+        process_account_event.side_effect = [ValueError, None]
+        failing = mock.Mock(body="my-body", message_id='1', attributes={})
+        failing.change_visibility.side_effect = ValueError
+        following = mock.Mock(body="other-body", message_id='2', attributes={})
+        self.queue.receive_messages.return_value = [failing, following]
+
+        process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23)
+
+        logger.exception.assert_called_with("Could not delay the retry of account event %r",
+                                            '1')
+        self.assertDeleted(following)
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.logger')
+    @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
+    @mock.patch('kinto_fxa.scripts.process_account_events.itertools.count')
+    def test_failed_dead_letters_are_logged(self, count, process_account_event, logger):
+        count.return_value = [1]
+        self.registry.statsd = mock.Mock()
+        self.registry.statsd.timer.return_value = mock.Mock(side_effect=lambda f: f)
+        dead_letter_queue = mock.Mock()
+        dead_letter_queue.send_message.side_effect = ValueError
+        self.sqs.get_queue_by_name.side_effect = [self.queue, dead_letter_queue]
+        junk = mock.Mock(body="junk", message_id='1', attributes={})
+        body = json.dumps({"Message": json.dumps({"event": "delete", "uid": "abc"})})
+        following = mock.Mock(body=body, message_id='2', attributes={})
+        self.queue.receive_messages.return_value = [junk, following]
+
+        process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23,
+                               dead_letter_queue_name='my-dlq')
+
+        logger.exception.assert_called_with(
+            "Could not forward account event %r to dead-letter queue", '1')
+        junk.delete.assert_not_called()
+        self.assertNotIn(mock.call("process_account_event.dead_lettered"),
+                         self.registry.statsd.count.call_args_list)
+        process_account_event.assert_called_with(self.config, body, metrics=mock.ANY)
+        self.assertDeleted(following)
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
+    @mock.patch('kinto_fxa.scripts.process_account_events.itertools.count')
+    def test_failed_events_are_dead_lettered_after_max_attempts(
+            self, count, process_account_event):
+        count.return_value = [1]
+        self.registry.statsd = mock.Mock()
+        self.registry.statsd.timer.return_value = mock.Mock(side_effect=lambda f: f)
+        dead_letter_queue = mock.Mock()
+        self.sqs.get_queue_by_name.side_effect = [self.queue, dead_letter_queue]
+        process_account_event.side_effect = ValueError
+        body = json.dumps({"Message": json.dumps({"event": "delete", "uid": "abc"})})
+        message = mock.Mock(body=body, message_id='1',
+                            attributes={'ApproximateReceiveCount': '5'})
+        self.queue.receive_messages.return_value = [message]
+
+        process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23,
+                               max_attempts=5, dead_letter_queue_name='my-dlq')
+
+        self.sqs.get_queue_by_name.assert_called_with(QueueName='my-dlq')
+        _, kwargs = dead_letter_queue.send_message.call_args
+        self.assertEqual(kwargs['MessageBody'], body)
+        self.assertEqual(kwargs['MessageAttributes']['ReceiveCount']['StringValue'], '5')
+        message.delete.assert_called_with()
+        message.change_visibility.assert_not_called()
+        self.registry.statsd.count.assert_called_with("process_account_event.dead_lettered")
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
+    @mock.patch('kinto_fxa.scripts.process_account_events.itertools.count')
+    def test_backoff_is_capped_without_dead_letter_queue(self, count, process_account_event):
+        count.return_value = [1]
+        self.registry.statsd = mock.Mock()
+        self.registry.statsd.timer.return_value = mock.Mock(side_effect=lambda f: f)
+        process_account_event.side_effect = ValueError
+        message = mock.Mock(body="my-body", message_id='1',
+                            attributes={'ApproximateReceiveCount': '50'})
+        self.queue.receive_messages.return_value = [message]
+
+        process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23,
+                               max_attempts=20, retry_backoff=60)
+
+        message.change_visibility.assert_called_with(VisibilityTimeout=43200)
+        self.registry.statsd.count.assert_called_with("process_account_event.retried")
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
+    @mock.patch('kinto_fxa.scripts.process_account_events.itertools.count')
+    def test_invalid_messages_are_dead_lettered_right_away(
+            self, count, process_account_event):
+        count.return_value = [1]
+        dead_letter_queue = mock.Mock()
+        self.sqs.get_queue_by_name.side_effect = [self.queue, dead_letter_queue]
+        message = mock.Mock(body="junk", message_id='1', attributes=None)
+        self.queue.receive_messages.return_value = [message]
+
+        process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23,
+                               dead_letter_queue_name='my-dlq')
+
+        process_account_event.assert_not_called()
+        _, kwargs = dead_letter_queue.send_message.call_args
+        self.assertEqual(kwargs['MessageBody'], 'junk')
+        self.assertEqual(kwargs['MessageAttributes']['ReceiveCount']['StringValue'], '1')
+        message.delete.assert_called_with()
+
     @mock.patch('kinto_fxa.scripts.process_account_events.itertools')
     def test_gets_ec2_metadata_if_no_region_given(self, itertools):
         itertools.count.return_value = [1]
@@ -191,5 +530,436 @@ class TestProcessAccountEvents(unittest.TestCase):
         process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23)
         statsd.timer.assert_called_with('process_account_event')
         timer_wrapper.assert_called_with(process_account_event)
-        process_one.assert_called_with(self.config, 'my-body')
-        message.delete.assert_called_with()
+        process_one.assert_called_with(self.config, 'my-body', metrics=mock.ANY)
+        self.assertDeleted(message)
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.serve_metrics')
+    @mock.patch('kinto_fxa.scripts.process_account_events.time.time')
+    @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
+    @mock.patch('kinto_fxa.scripts.process_account_events.itertools.count')
+    def test_consumer_metrics_are_served_if_port_is_given(
+            self, count, process_account_event, time_, serve_metrics):
+        count.return_value = [1]
+        time_.return_value = 1000
+        process_account_event.side_effect = [None, ValueError]
+        messages = [mock.Mock(body="my-body", message_id=str(i),
+                              attributes={'SentTimestamp': '990000',
+                                          'ApproximateReceiveCount': '1'})
+                    for i in range(2)]
+        self.queue.receive_messages.return_value = messages
+
+        process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23,
+                               metrics_port=9090)
+
+        metrics, port = serve_metrics.call_args[0]
+        self.assertEqual(port, 9090)
+        rendered = metrics.render()
+        self.assertIn('process_account_event_received_total 2\n', rendered)
+        self.assertIn('process_account_event_failed_ValueError_total 1\n', rendered)
+        self.assertIn('process_account_event_batch_fill_ratio 0.2\n', rendered)
+        self.assertIn('process_account_event_queue_lag_seconds 10.0\n', rendered)
+        self.assertIn('process_account_event_in_flight 0\n', rendered)
+        self.assertIn('process_account_event_receive_seconds_count 1\n', rendered)
+        serve_metrics.return_value.shutdown.assert_called_with()
+
+    def test_phases_of_event_processing_are_timed(self):
+        metrics = ConsumerMetrics()
+        fxa_settings = FxAOAuthSettings.from_settings(DEFAULT_SETTINGS).replace(
+            principal_index_enabled=True)
+        registry = mock.Mock(settings={'userid_hmac_secret': 'secret'}, cache=None,
+                             _fxa_oauth_settings=fxa_settings)
+        registry._fxa_oauth_clients.userid_suffixes = ('',)
+        registry.permission.get_objects_permissions.return_value = []
+        registry.storage.list_all.return_value = []
+        config = {'registry': registry}
+
+        process_account_event(config, json.dumps({
+            "Message": json.dumps({"event": "delete", "uid": "abcd"})}), metrics=metrics)
+
+        rendered = metrics.render()
+        for phase in ('bucket_ids', 'storage_delete_all', 'storage_purge_deleted',
+                      'permission_delete_object_permissions', 'purge_principals',
+                      'commit'):
+            self.assertIn('process_account_event_{}_seconds_count'.format(phase), rendered)
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
+    @mock.patch('kinto_fxa.scripts.process_account_events.itertools.count')
+    def test_duplicated_events_are_acknowledged_without_processing(
+            self, count, process_account_event):
+        count.return_value = [1]
+        self.registry.statsd = mock.Mock()
+        self.registry.statsd.timer.return_value = mock.Mock(side_effect=lambda f: f)
+        body = json.dumps({"Message": json.dumps({"event": "delete", "uid": "abc"})})
+        first = mock.Mock(body=body, message_id='1')
+        redelivered = mock.Mock(body=body, message_id='1')
+        duplicated = mock.Mock(body=body, message_id='2')
+        self.queue.receive_messages.return_value = [first, redelivered, duplicated]
+
+        process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23)
+
+        self.assertEqual(process_account_event.call_count, 1)
+        self.assertDeleted(first, redelivered, duplicated)
+        self.registry.statsd.count.assert_called_with("process_account_event.duplicate")
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
+    @mock.patch('kinto_fxa.scripts.process_account_events.itertools.count')
+    def test_processed_events_are_recorded_in_cache_if_enabled(
+            self, count, process_account_event):
+        count.return_value = [1]
+        self.registry.cache = memory_backend.Cache(cache_prefix="tests",
+                                                   cache_max_size_bytes=float("inf"))
+        message = mock.Mock(body="my-body", message_id='1')
+        self.queue.receive_messages.return_value = [message]
+
+        process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23,
+                               dedup_ttl=60)
+        self.assertTrue(self.registry.cache.get('fxa-account-events:message:1'))
+
+        # Another consumer won't process it again.
+        process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23,
+                               dedup_ttl=60)
+        self.assertEqual(process_account_event.call_count, 1)
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.itertools')
+    def test_visibility_timeout_can_be_given(self, itertools):
+        itertools.count.return_value = [1]
+        self.queue.receive_messages.return_value = []
+        process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23,
+                               visibility_timeout=120)
+        self.queue.receive_messages.assert_called_with(
+            MaxNumberOfMessages=10, WaitTimeSeconds=23,
+            AttributeNames=['ApproximateReceiveCount', 'SentTimestamp'], VisibilityTimeout=120)
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.VisibilityHeartbeat')
+    @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
+    @mock.patch('kinto_fxa.scripts.process_account_events.itertools.count')
+    def test_messages_are_tracked_until_deleted(self, count, process_account_event,
+                                                heartbeat):
+        count.return_value = [1]
+        message = mock.Mock(body="my-body", message_id='1')
+        self.queue.receive_messages.return_value = [message]
+
+        process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23)
+
+        heartbeat.assert_called_with(self.queue, 30, statsd=mock.ANY)
+        heartbeat.return_value.track.assert_called_with([message])
+        heartbeat.return_value.untrack.assert_called_with(message)
+        heartbeat.return_value.stop.assert_called_with()
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
+    def test_shutdown_releases_unprocessed_messages_after_drain_timeout(
+            self, process_account_event):
+        messages = [mock.Mock(body="my-body", message_id=str(i), receipt_handle='h%s' % i)
+                    for i in range(3)]
+        self.queue.receive_messages.return_value = messages
+
+        def terminate(*args, **kwargs):
+            os.kill(os.getpid(), signal.SIGTERM)
+        process_account_event.side_effect = terminate
+
+        process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23,
+                               drain_timeout=0)
+
+        self.assertEqual(process_account_event.call_count, 1)
+        self.assertEqual(self.queue.receive_messages.call_count, 1)
+        self.assertDeleted(messages[0])
+        entries = self.queue.change_message_visibility_batch.call_args[1]['Entries']
+        self.assertEqual(entries, [
+            {'Id': '0', 'ReceiptHandle': 'h1', 'VisibilityTimeout': 0},
+            {'Id': '1', 'ReceiptHandle': 'h2', 'VisibilityTimeout': 0},
+        ])
+        self.assertIs(signal.getsignal(signal.SIGTERM), signal.SIG_DFL)
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
+    def test_shutdown_finishes_batch_within_drain_timeout(self, process_account_event):
+        messages = [mock.Mock(body="my-body", message_id=str(i)) for i in range(3)]
+        self.queue.receive_messages.return_value = messages
+
+        def terminate_once(*args, **kwargs):
+            # A second signal would kill the process.
+            if process_account_event.call_count == 1:
+                os.kill(os.getpid(), signal.SIGTERM)
+        process_account_event.side_effect = terminate_once
+
+        process_account_events(self.config, 'my-queue-name', 'my-aws-region', 23)
+
+        self.assertEqual(process_account_event.call_count, 3)
+        self.assertDeleted(*messages)
+
+
+class TestReplayAccountEvents(unittest.TestCase):
+    def setUp(self):
+        self.registry = mock.Mock()
+        self.registry.statsd = None
+        self.config = {"registry": self.registry}
+        self.events = io.StringIO(''.join(
+            json.dumps({"event": "delete", "uid": uid}) + '\n' for uid in ('a', 'b', 'a')))
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
+    def test_every_event_of_the_file_is_processed(self, process_account_event):
+        replay_account_events(self.config, self.events)
+        uids = [json.loads(json.loads(call[0][1])['Message'])['uid']
+                for call in process_account_event.call_args_list]
+        self.assertEqual(uids, ['a', 'b'])
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.logger')
+    @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
+    def test_failed_events_are_written_to_dead_letter_file(
+            self, process_account_event, logger):
+        process_account_event.side_effect = ValueError
+        dead_letters = io.StringIO()
+        replay_account_events(self.config, io.StringIO('junk\n'),
+                              dead_letter_file=dead_letters)
+        self.assertEqual(dead_letters.getvalue(), 'junk\n')
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.logger')
+    @mock.patch('kinto_fxa.scripts.process_account_events.process_account_event')
+    def test_failed_events_are_counted_without_dead_letter_file(
+            self, process_account_event, logger):
+        process_account_event.side_effect = ValueError
+        replay_account_events(self.config, self.events, max_attempts=2, retry_backoff=0)
+        self.assertEqual(process_account_event.call_count, 4)
+        logger.error.assert_called_with("%s account events could not be processed", 2)
+
+
+class TestGracefulShutdown(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.shutdown = GracefulShutdown(drain_timeout=10, clock=lambda: self.now)
+
+    def test_drain_expires_after_timeout(self):
+        self.assertFalse(self.shutdown.requested)
+        self.shutdown.request()
+        self.shutdown.request()
+        self.assertTrue(self.shutdown.requested)
+        self.assertFalse(self.shutdown.expired)
+        self.now += 10
+        self.assertTrue(self.shutdown.expired)
+
+    def test_signals_request_shutdown_once(self):
+        previous = mock.Mock()
+        signal.signal(signal.SIGUSR1, previous)
+        self.addCleanup(signal.signal, signal.SIGUSR1, signal.SIG_DFL)
+        shutdown = GracefulShutdown(signals=(signal.SIGUSR1,))
+        shutdown.install()
+        os.kill(os.getpid(), signal.SIGUSR1)
+        self.assertTrue(shutdown.requested)
+        os.kill(os.getpid(), signal.SIGUSR1)
+        self.assertTrue(previous.called)
+
+    def test_handlers_are_not_installed_outside_main_thread(self):
+        shutdown = GracefulShutdown(signals=(signal.SIGUSR1,))
+        thread = threading.Thread(target=shutdown.install)
+        thread.start()
+        thread.join()
+        self.assertIs(signal.getsignal(signal.SIGUSR1), signal.SIG_DFL)
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.logger')
+    def test_release_errors_are_logged(self, logger):
+        queue = mock.Mock()
+        queue.change_message_visibility_batch.side_effect = ValueError
+        release_messages(queue, [mock.Mock()])
+        logger.exception.assert_called_with("Error while releasing messages")
+
+    def test_long_polls_are_abandoned_on_shutdown(self):
+        queue = mock.Mock()
+        received = threading.Event()
+        message = mock.Mock(receipt_handle='h')
+
+        def receive(**kwargs):
+            received.wait(5)
+            return [message]
+        queue.receive_messages.side_effect = receive
+        released = threading.Event()
+        queue.change_message_visibility_batch.side_effect = lambda **kwargs: released.set()
+        self.shutdown.request()
+
+        self.assertEqual(receive_messages(queue, self.shutdown, poll_interval=0.01), [])
+        received.set()
+        self.assertTrue(released.wait(5))
+        queue.change_message_visibility_batch.assert_called_with(
+            Entries=[{'Id': '0', 'ReceiptHandle': 'h', 'VisibilityTimeout': 0}])
+
+    def test_long_polls_do_not_delay_the_exit(self):
+        queue = mock.Mock()
+        received = threading.Event()
+        self.addCleanup(received.set)
+
+        def receive(**kwargs):
+            received.wait(5)
+            return []
+        queue.receive_messages.side_effect = receive
+        self.shutdown.request()
+        threads = set(threading.enumerate())
+
+        receive_messages(queue, self.shutdown, poll_interval=0.01)
+
+        [poll] = set(threading.enumerate()) - threads
+        self.assertTrue(poll.daemon)
+
+    def test_errors_of_long_polls_are_raised(self):
+        queue = mock.Mock()
+        queue.receive_messages.side_effect = ValueError
+        with self.assertRaises(ValueError):
+            receive_messages(queue, self.shutdown, poll_interval=0.01)
+
+    def test_errors_of_abandoned_long_polls_are_ignored(self):
+        queue = mock.Mock()
+        failing = threading.Event()
+
+        def receive(**kwargs):
+            failing.wait(5)
+            raise ValueError
+        queue.receive_messages.side_effect = receive
+        self.shutdown.request()
+        threads = set(threading.enumerate())
+
+        self.assertEqual(receive_messages(queue, self.shutdown, poll_interval=0.01), [])
+        [poll] = set(threading.enumerate()) - threads
+        failing.set()
+        poll.join(5)
+        queue.change_message_visibility_batch.assert_not_called()
+
+
+class TestBackOff(unittest.TestCase):
+    def setUp(self):
+        self.shutdown = GracefulShutdown(signals=())
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.time')
+    def test_delay_doubles_up_to_the_maximum(self, time):
+        for errors, expected in ((1, 1), (3, 4), (10, 60)):
+            time.monotonic.side_effect = [0, 0, expected]
+            back_off(self.shutdown, errors, step=100)
+            time.sleep.assert_called_with(expected)
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.time')
+    def test_waits_in_small_steps(self, time):
+        time.monotonic.side_effect = [0, 0, 0.5, 0.9, 1]
+        back_off(self.shutdown, 1)
+        delays = [c[0][0] for c in time.sleep.call_args_list]
+        self.assertEqual(delays[:2], [0.5, 0.5])
+        self.assertAlmostEqual(delays[2], 0.1)
+
+    def test_is_cut_short_by_shutdown(self):
+        self.shutdown.request()
+        started = time.monotonic()
+        back_off(self.shutdown, 10)
+        self.assertLess(time.monotonic() - started, 1)
+
+
+class TestVisibilityHeartbeat(unittest.TestCase):
+    def setUp(self):
+        self.queue = mock.Mock()
+        self.queue.change_message_visibility_batch.return_value = {}
+        self.statsd = mock.Mock()
+        self.heartbeat = VisibilityHeartbeat(self.queue, 60, statsd=self.statsd)
+        self.messages = [mock.Mock(message_id=str(i), receipt_handle='h%s' % i)
+                         for i in range(12)]
+
+    def test_interval_is_half_the_visibility_timeout(self):
+        self.assertEqual(self.heartbeat.interval, 30)
+        self.assertEqual(VisibilityHeartbeat(self.queue, 1).interval, 1)
+
+    def test_visibility_of_tracked_messages_is_extended_in_batches(self):
+        self.heartbeat.track(self.messages)
+        self.heartbeat.untrack(self.messages[0])
+        self.heartbeat.extend()
+
+        calls = self.queue.change_message_visibility_batch.call_args_list
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(calls[0][1]['Entries']), 10)
+        self.assertEqual(calls[1][1]['Entries'],
+                         [{'Id': '0', 'ReceiptHandle': 'h11', 'VisibilityTimeout': 60}])
+
+    def test_failed_messages_are_abandoned(self):
+        self.queue.change_message_visibility_batch.return_value = {
+            'Successful': [{'Id': '0'}],
+            'Failed': [{'Id': '1', 'Message': 'ReceiptHandleIsInvalid'}],
+        }
+        self.heartbeat.track(self.messages[:2])
+        self.heartbeat.extend()
+
+        self.statsd.count.assert_any_call("process_account_event.visibility_extended", 1)
+        self.statsd.count.assert_any_call("process_account_event.abandoned", 1)
+        self.queue.change_message_visibility_batch.return_value = {}
+        self.heartbeat.extend()
+        entries = self.queue.change_message_visibility_batch.call_args[1]['Entries']
+        self.assertEqual([e['ReceiptHandle'] for e in entries], ['h0'])
+
+    def test_messages_untracked_during_a_round_are_skipped(self):
+        def untrack(Entries):
+            # As if untracked by the consumer between the two batches.
+            self.heartbeat._in_flight.pop('10')
+            self.heartbeat._in_flight.pop('11')
+            return {}
+        self.queue.change_message_visibility_batch.side_effect = untrack
+        self.heartbeat.track(self.messages)
+        self.heartbeat.extend()
+
+        self.assertEqual(self.queue.change_message_visibility_batch.call_count, 1)
+
+    def test_untrack_waits_for_the_batch_being_sent(self):
+        untracked = []
+
+        def extend(Entries):
+            thread = threading.Thread(target=self.heartbeat.untrack, args=(self.messages[0],))
+            thread.start()
+            thread.join(0.05)
+            untracked.append(not thread.is_alive())
+            return {}
+        self.queue.change_message_visibility_batch.side_effect = extend
+        self.heartbeat.track(self.messages[:1])
+        self.heartbeat.extend()
+
+        self.assertEqual(untracked, [False])
+
+    @mock.patch('kinto_fxa.scripts.process_account_events.logger')
+    def test_errors_are_logged(self, logger):
+        self.queue.change_message_visibility_batch.side_effect = ValueError
+        self.heartbeat.track(self.messages[:1])
+        self.heartbeat.extend()
+        logger.exception.assert_called_with("Error while extending visibility of messages")
+
+    def test_extends_periodically_until_stopped(self):
+        extended = threading.Event()
+        self.heartbeat.interval = 0.01
+        with mock.patch.object(self.heartbeat, 'extend', side_effect=extended.set):
+            self.heartbeat.start()
+            self.assertTrue(extended.wait(5))
+            self.heartbeat.stop()
+
+
+class TestEventDeduplicator(unittest.TestCase):
+    def setUp(self):
+        self.body = json.dumps({"Message": json.dumps({"event": "delete", "uid": "abc"})})
+        self.deduplicator = EventDeduplicator(history_size=2)
+
+    def test_keys_include_event_type_and_uid(self):
+        self.assertEqual(self.deduplicator.keys('1', self.body),
+                         ['message:1', 'event:delete:abc'])
+
+    def test_keys_of_repeatable_events_only_include_message_id(self):
+        body = json.dumps({"Message": json.dumps({"event": "passwordChange", "uid": "abc"})})
+        self.assertEqual(self.deduplicator.keys('1', body), ['message:1'])
+
+    def test_keys_of_invalid_messages_only_include_message_id(self):
+        self.assertEqual(self.deduplicator.keys('1', 'junk'), ['message:1'])
+
+    def test_remembered_events_are_seen(self):
+        self.deduplicator.remember(['message:1'])
+        self.assertTrue(self.deduplicator.seen(['message:1']))
+        self.assertFalse(self.deduplicator.seen(['message:2']))
+
+    def test_history_is_bounded(self):
+        for i in range(3):
+            self.deduplicator.remember(['message:%s' % i])
+        self.assertFalse(self.deduplicator.seen(['message:0']))
+        self.assertTrue(self.deduplicator.seen(['message:2']))
+
+    def test_cache_errors_are_ignored(self):
+        cache = mock.Mock()
+        cache.get.side_effect = ValueError
+        cache.set.side_effect = ValueError
+        deduplicator = EventDeduplicator(cache=cache)
+        deduplicator.remember(['message:1'])
+        self.assertFalse(deduplicator.seen(['message:2']))
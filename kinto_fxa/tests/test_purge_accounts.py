@@ -0,0 +1,84 @@
+import io
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from kinto_fxa import DEFAULT_SETTINGS
+from kinto_fxa.scripts.purge_accounts import purge_accounts
+from kinto_fxa.utils import FxAOAuthSettings
+
+
+class PurgeAccountsTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = mock.Mock()
+        self.registry.settings = {
+            'userid_hmac_secret': 'efghi',
+            'multiauth.policy.fxa.use': 'kinto_fxa.authentication.FxAOAuthAuthenticationPolicy',
+            'fxa-oauth.clients.notes.client_id': 'a',
+        }
+        self.registry._fxa_oauth_settings = FxAOAuthSettings.from_settings(DEFAULT_SETTINGS)
+        self.registry._fxa_oauth_clients.userid_suffixes = ('', '-notes')
+        self.config = {'registry': self.registry}
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.checkpoint = os.path.join(self.tmpdir, 'purge.ckpt')
+
+        patcher = mock.patch('kinto_fxa.scripts.purge_accounts.current_transaction')
+        self.transaction = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def deleted_buckets(self):
+        return [c[1]['parent_id'].rstrip('*')
+                for c in self.registry.storage.delete_all.call_args_list
+                if c[1]['parent_id']]
+
+    def test_default_buckets_of_every_client_are_deleted(self):
+        purged = purge_accounts(self.config, io.StringIO('abcd\n'))
+        self.assertEqual(purged, 1)
+        self.assertEqual(len(self.deleted_buckets()), 2)
+        self.registry.permission.delete_object_permissions.assert_called_with(
+            *[uri + '*' for uri in self.deleted_buckets()])
+        self.transaction.commit.assert_called_with()
+
+    def test_buckets_of_a_batch_are_deleted_at_once(self):
+        purge_accounts(self.config, io.StringIO('a\nb\n'))
+        [bucket_deletion] = [c for c in self.registry.storage.delete_all.call_args_list
+                             if c[1]['parent_id'] == '']
+        [ids_filter] = bucket_deletion[1]['filters']
+        self.assertEqual(bucket_deletion[1]['collection_id'], 'bucket')
+        self.assertEqual(['/buckets/' + i for i in ids_filter.value], self.deleted_buckets())
+        self.assertEqual(self.registry.permission.delete_object_permissions.call_count, 1)
+
+    def test_empty_batches_do_not_reach_the_storage(self):
+        purged = purge_accounts(self.config, io.StringIO('a\nb\n'), batch_size=2)
+        self.assertEqual(purged, 2)
+        self.assertEqual(self.registry.storage.delete_all.call_count, 1 + 4)
+
+    @mock.patch('kinto_fxa.scripts.purge_accounts.invalidate_tokens')
+    def test_tokens_of_purged_accounts_are_invalidated(self, invalidate_tokens):
+        purge_accounts(self.config, io.StringIO('a\nb\n'))
+        invalidate_tokens.assert_has_calls([mock.call(self.registry, 'a'),
+                                            mock.call(self.registry, 'b')])
+
+    def test_accounts_are_deleted_in_batches(self):
+        uids = io.StringIO('a\nb\n\nc\n')
+        purged = purge_accounts(self.config, uids, batch_size=2)
+        self.assertEqual(purged, 3)
+        self.assertEqual(len(self.deleted_buckets()), 6)
+        self.assertEqual(self.transaction.commit.call_count, 2)
+
+    def test_progress_is_saved_in_checkpoint(self):
+        purge_accounts(self.config, io.StringIO('a\nb\nc\n'), batch_size=2,
+                       checkpoint_file=self.checkpoint)
+        with open(self.checkpoint) as f:
+            self.assertEqual(f.read(), '3\n')
+
+    def test_purge_is_resumed_from_checkpoint(self):
+        with open(self.checkpoint, 'w') as f:
+            f.write('2\n')
+        purged = purge_accounts(self.config, io.StringIO('a\nb\nc\n'),
+                                checkpoint_file=self.checkpoint)
+        self.assertEqual(purged, 1)
+        self.assertEqual(len(self.deleted_buckets()), 2)
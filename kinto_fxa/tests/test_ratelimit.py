@@ -0,0 +1,111 @@
+import mock
+import unittest
+
+from kinto.core.cache import memory as memory_backend
+from pyramid.request import Request
+
+from kinto_fxa.ratelimit import RateLimiter, SharedFailureCounter, client_address
+
+
+class ClientAddressTest(unittest.TestCase):
+    def _request(self, forwarded_for=None):
+        headers = {} if forwarded_for is None else {'X-Forwarded-For': forwarded_for}
+        return Request.blank('/', environ={'REMOTE_ADDR': '1.2.3.4'}, headers=headers)
+
+    def test_forwarded_addresses_are_ignored_by_default(self):
+        self.assertEqual(client_address(self._request('9.9.9.9')), '1.2.3.4')
+
+    def test_forwarded_addresses_of_trusted_proxies_are_used(self):
+        request = self._request('9.9.9.9, 5.6.7.8, 10.0.0.1')
+        self.assertEqual(client_address(request, trusted_proxies=1), '10.0.0.1')
+        self.assertEqual(client_address(request, trusted_proxies=2), '5.6.7.8')
+
+    def test_first_address_is_used_if_there_are_less_proxies(self):
+        self.assertEqual(client_address(self._request('5.6.7.8'), trusted_proxies=3),
+                         '5.6.7.8')
+        self.assertEqual(client_address(self._request(), trusted_proxies=1), '1.2.3.4')
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.limiter = RateLimiter(rate=1, burst=3, max_keys=2, clock=lambda: self.now)
+
+    def test_allows_up_to_burst(self):
+        self.assertTrue(self.limiter.consume('a'))
+        self.assertTrue(self.limiter.consume('a'))
+        self.assertTrue(self.limiter.consume('a'))
+        self.assertFalse(self.limiter.consume('a'))
+
+    def test_buckets_are_refilled_over_time(self):
+        for _ in range(3):
+            self.limiter.consume('a')
+        self.assertTrue(self.limiter.exhausted('a'))
+        self.now += 1
+        self.assertFalse(self.limiter.exhausted('a'))
+        self.assertTrue(self.limiter.consume('a'))
+
+    def test_buckets_are_not_refilled_beyond_burst(self):
+        self.limiter.consume('a')
+        self.now += 100
+        for _ in range(3):
+            self.assertTrue(self.limiter.consume('a'))
+        self.assertFalse(self.limiter.consume('a'))
+
+    def test_unknown_keys_are_not_exhausted(self):
+        self.assertFalse(self.limiter.exhausted('a'))
+
+    def test_keys_are_independent(self):
+        for _ in range(3):
+            self.limiter.consume('a')
+        self.assertTrue(self.limiter.consume('b'))
+
+    def test_least_recently_used_keys_are_evicted(self):
+        for _ in range(3):
+            self.limiter.consume('a')
+        self.limiter.consume('b')
+        self.limiter.consume('c')
+        self.assertFalse(self.limiter.exhausted('a'))
+
+    def test_retry_after_gives_time_until_next_token(self):
+        for _ in range(3):
+            self.limiter.consume('a')
+        self.assertEqual(self.limiter.retry_after('a'), 1)
+        self.assertEqual(self.limiter.retry_after('b'), 0)
+
+    def test_retry_after_is_infinite_without_refill(self):
+        limiter = RateLimiter(rate=0, burst=1)
+        limiter.consume('a')
+        self.assertEqual(limiter.retry_after('a'), float('inf'))
+
+
+class SharedFailureCounterTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = memory_backend.Cache(cache_prefix="tests",
+                                          cache_max_size_bytes=float("inf"))
+        self.counter = SharedFailureCounter(self.cache, limit=2, window=10,
+                                            clock=lambda: self.now)
+
+    def test_exceeded_once_limit_is_reached(self):
+        self.counter.incr('a')
+        self.assertFalse(self.counter.exceeded('a'))
+        self.counter.incr('a')
+        self.assertTrue(self.counter.exceeded('a'))
+
+    def test_counters_are_reset_on_next_window(self):
+        self.counter.incr('a')
+        self.counter.incr('a')
+        self.now += 10
+        self.assertFalse(self.counter.exceeded('a'))
+
+    def test_counters_are_shared_between_instances(self):
+        other = SharedFailureCounter(self.cache, limit=2, window=10, clock=lambda: self.now)
+        self.counter.incr('a')
+        other.incr('a')
+        self.assertTrue(self.counter.exceeded('a'))
+
+    def test_cache_errors_are_ignored(self):
+        with mock.patch.object(self.cache, 'get', side_effect=ValueError):
+            self.counter.incr('a')
+            self.assertFalse(self.counter.exceeded('a'))
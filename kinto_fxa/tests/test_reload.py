@@ -0,0 +1,181 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import kinto.core
+import mock
+from pyramid.config import Configurator
+from pyramid.exceptions import ConfigurationError
+
+from kinto_fxa import includeme
+from kinto_fxa.authentication import FxAOAuthAuthenticationPolicy
+from kinto_fxa.reload import ClientsReloader, ClientsTables
+
+NOTES = {
+    'fxa-oauth.clients.notes.client_id': '89513028159972bc',
+    'fxa-oauth.clients.notes.required_scope': 'profile app-notes',
+}
+
+
+def build_registry(**settings):
+    settings.setdefault('cache_backend', 'kinto.core.cache.memory')
+    settings.setdefault('fxa-oauth.required_scope', 'profile kinto')
+    config = Configurator(settings=settings)
+    kinto.core.initialize(config, '0.0.1')
+    config.include(includeme)
+    return config.registry
+
+
+class ClientsReloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = build_registry(**{'fxa-oauth.clients.todo.client_id': 'abc',
+                                          'fxa-oauth.clients.todo.required_scope': 'app-todo'})
+        self.reloader = ClientsReloader(self.registry)
+
+    def test_load_publishes_new_routing_tables(self):
+        tables = self.registry._fxa_oauth_clients
+        self.assertEqual(tables.userid_suffixes, ('', '-todo'))
+        self.reloader.load(NOTES)
+        new_tables = self.registry._fxa_oauth_clients
+        self.assertIsInstance(new_tables, ClientsTables)
+        self.assertEqual(new_tables.scope_routing,
+                         {'profile kinto': 'default', 'profile app-notes': 'notes'})
+        self.assertEqual(sorted(new_tables.resources), ['default', 'notes'])
+        self.assertEqual(new_tables.params, tables.params)
+        self.assertNotEqual(new_tables.clients_params.etag, tables.clients_params.etag)
+        self.assertIn(b'89513028159972bc', new_tables.clients_params.body)
+        self.assertEqual(new_tables.userid_suffixes, ('', '-notes'))
+        # The previous tables are left untouched, for requests still using them.
+        self.assertEqual(tables.userid_suffixes, ('', '-todo'))
+        # The settings may be iterated concurrently.
+        self.assertIn('fxa-oauth.clients.todo.client_id', self.registry.settings)
+        self.assertNotIn('fxa-oauth.clients.notes.client_id', self.registry.settings)
+
+    def test_policy_uses_new_routing_and_keeps_its_clients(self):
+        policy = FxAOAuthAuthenticationPolicy()
+        policy.setup(self.registry)
+        auth_client = policy._auth_client
+        policy._get_scope_routing(self.registry)
+        self.reloader.load(NOTES)
+        routing = policy._get_scope_routing(self.registry)
+        self.assertIn(('profile app-notes', ['profile', 'app-notes'], 'notes'), routing)
+        self.assertIs(policy._auth_client, auth_client)
+
+    def test_duplicate_scopes_are_rejected(self):
+        tables = self.registry._fxa_oauth_clients
+        with self.assertRaises(ConfigurationError):
+            self.reloader.load({'fxa-oauth.clients.notes.required_scope': 'profile kinto'})
+        self.assertIs(self.registry._fxa_oauth_clients, tables)
+
+    def test_only_client_settings_can_be_reloaded(self):
+        with self.assertRaisesRegex(ConfigurationError, 'fxa-oauth.oauth_uri'):
+            self.reloader.load({'fxa-oauth.oauth_uri': 'https://evil.com'})
+        with self.assertRaisesRegex(ConfigurationError, 'JSON object'):
+            self.reloader.load([])
+
+
+class FileReloadTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'clients.json')
+        self.registry = build_registry()
+        self.reloader = ClientsReloader(self.registry, path=self.path, interval=0.01)
+
+    def write(self, content, mtime):
+        with open(self.path, 'w') as f:
+            f.write(content)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_missing_file_is_ignored(self):
+        self.assertFalse(self.reloader.check())
+
+    def test_file_is_reloaded_when_it_changes(self):
+        self.write(json.dumps(NOTES), 1000)
+        self.assertTrue(self.reloader.check())
+        self.assertIn('profile app-notes', self.registry._fxa_oauth_clients.scope_routing)
+        self.assertFalse(self.reloader.check())
+        self.write(json.dumps({}), 2000)
+        self.assertTrue(self.reloader.check())
+        self.assertNotIn('profile app-notes', self.registry._fxa_oauth_clients.scope_routing)
+
+    def test_invalid_files_are_logged_once(self):
+        self.write('{"fxa-oauth.clients', 1000)
+        tables = self.registry._fxa_oauth_clients
+        with mock.patch('kinto_fxa.reload.logger') as logger:
+            self.assertFalse(self.reloader.check())
+            self.assertFalse(self.reloader.check())
+        self.assertEqual(logger.error.call_count, 1)
+        self.assertIs(self.registry._fxa_oauth_clients, tables)
+
+    def test_unreadable_files_are_logged(self):
+        self.write(json.dumps(NOTES), 1000)
+        with mock.patch('kinto_fxa.reload.open', side_effect=PermissionError, create=True):
+            with mock.patch('kinto_fxa.reload.logger') as logger:
+                self.assertFalse(self.reloader.check())
+        self.assertTrue(logger.error.called)
+
+    def test_file_is_polled_in_background(self):
+        self.reloader.start()
+        self.reloader.start()
+        self.addCleanup(self.reloader.stop)
+        self.write(json.dumps(NOTES), 1000)
+        for _ in range(100):
+            if 'profile app-notes' in self.registry._fxa_oauth_clients.scope_routing:
+                break
+            time.sleep(0.01)
+        self.assertIn('profile app-notes', self.registry._fxa_oauth_clients.scope_routing)
+
+
+class CacheReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = build_registry()
+        self.reloader = ClientsReloader(self.registry, cache_key='fxa-clients')
+
+    def test_cache_value_is_reloaded_when_it_changes(self):
+        self.assertFalse(self.reloader.check())
+        self.registry.cache.set('fxa-clients', NOTES, ttl=60)
+        self.assertTrue(self.reloader.check())
+        self.assertFalse(self.reloader.check())
+        self.registry.cache.set('fxa-clients', json.dumps({}), ttl=60)
+        self.assertTrue(self.reloader.check())
+        self.assertNotIn('profile app-notes', self.registry._fxa_oauth_clients.scope_routing)
+
+    def test_cache_errors_are_logged(self):
+        with mock.patch.object(self.registry.cache, 'get', side_effect=RuntimeError):
+            with mock.patch('kinto_fxa.reload.logger') as logger:
+                self.assertFalse(self.reloader.check())
+        self.assertTrue(logger.exception.called)
+
+
+class IncludeMeReloadTest(unittest.TestCase):
+    def test_clients_are_loaded_at_startup(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'clients.json')
+        with open(path, 'w') as f:
+            json.dump(NOTES, f)
+        registry = build_registry(**{'fxa-oauth.clients_reload.file': path})
+        self.assertIn('profile app-notes', registry._fxa_oauth_clients.scope_routing)
+        self.assertEqual(registry._fxa_oauth_clients_reloader.path, path)
+
+    def test_invalid_clients_prevent_startup(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'clients.json')
+        with open(path, 'w') as f:
+            f.write('{"fxa-oauth.clients')
+        with self.assertRaisesRegex(ConfigurationError, 'Invalid JSON'):
+            build_registry(**{'fxa-oauth.clients_reload.file': path})
+        with open(path, 'w') as f:
+            json.dump({'fxa-oauth.clients.notes.required_scope': 'profile kinto'}, f)
+        with self.assertRaises(ConfigurationError):
+            build_registry(**{'fxa-oauth.clients_reload.file': path})
+
+    def test_cache_key_requires_a_cache_backend(self):
+        with self.assertRaises(ConfigurationError):
+            build_registry(**{'fxa-oauth.clients_reload.cache_key': 'fxa-clients',
+                              'cache_backend': ''})
@@ -1,16 +1,52 @@
 import mock
+import subprocess
+import sys
 import unittest
 
 from kinto_fxa.scripts import __main__ as main
+from kinto_fxa.scripts.benchmark_startup import StartupResult
 
 
 class TestScripts(unittest.TestCase):
     def setUp(self):
         process_account_events_patcher = mock.patch(
-            'kinto_fxa.scripts.__main__.process_account_events')
+            'kinto_fxa.scripts.process_account_events.process_account_events')
         self.process_account_events = process_account_events_patcher.start()
         self.addCleanup(process_account_events_patcher.stop)
 
+        replay_patcher = mock.patch(
+            'kinto_fxa.scripts.process_account_events.replay_account_events')
+        self.replay_account_events = replay_patcher.start()
+        self.addCleanup(replay_patcher.stop)
+
+        purge_patcher = mock.patch('kinto_fxa.scripts.purge_accounts.purge_accounts')
+        self.purge_accounts = purge_patcher.start()
+        self.addCleanup(purge_patcher.stop)
+
+        rebuild_patcher = mock.patch('kinto_fxa.scripts.rebuild_principal_index.rebuild_index')
+        self.rebuild_index = rebuild_patcher.start()
+        self.addCleanup(rebuild_patcher.stop)
+
+        simulate_patcher = mock.patch('kinto_fxa.scripts.simulate_cache.simulate_cache')
+        self.simulate_cache = simulate_patcher.start()
+        self.addCleanup(simulate_patcher.stop)
+
+        load_test_patcher = mock.patch('kinto_fxa.scripts.load_test_relier.load_test_relier')
+        self.load_test_relier = load_test_patcher.start()
+        self.addCleanup(load_test_patcher.stop)
+
+        appsettings_patcher = mock.patch('kinto_fxa.scripts.__main__.get_appsettings')
+        self.get_appsettings = appsettings_patcher.start()
+        self.addCleanup(appsettings_patcher.stop)
+
+        benchmark_patcher = mock.patch('kinto_fxa.scripts.benchmark_startup.benchmark_startup')
+        self.benchmark_startup = benchmark_patcher.start()
+        self.addCleanup(benchmark_patcher.stop)
+
+        warm_up_cache_patcher = mock.patch('kinto_fxa.scripts.warm_up_cache.warm_up_cache')
+        self.warm_up_cache = warm_up_cache_patcher.start()
+        self.addCleanup(warm_up_cache_patcher.stop)
+
         bootstrap_patcher = mock.patch('kinto_fxa.scripts.__main__.bootstrap')
         self.bootstrap = bootstrap_patcher.start()
         self.addCleanup(bootstrap_patcher.stop)
@@ -26,7 +62,69 @@ class TestScripts(unittest.TestCase):
         main.main(["process-account-events", "my-queue-name"])
         self.bootstrap.assert_called_with(main.DEFAULT_CONFIG_FILE)
         self.process_account_events.assert_called_with(
-            self.config, 'my-queue-name', None, 20
+            self.config, 'my-queue-name', None, 20,
+            visibility_timeout=None, dead_letter_queue_name=None,
+            dedup_history_size=10000, dedup_ttl=0, max_attempts=5, retry_backoff=30,
+            drain_timeout=30, metrics_port=None,
         )
         self.fileConfig.assert_called_with(main.DEFAULT_CONFIG_FILE,
                                            disable_existing_loggers=False)
+
+    def test_subcommands_are_only_imported_when_they_run(self):
+        code = ('import sys, kinto_fxa.scripts.__main__; '
+                'print(sorted(m for m in sys.modules if m.startswith("kinto_fxa.scripts.")))')
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(output.decode('utf-8').strip(), "['kinto_fxa.scripts.__main__']")
+
+    def test_call_simulate_cache(self):
+        main.main(["simulate-cache", "-", "--size", "100", "--size", "1000",
+                   "--admission", "both"])
+        self.simulate_cache.assert_called_with(sys.stdin, sizes=[100, 1000], ttls=[300],
+                                               admission=(False, True), jitter=0.1,
+                                               entry_size=512)
+        self.assertFalse(self.bootstrap.called)
+
+    def test_call_load_test_relier(self):
+        main.main(["load-test-relier", "--flows", "10", "--cache-backend",
+                   "kinto.core.cache.memory"])
+        self.get_appsettings.assert_called_with(main.DEFAULT_CONFIG_FILE)
+        self.load_test_relier.assert_called_with(self.get_appsettings.return_value, flows=10,
+                                                 concurrency=8, fxa_latency=0,
+                                                 cache_backend='kinto.core.cache.memory',
+                                                 cache_url=None)
+        self.assertFalse(self.bootstrap.called)
+
+    def test_call_benchmark_startup(self):
+        self.benchmark_startup.return_value = StartupResult(0.5, 0.05, 0.1)
+        self.assertEqual(main.main(["benchmark-startup", "--runs", "3"]), 0)
+        self.benchmark_startup.assert_called_with(main.DEFAULT_CONFIG_FILE, runs=3)
+        self.assertFalse(self.bootstrap.called)
+
+    def test_benchmark_startup_fails_over_budget(self):
+        self.benchmark_startup.return_value = StartupResult(0.5, 0.05, 0.1)
+        self.assertEqual(main.main(["benchmark-startup", "--budget-ms", "200"]), 0)
+        self.assertEqual(main.main(["benchmark-startup", "--budget-ms", "100"]), 1)
+
+    def test_call_warm_up_cache(self):
+        main.main(["warm-up-cache", "-", "--max-workers", "3"])
+        self.warm_up_cache.assert_called_with(self.config, sys.stdin, 3)
+        self.assertFalse(self.process_account_events.called)
+
+    def test_call_replay_account_events(self):
+        main.main(["replay-account-events", "-", "--max-attempts", "2"])
+        self.replay_account_events.assert_called_with(
+            self.config, sys.stdin, dead_letter_file=None,
+            dedup_history_size=10000, dedup_ttl=0, max_attempts=2, retry_backoff=30,
+            drain_timeout=30, metrics_port=None,
+        )
+        self.assertFalse(self.process_account_events.called)
+
+    def test_call_purge_accounts(self):
+        main.main(["purge-accounts", "-", "--batch-size", "10", "--checkpoint", "purge.ckpt"])
+        self.purge_accounts.assert_called_with(self.config, sys.stdin, batch_size=10,
+                                               checkpoint_file='purge.ckpt')
+        self.assertFalse(self.process_account_events.called)
+
+    def test_call_rebuild_principal_index(self):
+        main.main(["rebuild-principal-index", "--batch-size", "10"])
+        self.rebuild_index.assert_called_with(self.config, batch_size=10)
@@ -0,0 +1,78 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from kinto_fxa.scripts.simulate_cache import simulate, simulate_cache
+from kinto_fxa.trace import TraceWriter, read_trace
+
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'trace.tsv')
+
+    def test_written_lookups_can_be_read(self):
+        writer = TraceWriter(self.path, 'secret', clock=lambda: 12.5)
+        writer.record('token', 'notes', True)
+        writer.record('token', None, False)
+        writer.close()
+        with open(self.path) as f:
+            lookups = list(read_trace(f))
+        token_hash = lookups[0][1]
+        self.assertEqual(lookups, [(12.5, token_hash, 'notes', True),
+                                   (12.5, token_hash, '-', False)])
+        self.assertEqual(len(token_hash), 16)
+        self.assertNotIn('token', token_hash)
+
+    def test_malformed_lines_are_skipped(self):
+        trace = io.StringIO('junk\n1.0\ta\tnotes\t1\nabc\ta\tnotes\t1\n')
+        self.assertEqual(list(read_trace(trace)), [(1.0, 'a', 'notes', True)])
+
+
+class SimulateTest(unittest.TestCase):
+    def test_hit_ratio_and_fxa_call_rate(self):
+        lookups = [(0, 'a', 'notes', False), (1, 'a', 'notes', False),
+                   (2, 'b', 'notes', False), (4, 'a', 'lockbox', False)]
+        result = simulate(lookups, size=0, ttl=10)
+        self.assertEqual(result.lookups, 4)
+        self.assertEqual(result.hit_ratio, 0.25)
+        self.assertEqual(result.fxa_calls_per_second, 0.75)
+        self.assertEqual(result.peak_memory_bytes, 3 * 512)
+
+    def test_entries_expire_after_ttl(self):
+        lookups = [(0, 'a', 'notes', False), (11, 'a', 'notes', False)]
+        self.assertEqual(simulate(lookups, size=0, ttl=10).hit_ratio, 0)
+
+    def test_size_limits_entries(self):
+        lookups = [(0, 'a', 'notes', False), (1, 'b', 'notes', False),
+                   (2, 'a', 'notes', False)]
+        self.assertEqual(simulate(lookups, size=1, ttl=10).hit_ratio, 0)
+        self.assertEqual(simulate(lookups, size=2, ttl=10).hit_ratio, 1 / 3)
+
+    def test_admission_keeps_frequent_entries(self):
+        lookups = [(0, 'hot', 'notes', False), (1, 'hot', 'notes', False),
+                   (2, 'once', 'notes', False), (3, 'hot', 'notes', False)]
+        self.assertEqual(simulate(lookups, size=1, ttl=10, admission=True).hit_ratio, 0.5)
+        self.assertEqual(simulate(lookups, size=1, ttl=10).hit_ratio, 0.25)
+
+    def test_failed_verifications_are_never_cached(self):
+        lookups = [(0, 'bad', '-', False), (1, 'bad', '-', False), (2, 'a', 'notes', False),
+                   (3, 'bad', '-', False), (4, 'a', 'notes', False)]
+        result = simulate(lookups, size=1, ttl=10)
+        self.assertEqual(result.hit_ratio, 1 / 5)
+        self.assertEqual(result.fxa_calls_per_second, 1)
+        self.assertEqual(result.peak_memory_bytes, 512)
+
+    def test_empty_trace(self):
+        result = simulate([], size=0, ttl=10)
+        self.assertEqual((result.hit_ratio, result.fxa_calls_per_second), (0, 0))
+
+    def test_every_configuration_is_simulated(self):
+        trace = io.StringIO('0\ta\tnotes\t0\n1\ta\tnotes\t1\n')
+        results = simulate_cache(trace, sizes=[0, 10], ttls=[1, 60], admission=(False, True))
+        self.assertEqual(len(results), 8)
+        self.assertEqual({(r.size, r.ttl) for r in results if r.hit_ratio == 0.5},
+                         {(0, 60), (10, 60)})
@@ -0,0 +1,114 @@
+import base64
+import json
+import unittest
+
+import requests
+from fxa import errors as fxa_errors
+from fxa.oauth import Client as OAuthClient
+
+from kinto.core.cache import memory as memory_backend
+from kinto.core.testing import DummyRequest
+
+from kinto_fxa import DEFAULT_SETTINGS
+from kinto_fxa.authentication import FxAOAuthAuthenticationPolicy, token_expiration
+from kinto_fxa.reload import build_clients_tables
+from kinto_fxa.testing import FakeFxAServer, constant, lognormal
+from kinto_fxa.utils import FxAOAuthSettings
+
+
+class FakeFxAServerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.server = FakeFxAServer(scopes=['profile', 'kinto'], clock=lambda: self.now,
+                                    seed=42).start()
+        self.addCleanup(self.server.stop)
+        self.client = OAuthClient(server_url=self.server.url, client_id='abc',
+                                  client_secret='secret')
+
+    def test_issued_tokens_are_verified(self):
+        token = self.server.issue_token(user='alice')
+        profile = self.client.verify_token(token, scope='kinto')
+        self.assertEqual(profile['user'], 'alice')
+        self.assertEqual(profile['scope'], ['profile', 'kinto'])
+        self.assertEqual(profile['exp'], 4600)
+        self.assertEqual(self.server.requests['/v1/verify'], 1)
+
+    def test_expired_and_revoked_tokens_are_rejected(self):
+        expired = self.server.issue_token(ttl=10)
+        revoked = self.server.issue_token()
+        self.server.revoke(revoked)
+        self.now += 10
+        for token in (expired, revoked, 'unknown'):
+            with self.assertRaises(fxa_errors.ClientError):
+                self.client.verify_token(token)
+
+    def test_codes_are_traded_once_for_tokens(self):
+        code = self.server.grant_code(scope=['kinto'])
+        token = self.client.trade_code(code)
+        self.assertEqual(token['scope'], 'kinto')
+        self.assertEqual(self.client.verify_token(token['access_token'])['client_id'], 'abc')
+        with self.assertRaises(fxa_errors.ClientError):
+            self.client.trade_code(code)
+
+    def test_authorization_redirects_with_code(self):
+        response = requests.get(self.server.url + '/authorization', allow_redirects=False,
+                                params={'client_id': 'abc', 'state': 'xyz', 'scope': 'kinto',
+                                        'redirect_uri': 'https://app/callback'})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.headers['Location'].startswith('https://app/callback?code='))
+        self.assertIn('state=xyz', response.headers['Location'])
+
+        response = requests.get(self.server.url + '/authorization', params={'state': 'xyz'})
+        code = response.json()['code']
+        self.assertEqual(self.client.trade_code(code)['scope'], 'profile kinto')
+
+    def test_jwt_tokens_have_expiration_and_signing_key(self):
+        self.server.jwt = True
+        token = self.server.issue_token(ttl=60)
+        self.assertEqual(token_expiration(token), 1060)
+        self.assertEqual(self.client.verify_token(token)['user'], 'fake-user')
+        key = requests.get(self.server.url + '/jwks').json()['keys'][0]
+        self.assertEqual(key['alg'], 'HS256')
+        header = json.loads(base64.urlsafe_b64decode(token.split('.')[0] + '=='))
+        self.assertEqual(header['kid'], key['kid'])
+
+    def test_errors_are_injected(self):
+        self.server.error_rate = 1
+        with self.assertRaises(fxa_errors.ServerError):
+            self.client.verify_token(self.server.issue_token())
+
+    def test_heartbeat(self):
+        url = self.server.url.replace('/v1', '/__heartbeat__')
+        self.assertEqual(requests.get(url).status_code, 200)
+        self.server.healthy = False
+        self.assertEqual(requests.get(url).status_code, 503)
+
+    def test_unknown_endpoints_and_bodies(self):
+        self.assertEqual(requests.get(self.server.url + '/unknown').status_code, 404)
+        response = requests.post(self.server.url + '/verify', data='junk')
+        self.assertEqual(response.json()['errno'], 108)
+
+    def test_latency_distributions(self):
+        self.server.latency = constant(0.01)
+        self.client.verify_token(self.server.issue_token())
+        samples = [lognormal(0.02, 0.5)(self.server._random) for _ in range(1000)]
+        self.assertAlmostEqual(sorted(samples)[500], 0.02, delta=0.005)
+
+
+class PolicyWithFakeFxAServerTest(unittest.TestCase):
+    def test_policy_verifies_tokens_against_fake_server(self):
+        with FakeFxAServer(scopes=['kinto']) as server:
+            settings = DEFAULT_SETTINGS.copy()
+            settings['fxa-oauth.oauth_uri'] = server.url
+            settings['fxa-oauth.required_scope'] = 'kinto'
+            request = DummyRequest()
+            request.bound_data = {}
+            request.registry.cache = memory_backend.Cache(cache_prefix="tests",
+                                                          cache_max_size_bytes=float("inf"))
+            request.registry._fxa_oauth_settings = FxAOAuthSettings.from_settings(settings)
+            request.registry._fxa_oauth_clients = build_clients_tables(
+                settings, request.registry._fxa_oauth_settings)
+            request.headers['Authorization'] = 'Bearer ' + server.issue_token(user='alice')
+
+            policy = FxAOAuthAuthenticationPolicy()
+            self.assertEqual(policy.authenticated_userid(request), 'alice')
@@ -1,8 +1,10 @@
 import unittest
 
+import mock
 from pyramid.exceptions import ConfigurationError
 
-from kinto_fxa.utils import parse_clients
+from kinto_fxa import DEFAULT_SETTINGS
+from kinto_fxa.utils import FxAOAuthSettings, StripedLock, fxa_conf, parse_clients
 
 
 class UtilsTest(unittest.TestCase):
@@ -19,3 +21,63 @@ class UtilsTest(unittest.TestCase):
             'https://identity.mozilla.org/apps/notes')
 
         self.assertRaises(ConfigurationError, parse_clients, settings)
+
+    def test_fxa_conf_returns_raw_setting_and_is_deprecated(self):
+        request = mock.Mock()
+        request.registry.settings = {'fxa-oauth.cache_ttl_seconds': '60'}
+        with self.assertWarns(DeprecationWarning):
+            self.assertEqual(fxa_conf(request, 'cache_ttl_seconds'), '60')
+
+
+class FxAOAuthSettingsTest(unittest.TestCase):
+    def setUp(self):
+        self.settings = DEFAULT_SETTINGS.copy()
+
+    def test_values_are_converted_once(self):
+        self.settings['fxa-oauth.cache_ttl_seconds'] = '0.01'
+        self.settings['fxa-oauth.requested_scope'] = 'profile kinto'
+        self.settings['fxa-oauth.webapp.authorized_domains'] = '*.firefox.com\nlocalhost'
+        self.settings['fxa-oauth.relier.enabled'] = 'false'
+        settings = FxAOAuthSettings.from_settings(self.settings)
+        self.assertEqual(settings.cache_ttl_seconds, 0.01)
+        self.assertEqual(settings.requested_scopes, ('profile', 'kinto'))
+        self.assertEqual(settings.authorized_domains, ('*.firefox.com', 'localhost'))
+        self.assertFalse(settings.relier_enabled)
+
+    def test_raises_configuration_error_if_number_is_invalid(self):
+        self.settings['fxa-oauth.cache_ttl_seconds'] = 'five minutes'
+        with self.assertRaises(ConfigurationError) as cm:
+            FxAOAuthSettings.from_settings(self.settings)
+        self.assertIn('fxa-oauth.cache_ttl_seconds', str(cm.exception))
+
+    def test_settings_are_read_only(self):
+        settings = FxAOAuthSettings.from_settings(self.settings)
+        with self.assertRaises(AttributeError):
+            settings.oauth_uri = 'http://evil'
+        with self.assertRaises(AttributeError):
+            del settings.oauth_uri
+
+    def test_replace_returns_a_modified_copy(self):
+        settings = FxAOAuthSettings.from_settings(self.settings)
+        changed = settings.replace(client_id='abc')
+        self.assertEqual(changed.client_id, 'abc')
+        self.assertIsNone(settings.client_id)
+
+    def test_repr_does_not_leak_client_secret(self):
+        self.settings['fxa-oauth.client_secret'] = 's3cr3t'
+        settings = FxAOAuthSettings.from_settings(self.settings)
+        self.assertNotIn('s3cr3t', repr(settings))
+
+
+class StripedLockTest(unittest.TestCase):
+    def test_same_key_always_gets_the_same_lock(self):
+        locks = StripedLock(8)
+        self.assertIs(locks.get('abc'), locks.get('abc'))
+
+    def test_keys_are_spread_over_stripes(self):
+        locks = StripedLock(8)
+        distinct = {id(locks.get(str(i))) for i in range(100)}
+        self.assertEqual(len(distinct), 8)
+
+    def test_requires_at_least_one_stripe(self):
+        self.assertRaises(ValueError, StripedLock, 0)
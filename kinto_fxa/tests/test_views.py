@@ -9,6 +9,7 @@ from kinto.core.testing import FormattedErrorMixin
 from kinto.core.utils import random_bytes_hex
 from fxa import errors as fxa_errors
 from pyramid.config import Configurator
+from pyramid.interfaces import IAuthenticationPolicy
 from time import sleep
 
 from kinto_fxa import __version__ as fxa_version
@@ -40,8 +41,7 @@ class BaseWebTest(object):
         self.headers = {
             'Content-Type': 'application/json',
         }
-        self._fxa_verify_patcher = mock.patch('kinto_fxa.authentication.'
-                                              'OAuthClient.verify_token')
+        self._fxa_verify_patcher = mock.patch('fxa.oauth.Client.verify_token')
 
     def setUp(self):
         super(BaseWebTest, self).setUp()
@@ -121,16 +121,17 @@ class LoginViewTest(BaseWebTest, unittest.TestCase):
         self.assertIn('redirect', r.json['message'])
 
     def test_redirect_parameter_should_be_accepted_if_whitelisted(self):
-        with mock.patch.dict(self.app.app.registry.settings,
-                             [('fxa-oauth.webapp.authorized_domains',
-                               '*.whitelist.ed')]):
+        registry = self.app.app.registry
+        settings = registry._fxa_oauth_settings.replace(
+            authorized_domains=('*.whitelist.ed',))
+        with mock.patch.object(registry, '_fxa_oauth_settings', settings):
             url = '/fxa-oauth/login?redirect=http://iam.whitelist.ed'
             self.app.get(url)
 
     def test_redirect_parameter_should_be_rejected_if_no_whitelist(self):
-        with mock.patch.dict(self.app.app.registry.settings,
-                             [('fxa-oauth.webapp.authorized_domains',
-                               '')]):
+        registry = self.app.app.registry
+        settings = registry._fxa_oauth_settings.replace(authorized_domains=())
+        with mock.patch.object(registry, '_fxa_oauth_settings', settings):
             url = '/fxa-oauth/login?redirect=http://iam.whitelist.ed'
             r = self.app.get(url, status=400)
         self.assertIn('redirect', r.json['message'])
@@ -197,6 +198,43 @@ class ParamsViewTest(BaseWebTest, unittest.TestCase):
         self.assertEqual(r.status_code, 200)
         self.assertEqual(r.json, expected_body)
 
+    def test_params_view_is_cacheable(self):
+        r = self.app.get(self.url)
+        self.assertEqual(r.headers['Cache-Control'], 'public, max-age=3600')
+        self.assertIsNotNone(r.headers['ETag'])
+
+    def test_params_view_etag_is_strong(self):
+        r = self.app.get(self.url)
+        self.assertFalse(r.headers['ETag'].startswith('W/'))
+
+    def test_params_view_returns_304_if_etag_matches(self):
+        etag = self.app.get(self.url).headers['ETag']
+        r = self.app.get(self.url, headers={'If-None-Match': etag}, status=304)
+        self.assertEqual(r.body, b'')
+        self.assertEqual(r.headers['ETag'], etag)
+        self.assertNotIn('Content-Type', r.headers)
+
+    def test_params_view_returns_body_if_etag_does_not_match(self):
+        r = self.app.get(self.url, headers={'If-None-Match': '"abc"'})
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('client_id', r.json)
+
+    def test_clients_params_view_lists_every_configured_client(self):
+        app = self._get_test_app({
+            'fxa-oauth.client_id': 'abc',
+            'fxa-oauth.clients.notes.client_id': 'c73e46074a948932',
+            'fxa-oauth.clients.notes.required_scope': 'profile notes',
+        })
+        r = app.get('/fxa-oauth/params/clients')
+        oauth_endpoint = app.app.registry.settings['fxa-oauth.oauth_uri']
+        self.assertEqual(r.json['default']['client_id'], 'abc')
+        self.assertEqual(r.json['notes'], {
+            'client_id': 'c73e46074a948932',
+            'oauth_uri': oauth_endpoint,
+            'scope': 'profile notes',
+        })
+        self.assertIn('ETag', r.headers)
+
 
 class TokenViewTest(FormattedErrorMixin, BaseWebTest, unittest.TestCase):
     url = '/fxa-oauth/token'
@@ -204,8 +242,7 @@ class TokenViewTest(FormattedErrorMixin, BaseWebTest, unittest.TestCase):
 
     def __init__(self, *args, **kwargs):
         super(TokenViewTest, self).__init__(*args, **kwargs)
-        self._fxa_trade_patcher = mock.patch('kinto_fxa.views.relier.'
-                                             'OAuthClient.trade_code')
+        self._fxa_trade_patcher = mock.patch('fxa.oauth.Client.trade_code')
 
     def setUp(self):
         super(BaseWebTest, self).setUp()
@@ -247,8 +284,9 @@ class TokenViewTest(FormattedErrorMixin, BaseWebTest, unittest.TestCase):
             resp, 408, ERRORS.MISSING_AUTH_TOKEN, "Request Timeout", error_msg)
 
     def test_fails_if_state_has_expired(self):
-        with mock.patch.dict(self.app.app.registry.settings,
-                             [('fxa-oauth.cache_ttl_seconds', 0.01)]):
+        registry = self.app.app.registry
+        settings = registry._fxa_oauth_settings.replace(cache_ttl_seconds=0.01)
+        with mock.patch.object(registry, '_fxa_oauth_settings', settings):
             r = self.app.get(self.login_url)
         url = r.headers['Location']
         url_fragments = urlparse(url)
@@ -284,6 +322,30 @@ class TokenViewTest(FormattedErrorMixin, BaseWebTest, unittest.TestCase):
         self.app.get(url, status=400)
 
 
+class PolicySetupTest(BaseWebTest, unittest.TestCase):
+
+    def test_policy_is_set_up_when_application_is_created(self):
+        authn = self.app.app.registry.queryUtility(IAuthenticationPolicy)
+        policy = dict(authn.get_policies())['fxa']
+        self.assertIsNotNone(policy._auth_client)
+        self.assertIsNotNone(policy._cache)
+
+
+class ServerTimingTest(BaseWebTest, unittest.TestCase):
+    def get_app_settings(self, additional_settings=None):
+        settings = super(ServerTimingTest, self).get_app_settings(additional_settings)
+        settings['fxa-oauth.server_timing.enabled'] = True
+        return settings
+
+    def test_server_timing_is_sent_on_authenticated_requests(self):
+        resp = self.app.get('/', headers={'Authorization': 'Bearer foo'})
+        self.assertIn('fxa-auth;dur=', resp.headers['Server-Timing'])
+
+    def test_server_timing_is_not_sent_on_anonymous_requests(self):
+        resp = self.app.get('/')
+        self.assertNotIn('Server-Timing', resp.headers)
+
+
 class CapabilityTestView(BaseWebTest, unittest.TestCase):
 
     def test_fxa_capability(self, additional_settings=None):
@@ -0,0 +1,69 @@
+import io
+import mock
+import unittest
+
+from fxa import errors as fxa_errors
+from kinto.core.cache import memory as memory_backend
+from kinto.core.testing import DummyRequest
+
+from kinto_fxa import DEFAULT_SETTINGS
+from kinto_fxa.authentication import FxAOAuthAuthenticationPolicy, warm_up_verification_cache
+from kinto_fxa.reload import build_clients_tables
+from kinto_fxa.scripts.warm_up_cache import warm_up_cache
+from kinto_fxa.utils import FxAOAuthSettings
+
+
+class WarmUpCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = memory_backend.Cache(cache_prefix="tests",
+                                            cache_max_size_bytes=float("inf"))
+        self.registry = DummyRequest().registry
+        self.registry.cache = self.backend
+        settings = DEFAULT_SETTINGS.copy()
+        settings['fxa-oauth.required_scope'] = 'profile'
+        self.registry._fxa_oauth_settings = FxAOAuthSettings.from_settings(settings)
+        self.registry._fxa_oauth_clients = build_clients_tables(
+            settings, self.registry._fxa_oauth_settings)
+        self.config = {'registry': self.registry}
+
+        patcher = mock.patch('fxa.oauth.APIClient.post')
+        self.api_mocked = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        def verify(url, body):
+            if body['token'].startswith('invalid'):
+                raise fxa_errors.ClientError
+            if body['token'] == 'unavailable':
+                raise fxa_errors.OutOfProtocolError
+            return {'user': body['token'], 'scope': ['profile'], 'client_id': ''}
+        self.api_mocked.side_effect = verify
+
+    def tearDown(self):
+        self.backend.flush()
+
+    def test_tokens_are_verified_and_counted(self):
+        tokens = ['a', 'invalid-b', 'c', 'unavailable']
+        verified, rejected = warm_up_verification_cache(self.registry, tokens, max_workers=2)
+        self.assertEqual(verified, 2)
+        self.assertEqual(rejected, 2)
+
+    def test_blank_lines_are_skipped(self):
+        verified, rejected = warm_up_verification_cache(self.registry, ['\n', 'a\n'])
+        self.assertEqual((verified, rejected), (1, 0))
+        self.api_mocked.assert_called_once_with('/verify', {'token': 'a'})
+
+    def test_verifications_are_cached_for_the_policy(self):
+        warm_up_verification_cache(self.registry, ['a', 'b'])
+        self.api_mocked.reset_mock()
+
+        request = DummyRequest()
+        request.bound_data = {}
+        request.registry = self.registry
+        request.headers['Authorization'] = 'Bearer a'
+        user_id = FxAOAuthAuthenticationPolicy().authenticated_userid(request)
+        self.assertEqual(user_id, 'a')
+        self.assertFalse(self.api_mocked.called)
+
+    def test_script_reads_tokens_from_file(self):
+        tokens_file = io.StringIO('a\nb\ninvalid\n')
+        self.assertEqual(warm_up_cache(self.config, tokens_file, max_workers=4), (2, 1))
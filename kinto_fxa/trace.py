@@ -0,0 +1,52 @@
+"""Traces of the token verification cache lookups.
+
+In order to size the cache and pick TTLs from real traffic, the policy can
+append a line to a trace file for every verified token, with tab-separated:
+
+- the timestamp;
+- a truncated HMAC of the token (with the ``userid_hmac_secret``), so that
+  tokens can't be recovered from the trace, but lookups of the same token can
+  be matched between workers;
+- the name of the matching client (``-`` if none);
+- ``1`` if the verification was found in the cache, ``0`` otherwise.
+
+Traces can be replayed with ``kinto-fxa simulate-cache``.
+"""
+import threading
+import time
+
+from kinto.core.utils import hmac_digest
+
+#: Number of hexadecimal characters of the token HMAC that are kept.
+TOKEN_HASH_LENGTH = 16
+
+
+class TraceWriter(object):
+    """Append cache lookups to a trace file."""
+    def __init__(self, path, secret, clock=time.time):
+        self.secret = secret
+        self.clock = clock
+        self._file = open(path, 'a', buffering=1)
+        self._lock = threading.Lock()
+
+    def record(self, token, client_name, hit):
+        token_hash = hmac_digest(self.secret, token)[:TOKEN_HASH_LENGTH]
+        fields = ('{:.3f}'.format(self.clock()), token_hash, client_name or '-', str(int(hit)))
+        line = '\t'.join(fields) + '\n'
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        self._file.close()
+
+
+def read_trace(fileobj):
+    """Yield the ``(timestamp, token_hash, client_name, hit)`` lookups of a
+    trace file, skipping malformed lines.
+    """
+    for line in fileobj:
+        try:
+            timestamp, token_hash, client_name, hit = line.rstrip('\n').split('\t')
+            yield float(timestamp), token_hash, client_name, hit == '1'
+        except ValueError:
+            continue
@@ -1,12 +1,209 @@
+import re
+import threading
+import warnings
+
 from pyramid.exceptions import ConfigurationError
+from pyramid.settings import asbool, aslist
 from collections import OrderedDict
 
 
+class FxAOAuthSettings(object):
+    """Immutable and typed view of the ``fxa-oauth.*`` settings.
+
+    Values are validated and converted once in ``includeme``, so that bad
+    configurations fail at startup and requests don't have to parse them again.
+    """
+    __slots__ = (
+        'authorized_domains',
+        'cache_admission_enabled',
+        'cache_generations_ttl_seconds',
+        'cache_local_max_entries',
+        'cache_local_ttl_seconds',
+        'cache_shared_memory_path',
+        'cache_shared_memory_slots',
+        'cache_trace_file',
+        'cache_ttl_jitter',
+        'cache_ttl_seconds',
+        'client_id',
+        'client_secret',
+        'clients_reload_cache_key',
+        'clients_reload_file',
+        'clients_reload_interval_seconds',
+        'failover_uris',
+        'heartbeat_timeout_seconds',
+        'hedging_enabled',
+        'hedging_min_delay_seconds',
+        'hedging_percentile',
+        'oauth_uri',
+        'params_cache_expires_seconds',
+        'principal_index_enabled',
+        'ratelimit_enabled',
+        'ratelimit_failures_burst',
+        'ratelimit_failures_per_second',
+        'ratelimit_global_failures_burst',
+        'ratelimit_global_failures_per_second',
+        'ratelimit_max_clients',
+        'ratelimit_shared',
+        'ratelimit_trusted_proxies',
+        'relier_enabled',
+        'requested_scope',
+        'requested_scopes',
+        'required_scope',
+        'server_timing_enabled',
+        'state_ttl_seconds',
+        'token_max_length',
+    )
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is read-only'.format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError('{} is read-only'.format(type(self).__name__))
+
+    def __repr__(self):
+        values = ', '.join('{}={!r}'.format(name, getattr(self, name))
+                           for name in self.__slots__ if name != 'client_secret')
+        return '{}({})'.format(type(self).__name__, values)
+
+    def replace(self, **changes):
+        """Return a copy of these settings with the specified values changed."""
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        return type(self)(**values)
+
+    @classmethod
+    def from_settings(cls, settings):
+        requested_scope = settings['fxa-oauth.requested_scope'] or ''
+        return cls(
+            authorized_domains=tuple(aslist(settings['fxa-oauth.webapp.authorized_domains'])),
+            cache_admission_enabled=asbool(settings['fxa-oauth.cache.admission.enabled']),
+            cache_generations_ttl_seconds=_as_float(settings,
+                                                    'fxa-oauth.cache.generations_ttl_seconds'),
+            cache_local_max_entries=int(_as_float(settings, 'fxa-oauth.cache.local_max_entries')),
+            cache_local_ttl_seconds=_as_float(settings, 'fxa-oauth.cache.local_ttl_seconds'),
+            cache_shared_memory_path=settings['fxa-oauth.cache.shared_memory_path'] or None,
+            cache_shared_memory_slots=int(_as_float(settings,
+                                                    'fxa-oauth.cache.shared_memory_slots')),
+            cache_trace_file=settings['fxa-oauth.cache.trace_file'] or None,
+            cache_ttl_jitter=_as_float(settings, 'fxa-oauth.cache_ttl_jitter'),
+            cache_ttl_seconds=_as_float(settings, 'fxa-oauth.cache_ttl_seconds'),
+            client_id=settings['fxa-oauth.client_id'],
+            client_secret=settings['fxa-oauth.client_secret'],
+            clients_reload_cache_key=settings['fxa-oauth.clients_reload.cache_key'] or None,
+            clients_reload_file=settings['fxa-oauth.clients_reload.file'] or None,
+            clients_reload_interval_seconds=_as_float(
+                settings, 'fxa-oauth.clients_reload.interval_seconds'),
+            failover_uris=tuple(aslist(settings['fxa-oauth.failover_uris'])),
+            heartbeat_timeout_seconds=_as_float(settings,
+                                                'fxa-oauth.heartbeat_timeout_seconds'),
+            hedging_enabled=asbool(settings['fxa-oauth.hedging.enabled']),
+            hedging_min_delay_seconds=_as_float(settings,
+                                                'fxa-oauth.hedging.min_delay_seconds'),
+            hedging_percentile=_as_float(settings, 'fxa-oauth.hedging.percentile'),
+            oauth_uri=settings['fxa-oauth.oauth_uri'],
+            params_cache_expires_seconds=int(
+                _as_float(settings, 'fxa-oauth.params.cache_expires_seconds')),
+            principal_index_enabled=asbool(settings['fxa-oauth.principal_index.enabled']),
+            ratelimit_enabled=asbool(settings['fxa-oauth.ratelimit.enabled']),
+            ratelimit_failures_burst=_as_float(settings, 'fxa-oauth.ratelimit.failures_burst'),
+            ratelimit_failures_per_second=_as_float(
+                settings, 'fxa-oauth.ratelimit.failures_per_second'),
+            ratelimit_global_failures_burst=_as_float(
+                settings, 'fxa-oauth.ratelimit.global_failures_burst'),
+            ratelimit_global_failures_per_second=_as_float(
+                settings, 'fxa-oauth.ratelimit.global_failures_per_second'),
+            ratelimit_max_clients=int(_as_float(settings, 'fxa-oauth.ratelimit.max_clients')),
+            ratelimit_shared=asbool(settings['fxa-oauth.ratelimit.shared']),
+            ratelimit_trusted_proxies=int(_as_float(settings,
+                                                    'fxa-oauth.ratelimit.trusted_proxies')),
+            relier_enabled=asbool(settings['fxa-oauth.relier.enabled']),
+            requested_scope=requested_scope,
+            requested_scopes=tuple(requested_scope.split()),
+            required_scope=settings['fxa-oauth.required_scope'],
+            server_timing_enabled=asbool(settings['fxa-oauth.server_timing.enabled']),
+            state_ttl_seconds=_as_float(settings, 'fxa-oauth.state.ttl_seconds'),
+            token_max_length=int(_as_float(settings, 'fxa-oauth.token_max_length')),
+        )
+
+
+def _as_float(settings, key):
+    value = settings[key]
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        message = '{} should be a number, got {!r}.'.format(key, value)
+        raise ConfigurationError(message)
+
+
+class StripedLock(object):
+    """Fixed table of locks, picked by hashing a key.
+
+    Threads working on the same key are serialized, while unrelated keys are
+    spread over several locks instead of contending for a global one.
+    """
+    def __init__(self, stripes=64):
+        if stripes < 1:
+            raise ValueError('At least one lock stripe is required.')
+        self._locks = tuple(threading.Lock() for _ in range(stripes))
+
+    def get(self, key):
+        return self._locks[hash(key) % len(self._locks)]
+
+
+def verification_cache_key(token, scope):
+    """Return the key under which PyFxA caches the verification of ``token``
+    for the specified ``scope``.
+    """
+    # PyFxA is imported on first use, since it is slow to import.
+    from fxa._utils import get_hmac
+    from fxa.oauth import TOKEN_HMAC_SECRET
+
+    return 'fxa.oauth.verify_token:%s:%s' % (get_hmac(token, TOKEN_HMAC_SECRET), scope)
+
+
+def fxa_settings(request):
+    """Return the :class:`FxAOAuthSettings` computed at startup."""
+    return request.registry._fxa_oauth_settings
+
+
 def fxa_conf(request, name):
+    """Return the raw value of the ``fxa-oauth.<name>`` setting.
+
+    Deprecated, use :func:`fxa_settings` instead.
+    """
+    message = 'fxa_conf() is deprecated. Please use fxa_settings() instead.'
+    warnings.warn(message, DeprecationWarning, stacklevel=2)
     key = 'fxa-oauth.%s' % name
     return request.registry.settings[key]
 
 
+def get_userid_variants(settings):
+    """Return the prefix and suffixes of the user IDs of FxA accounts.
+
+    User IDs are prefixed with the name of the FxA authentication policy, and
+    suffixed with the name of each configured client (or nothing).
+    """
+    # Go through configured policies to find the policy name.
+    prefix = ""
+    for k, v in settings.items():
+        m = re.match('multiauth\\.policy\\.(.*)\\.use', k)
+        if m:
+            if v.endswith('FxAOAuthAuthenticationPolicy'):
+                prefix = "{}:".format(m.group(1))
+
+    suffixes = [""]
+    # Go through configured clients.
+    for k, v in settings.items():
+        m = re.match('fxa-oauth\\.clients\\.(.*)\\.client_id', k)
+        if m:
+            suffixes.append("-{}".format(m.group(1)))
+    return prefix, suffixes
+
+
 def parse_clients(settings):
     resources = OrderedDict()
     scope_routing = {}
@@ -1,19 +1,84 @@
+import hashlib
+import json
+from collections import namedtuple, OrderedDict
+
 from kinto.core import errors, Service
 from pyramid.security import NO_PERMISSION_REQUIRED
 
-from kinto_fxa.utils import fxa_conf
+from kinto_fxa.utils import fxa_settings
 
 
 params = Service(name='fxa-oauth-params',
                  path='/fxa-oauth/params',
                  error_handler=errors.json_error_handler)
 
+clients_params = Service(name='fxa-oauth-clients-params',
+                         path='/fxa-oauth/params/clients',
+                         error_handler=errors.json_error_handler)
+
+
+#: Response body serialized once at configuration time, with its strong ETag.
+SerializedParams = namedtuple('SerializedParams', ['body', 'etag'])
+
+
+def serialize_params(data):
+    """Serialize ``data`` as JSON and compute a strong ETag from its content.
+    """
+    body = json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    etag = hashlib.sha256(body).hexdigest()[:32]
+    return SerializedParams(body=body, etag=etag)
+
+
+def build_params(settings, resources):
+    """Build the serialized responses of the params endpoints.
+
+    Returns a tuple with the default client parameters and the parameters
+    of every configured client, indexed by client name.
+    """
+    default = {
+        'client_id': settings.client_id,
+        'oauth_uri': settings.oauth_uri,
+        'scope': settings.required_scope,
+    }
+    clients = OrderedDict()
+    for client_name, resource in resources.items():
+        clients[client_name] = {
+            'client_id': resource.get('client_id'),
+            'oauth_uri': resource.get('oauth_uri', default['oauth_uri']),
+            'scope': resource.get('required_scope'),
+        }
+    return serialize_params(default), serialize_params(clients)
+
+
+def serve_params(request, serialized):
+    """Serve a precomputed body with HTTP caching headers.
+
+    If the client already has the current version, reply with a
+    ``304 Not Modified`` without any body.
+    """
+    response = request.response
+    response.etag = serialized.etag
+    max_age = fxa_settings(request).params_cache_expires_seconds
+    response.cache_control = 'public, max-age=%s' % max_age
+
+    if serialized.etag in request.if_none_match:
+        response.status_code = 304
+        # A 304 has no content, and thus no content type.
+        del response.content_type
+        return response
+
+    response.content_type = 'application/json'
+    response.body = serialized.body
+    return response
+
 
 @params.get(permission=NO_PERMISSION_REQUIRED)
 def fxa_oauth_params(request):
     """Helper to give Firefox Account configuration information."""
-    return {
-        'client_id': fxa_conf(request, 'client_id'),
-        'oauth_uri': fxa_conf(request, 'oauth_uri'),
-        'scope': fxa_conf(request, 'required_scope'),
-    }
+    return serve_params(request, request.registry._fxa_oauth_clients.params)
+
+
+@clients_params.get(permission=NO_PERMISSION_REQUIRED)
+def fxa_oauth_clients_params(request):
+    """Helper to give Firefox Account configuration of every configured client."""
+    return serve_params(request, request.registry._fxa_oauth_clients.clients_params)
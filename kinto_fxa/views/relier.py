@@ -5,12 +5,9 @@ from fnmatch import fnmatch
 
 from cornice.validators import colander_validator
 import colander
-from fxa.oauth import Client as OAuthClient
-from fxa import errors as fxa_errors
 
 from pyramid import httpexceptions
 from pyramid.security import NO_PERMISSION_REQUIRED
-from pyramid.settings import aslist
 
 from kinto.core import Service
 from kinto.core.errors import (
@@ -18,7 +15,7 @@ from kinto.core.errors import (
 )
 from kinto.core.resource.schema import URL
 
-from kinto_fxa.utils import fxa_conf
+from kinto_fxa.utils import fxa_settings
 
 
 logger = logging.getLogger(__name__)
@@ -40,7 +37,7 @@ def persist_state(request):
     """
     state = uuid.uuid4().hex
     redirect_url = request.validated['querystring']['redirect']
-    expiration = float(fxa_conf(request, 'cache_ttl_seconds'))
+    expiration = fxa_settings(request).cache_ttl_seconds
 
     cache = request.registry.cache
     cache.set(state, redirect_url, expiration)
@@ -57,7 +54,7 @@ class FxALoginRequest(colander.MappingSchema):
 
 
 def authorized_redirect(req, **kwargs):
-    authorized = aslist(fxa_conf(req, 'webapp.authorized_domains'))
+    authorized = fxa_settings(req).authorized_domains
     if not req.validated:
         # Schema was not validated. Give up.
         return False
@@ -76,12 +73,12 @@ def authorized_redirect(req, **kwargs):
 def fxa_oauth_login(request):
     """Helper to redirect client towards FxA login form."""
     state = persist_state(request)
+    settings = fxa_settings(request)
     form_url = ('{oauth_uri}/authorization?action=signin'
                 '&client_id={client_id}&state={state}&scope={scope}')
-    scopes = fxa_conf(request, 'requested_scope')
-    form_url = form_url.format(oauth_uri=fxa_conf(request, 'oauth_uri'),
-                               client_id=fxa_conf(request, 'client_id'),
-                               scope='+'.join(scopes.split()),
+    form_url = form_url.format(oauth_uri=settings.oauth_uri,
+                               client_id=settings.client_id,
+                               scope='+'.join(settings.requested_scopes),
                                state=state)
     request.response.status_code = 302
     request.response.headers['Location'] = form_url
@@ -103,6 +100,9 @@ class OAuthRequest(colander.MappingSchema):
 def fxa_oauth_token(request):
     """Return OAuth token from authorization code.
     """
+    from fxa import errors as fxa_errors
+    from fxa.oauth import Client as OAuthClient
+
     state = request.validated['querystring']['state']
     code = request.validated['querystring']['code']
 
@@ -118,9 +118,10 @@ def fxa_oauth_token(request):
                           message=error_msg)
 
     # Trade the OAuth code for a longer-lived token
-    auth_client = OAuthClient(server_url=fxa_conf(request, 'oauth_uri'),
-                              client_id=fxa_conf(request, 'client_id'),
-                              client_secret=fxa_conf(request, 'client_secret'))
+    settings = fxa_settings(request)
+    auth_client = OAuthClient(server_url=settings.oauth_uri,
+                              client_id=settings.client_id,
+                              client_secret=settings.client_secret)
     try:
         token = auth_client.trade_code(code)
     except fxa_errors.OutOfProtocolError: